@@ -3,6 +3,20 @@ from __future__ import unicode_literals
 
 from django.apps import AppConfig
 
+from .config_handler.config import GerritFetchConfig
+from .gerrit_handler import archive, connection
+
 
 class LeaderboardConfig(AppConfig):
     name = 'leaderboard'
+
+    def ready(self):
+        config = GerritFetchConfig()
+        # gerrit connections are shared by all threads of the process, so the
+        # pool is built once, before anything connects, with the compression
+        # its connections are made with
+        connection.pool = connection.GerritConnectionPool(
+            compress=config.compression())
+        # pages fetched by any fetch, including those of streamed events, are
+        # archived in the configured directory
+        archive.pages = archive.PageArchive(config.archive_dir())
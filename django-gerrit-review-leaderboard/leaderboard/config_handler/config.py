@@ -10,6 +10,13 @@ import os
 CONFIG_FILE = "fetcher.cfg"
 CONFIG_FILE_PATH = os.path.join(settings.BASE_DIR, CONFIG_FILE)
 CONFIG_FILE_SECTION = "fetch"
+# default number of seconds between background syncs
+DEFAULT_SYNC_INTERVAL = 300
+# default maximum number of concurrent gerrit queries made by a sharded sync
+DEFAULT_FETCH_CONCURRENCY = 4
+# default number of seconds the open change load is shown for before being
+# fetched again
+DEFAULT_OPEN_LOAD_TTL = 60
 
 
 class GerritFetchConfig:
@@ -33,19 +40,52 @@ class GerritFetchConfig:
         self._username = self.config[CONFIG_FILE_SECTION]['username']
         self._port = int(self.config[CONFIG_FILE_SECTION]['port'])
         self._max_days = int(self.config[CONFIG_FILE_SECTION]['maxdays'])
+        # optional, config files created by older versions won't have it
+        self._sync_interval = self.config[CONFIG_FILE_SECTION].getint(
+            'syncinterval', DEFAULT_SYNC_INTERVAL)
+        self._compression = self.config[CONFIG_FILE_SECTION].getboolean(
+            'compression', False)
+        self._sharded_sync = self.config[CONFIG_FILE_SECTION].getboolean(
+            'shardedsync', False)
+        self._fetch_concurrency = self.config[CONFIG_FILE_SECTION].getint(
+            'fetchconcurrency', DEFAULT_FETCH_CONCURRENCY)
+        self._open_load_ttl = self.config[CONFIG_FILE_SECTION].getint(
+            'openloadttl', DEFAULT_OPEN_LOAD_TTL)
+        # relative to the site's directory, pages aren't archived if blank
+        archive_dir = self.config[CONFIG_FILE_SECTION].get('archivedir', '')
+        self._archive_dir = archive_dir and os.path.join(settings.BASE_DIR,
+                                                         archive_dir)
         logging.info(
-            "Loaded hostname: %s username: %s port: %d max_days: %d from %s",
+            "Loaded hostname: %s username: %s port: %d max_days: %d "
+            "sync_interval: %d compression: %s sharded_sync: %s "
+            "fetch_concurrency: %d open_load_ttl: %d archive_dir: %s "
+            "from %s",
             self._hostname,
             self._username,
             self._port,
             self._max_days,
+            self._sync_interval,
+            self._compression,
+            self._sharded_sync,
+            self._fetch_concurrency,
+            self._open_load_ttl,
+            self._archive_dir or None,
             CONFIG_FILE_PATH)
 
     def _create_default_config_file(self):
         self.config[CONFIG_FILE_SECTION] = {'hostname': 'gerrit.myhost.com',
                                             'username': 'gerritleaderboard',
                                             'port': '29418',
-                                            'maxdays': '180'}
+                                            'maxdays': '180',
+                                            'syncinterval': str(
+                                                DEFAULT_SYNC_INTERVAL),
+                                            'compression': 'no',
+                                            'shardedsync': 'no',
+                                            'fetchconcurrency': str(
+                                                DEFAULT_FETCH_CONCURRENCY),
+                                            'openloadttl': str(
+                                                DEFAULT_OPEN_LOAD_TTL),
+                                            'archivedir': ''}
         # write config file
         with open(CONFIG_FILE_PATH, 'w') as config_file:
             self.config.write(config_file)
@@ -70,3 +110,39 @@ class GerritFetchConfig:
         from config file
         """
         return self._max_days
+
+    def sync_interval(self):
+        """Returns number of seconds to wait between background syncs, read
+        from config file
+        """
+        return self._sync_interval
+
+    def compression(self):
+        """Returns whether to use SSH compression for gerrit connections, read
+        from config file
+        """
+        return self._compression
+
+    def sharded_sync(self):
+        """Returns whether to sync changes with a gerrit query per project,
+        read from config file
+        """
+        return self._sharded_sync
+
+    def fetch_concurrency(self):
+        """Returns maximum number of gerrit queries a sharded sync runs at a
+        time, read from config file
+        """
+        return self._fetch_concurrency
+
+    def open_load_ttl(self):
+        """Returns number of seconds open change load is cached for before
+        being fetched again, read from config file
+        """
+        return self._open_load_ttl
+
+    def archive_dir(self):
+        """Returns directory to archive pages of changes fetched in, read from
+        config file, None if they aren't archived
+        """
+        return self._archive_dir or None
@@ -1,16 +1,132 @@
 """For fetching current open changes from gerrit and processing per project
 count per reviewer"""
+from datetime import datetime, timedelta
+import logging
 
+from django.db import transaction
+from pygerrit.error import GerritError
+
+from . import database_helper
 from ..config_handler.config import GerritFetchConfig
 from ..gerrit_handler import fetch
+from ..models import SyncState
+from ..sync import database_helper as sync_database_helper
+from ..sync import lease
+
+# changes updated this long before the last refresh are fetched again, in
+# case gerrit hadn't indexed all changes updated at the time
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+def _fetch_pages(fetch_changes, config, after_datetime_utc):
+    """Fetch pages of changes, newest first, until there are no more
+
+    :arg callable fetch_changes: fetch.fetch_open_changes or
+        fetch.fetch_closed_changes
+    :arg GerritFetchConfig config: gerrit server configuration
+    :arg datetime.datetime after_datetime_utc: time in UTC to fetch changes
+        last updated after, None to fetch all changes
+    :Yields: lists of pygerrit.models.Change objects
+    :Raises: GerritError, OSError, or EOFError if fetching fails
+    """
+    before_datetime_utc = None
+    skip = 0
+    while True:
+        gerrit_changes = fetch_changes(
+            config.hostname(), config.username(), config.port(),
+            raise_errors=True, after_datetime_utc=after_datetime_utc,
+            skip=skip, before_datetime_utc=before_datetime_utc)
+        if not gerrit_changes:
+            return
+        yield gerrit_changes
+        before_datetime_utc, skip = fetch.next_page_cursor(
+            gerrit_changes, before_datetime_utc, skip)
+
+
+def _get_latest_timestamp(gerrit_changes, latest_datetime_utc):
+    for gerrit_change in gerrit_changes:
+        updated = sync_database_helper.convert_to_utc_datetime(
+            gerrit_change.last_update_timestamp)
+        if not latest_datetime_utc or updated > latest_datetime_utc:
+            latest_datetime_utc = updated
+    return latest_datetime_utc
+
+
+def refresh_open_changes():
+    """Update open changes stored in the database from gerrit
 
+    The first refresh fetches all open changes. After that, only open changes
+    updated since the last refresh are fetched, along with changes closed
+    (merged or abandoned) since then, which are retired from the open changes
+    stored. Open change counts per reviewer are adjusted as changes are
+    stored, so they don't need to be recounted.
 
-def get_open_change_reviewers_per_project():
+    Only one refresh runs at a time across all processes, a refresh started
+    while another is running returns without fetching anything.
+
+    :Return: count of open and closed changes fetched
+    :Raises: GerritError, OSError, or EOFError if fetching fails
+    """
+    with lease.hold(SyncState.QUERY_OPEN) as acquired:
+        if not acquired:
+            logging.info("Open changes are already being refreshed")
+            return 0
+        return _refresh_open_changes()
+
+
+def _refresh_open_changes():
+    config = GerritFetchConfig()
+    sync_state = sync_database_helper.start_sync(config.hostname(),
+                                                 SyncState.QUERY_OPEN)
+    last_refresh_datetime_utc = sync_state.watermark
+    after_datetime_utc = last_refresh_datetime_utc and \
+        last_refresh_datetime_utc - REFRESH_OVERLAP
+    latest_datetime_utc = last_refresh_datetime_utc
+    change_count = 0
+    try:
+        # changes fetched by a full refresh, anything else stored is closed
+        fetched_numbers = set()
+        for gerrit_changes in _fetch_pages(fetch.fetch_open_changes, config,
+                                           after_datetime_utc):
+            with transaction.atomic():
+                database_helper.update(gerrit_changes)
+            fetched_numbers.update(int(gerrit_change.number)
+                                   for gerrit_change in gerrit_changes)
+            latest_datetime_utc = _get_latest_timestamp(gerrit_changes,
+                                                        latest_datetime_utc)
+            change_count += len(gerrit_changes)
+        if after_datetime_utc:
+            for gerrit_changes in _fetch_pages(fetch.fetch_closed_changes,
+                                               config, after_datetime_utc):
+                with transaction.atomic():
+                    database_helper.retire(
+                        int(gerrit_change.number)
+                        for gerrit_change in gerrit_changes)
+                latest_datetime_utc = _get_latest_timestamp(
+                    gerrit_changes, latest_datetime_utc)
+                change_count += len(gerrit_changes)
+        else:
+            with transaction.atomic():
+                database_helper.retire(
+                    database_helper.get_stored_numbers() - fetched_numbers)
+    except (GerritError, OSError, EOFError) as err:
+        sync_database_helper.finish_sync(sync_state, change_count, err)
+        raise
+    # if there are no open changes, the next refresh fetches changes updated
+    # since this one
+    sync_database_helper.finish_sync(
+        sync_state, change_count,
+        watermark=latest_datetime_utc or datetime.utcnow())
+    logging.info("Refreshed open changes, fetched %d changes", change_count)
+    return change_count
+
+
+def get_open_change_reviewers_per_project(raise_errors=False):
     """Returns count of open changes per reviewer per project
 
-    Fetches all open changes from gerrit, and returns a dictionary containing
-    all projects with open changes, and for each project, all reviewers and the
-    count of changes they are reviewing. e.g.
+    Refreshes open changes stored in the database from gerrit, and returns a
+    dictionary containing all projects with open changes, and for each
+    project, all reviewers and the count of changes they are reviewing. e.g.
         {
             "project-a" : {
                             "Reviewer 1": 2,
@@ -20,34 +136,16 @@ def get_open_change_reviewers_per_project():
             ...
         }
 
+    :arg bool raise_errors: whether to raise gerrit and connection errors
+        instead of returning the counts as of the last refresh
     :Return: A dictionary of all projects with keyed by project name and a
     dictionary of reviewer names as keys and open change counts as values, as
     value.
     """
-    config = GerritFetchConfig()
-    open_changes = fetch.fetch_open_changes(
-        config.hostname(), config.username(), config.port())
-    open_change_reviewers_per_project = {}
-    for gerrit_change in open_changes:
-        project = gerrit_change.project
-        reviewers = gerrit_change.reviewers
-        if not reviewers:
-            continue
-        # Skip Jenkins
-        reviewers[:] = [
-            reviewer
-            for reviewer in reviewers
-            if reviewer.name and "Jenkins" not in reviewer.name]
-        if project in open_change_reviewers_per_project:
-            reviewer_open_count = open_change_reviewers_per_project[project]
-            for reviewer in reviewers:
-                if reviewer.name in reviewer_open_count:
-                    reviewer_open_count[reviewer.name] += 1
-                else:
-                    reviewer_open_count[reviewer.name] = 1
-        else:
-            reviewer_open_count = {}
-            for reviewer in reviewers:
-                reviewer_open_count[reviewer.name] = 1
-            open_change_reviewers_per_project[project] = reviewer_open_count
-    return open_change_reviewers_per_project
+    try:
+        refresh_open_changes()
+    except (GerritError, OSError, EOFError) as err:
+        if raise_errors:
+            raise
+        logging.error("Unable to refresh open changes: %s", err)
+    return database_helper.get_open_change_reviewers_per_project()
@@ -0,0 +1,151 @@
+"""For persisting open pygerrit Changes and their reviewers, along with the
+count of open changes per reviewer per project
+"""
+from collections import Counter
+
+from django.db.models import F
+
+from ..models import OpenChange, OpenChangeReviewer, OpenReviewerLoad
+from ..sync.database_helper import convert_to_utc_datetime, chunks
+
+
+def _get_reviewer_names(gerrit_change):
+    """Return names of reviewers of given open change, other than Jenkins
+
+    :arg pygerrit.models.Change gerrit_change: open change
+    :Returns: set of reviewer names
+    """
+    return set(reviewer.name for reviewer in gerrit_change.reviewers
+               if reviewer.name and "Jenkins" not in reviewer.name)
+
+
+def _get_open_changes(numbers):
+    """Return open changes with given numbers along with their reviewers
+
+    :arg iterable numbers: gerrit change numbers
+    :Returns: dictionary of change numbers to tuples of OpenChange and set of
+        reviewer names
+    """
+    open_changes = {}
+    for chunk in chunks(numbers):
+        for open_change in OpenChange.objects.filter(number__in=chunk):
+            open_changes[open_change.number] = (open_change, set())
+        for number, reviewer_name in OpenChangeReviewer.objects.filter(
+                change__number__in=chunk).values_list('change__number',
+                                                      'reviewer_name'):
+            open_changes[number][1].add(reviewer_name)
+    return open_changes
+
+
+def _adjust_loads(load_changes):
+    """Add given counts to reviewers' open change counts
+
+    :arg Counter load_changes: counts to add keyed by tuples of project name
+        and reviewer name
+    """
+    for (project_name, reviewer_name), count in load_changes.items():
+        if not count:
+            continue
+        updated = OpenReviewerLoad.objects.filter(
+            project_name=project_name, reviewer_name=reviewer_name).update(
+                open_count=F('open_count') + count)
+        if not updated:
+            OpenReviewerLoad.objects.create(project_name=project_name,
+                                            reviewer_name=reviewer_name,
+                                            open_count=count)
+    # only counts of the projects adjusted can have dropped to zero
+    project_names = set(project_name for project_name, _ in load_changes)
+    for chunk in chunks(project_names):
+        OpenReviewerLoad.objects.filter(project_name__in=chunk,
+                                        open_count__lte=0).delete()
+
+
+def update(gerrit_changes):
+    """Add or update given open changes
+
+    Reviewers of changes already stored are replaced, and open change counts
+    of reviewers are adjusted by the difference.
+
+    :arg list gerrit_changes: open pygerrit.models.Change objects
+    """
+    # the newest version of each change, changes are fetched newest first
+    gerrit_changes_by_number = {}
+    for gerrit_change in reversed(gerrit_changes):
+        gerrit_changes_by_number[int(gerrit_change.number)] = gerrit_change
+    stored_changes = _get_open_changes(gerrit_changes_by_number)
+    load_changes = Counter()
+    new_changes = []
+    new_reviewers = {}
+    for number, gerrit_change in gerrit_changes_by_number.items():
+        reviewer_names = _get_reviewer_names(gerrit_change)
+        timestamp = convert_to_utc_datetime(
+            gerrit_change.last_update_timestamp)
+        if number in stored_changes:
+            open_change, stored_reviewer_names = stored_changes[number]
+            for reviewer_name in stored_reviewer_names:
+                load_changes[(open_change.project_name, reviewer_name)] -= 1
+            open_change.project_name = gerrit_change.project
+            open_change.timestamp = timestamp
+            open_change.save()
+            OpenChangeReviewer.objects.filter(change=open_change).exclude(
+                reviewer_name__in=reviewer_names).delete()
+            new_reviewers[number] = reviewer_names - stored_reviewer_names
+        else:
+            new_changes.append(OpenChange(number=number,
+                                          project_name=gerrit_change.project,
+                                          timestamp=timestamp))
+            new_reviewers[number] = reviewer_names
+        for reviewer_name in reviewer_names:
+            load_changes[(gerrit_change.project, reviewer_name)] += 1
+    OpenChange.objects.bulk_create(new_changes)
+
+    # bulk_create() doesn't set primary keys for sqlite, look them up
+    change_ids = {}
+    for chunk in chunks(new_reviewers):
+        change_ids.update(OpenChange.objects.filter(
+            number__in=chunk).values_list('number', 'id'))
+    OpenChangeReviewer.objects.bulk_create([
+        OpenChangeReviewer(change_id=change_ids[number],
+                           reviewer_name=reviewer_name)
+        for number, reviewer_names in new_reviewers.items()
+        for reviewer_name in reviewer_names])
+    _adjust_loads(load_changes)
+
+
+def retire(numbers):
+    """Remove open changes with given numbers, e.g. as they were merged or
+    abandoned
+
+    :arg iterable numbers: gerrit change numbers, ones not stored are ignored
+    """
+    stored_changes = _get_open_changes(numbers)
+    load_changes = Counter()
+    for open_change, reviewer_names in stored_changes.values():
+        for reviewer_name in reviewer_names:
+            load_changes[(open_change.project_name, reviewer_name)] -= 1
+    for chunk in chunks(stored_changes):
+        OpenChange.objects.filter(number__in=chunk).delete()
+    _adjust_loads(load_changes)
+
+
+def get_stored_numbers():
+    """Return numbers of all open changes stored
+
+    :Returns: set of gerrit change numbers
+    """
+    return set(OpenChange.objects.values_list('number', flat=True))
+
+
+def get_open_change_reviewers_per_project():
+    """Returns count of open changes per reviewer per project
+
+    :Return: dictionary of project names to dictionaries of reviewer names to
+        open change counts
+    """
+    open_change_reviewers_per_project = {}
+    for project_name, reviewer_name, open_count in \
+            OpenReviewerLoad.objects.values_list(
+                'project_name', 'reviewer_name', 'open_count'):
+        open_change_reviewers_per_project.setdefault(
+            project_name, {})[reviewer_name] = open_count
+    return open_change_reviewers_per_project
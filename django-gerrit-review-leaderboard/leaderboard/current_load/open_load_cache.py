@@ -0,0 +1,106 @@
+"""Cached snapshot of the count of open changes per reviewer per project, so
+that page views don't fetch all open changes from gerrit
+
+The snapshot is kept in django's cache, shared by all requests and worker
+processes. It is fetched in a background thread, outside of any request's
+transaction, and once it is older than openloadttl seconds, it is fetched
+again while the last snapshot keeps being returned.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from pygerrit.error import GerritError
+
+from . import current_load_fetcher
+from ..config_handler.config import GerritFetchConfig
+
+# cache key of tuple of snapshot and time it was fetched at
+SNAPSHOT_KEY = "leaderboard:open_load"
+# cache key held while a snapshot is being fetched, so that only one process
+# fetches it at a time
+REFRESH_LOCK_KEY = "leaderboard:open_load:refreshing"
+# seconds after which a refresh is assumed to have died, and the minimum
+# number of seconds between attempts if fetching fails
+REFRESH_LOCK_TIMEOUT = 120
+
+
+def _fetch():
+    """Fetch snapshot from gerrit and cache it
+
+    :Return: snapshot fetched
+    :Raises: GerritError, OSError, or EOFError if fetching fails,
+        DatabaseError if storing open changes fetched fails
+    """
+    snapshot = current_load_fetcher.get_open_change_reviewers_per_project(
+        raise_errors=True)
+    # kept until replaced, so there is always a snapshot to return
+    cache.set(SNAPSHOT_KEY, (snapshot, time.time()), None)
+    return snapshot
+
+
+def _refresh():
+    try:
+        _fetch()
+    except (GerritError, OSError, EOFError, DatabaseError) as err:
+        # keep returning the last snapshot, if any, and leave the lock to
+        # expire before trying again
+        logging.error("Unable to refresh open change load: %s", err)
+        return
+    finally:
+        # the thread's database connection isn't closed by a request ending
+        connection.close()
+    cache.delete(REFRESH_LOCK_KEY)
+
+
+def _refresh_in_background():
+    """Fetch snapshot in a background thread, unless it is already being
+    fetched
+
+    :Return: thread fetching the snapshot, None if already being fetched
+    """
+    if not cache.add(REFRESH_LOCK_KEY, True, REFRESH_LOCK_TIMEOUT):
+        return None
+    logging.info("Refreshing open change load in the background")
+    thread = threading.Thread(target=_refresh,
+                              name="leaderboard-open-load-refresh",
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def get_open_change_reviewers_per_project():
+    """Returns count of open changes per reviewer per project
+
+    Returns the cached snapshot, see
+    current_load_fetcher.get_open_change_reviewers_per_project() for its
+    format. If there is no snapshot yet, or it is older than openloadttl
+    seconds, it is fetched in the background, unless it is already being
+    fetched, while no open change load or the last snapshot is returned. If
+    fetching fails, it isn't fetched again for REFRESH_LOCK_TIMEOUT seconds.
+
+    :Return: dictionary of project names to dictionaries of reviewer names to
+        open change counts, empty if there is no snapshot yet
+    """
+    cached = cache.get(SNAPSHOT_KEY)
+    if cached is None:
+        _refresh_in_background()
+        return {}
+    snapshot, fetched_at = cached
+    if time.time() - fetched_at > GerritFetchConfig().open_load_ttl():
+        _refresh_in_background()
+    return snapshot
+
+
+def invalidate():
+    """Mark snapshot as out of date, so that the next request fetches it
+    again in the background
+
+    Called after a sync, as changes merged since the snapshot was fetched
+    are no longer open.
+    """
+    cached = cache.get(SNAPSHOT_KEY)
+    if cached is not None:
+        cache.set(SNAPSHOT_KEY, (cached[0], 0), None)
@@ -0,0 +1,201 @@
+"""Archive of pages of changes fetched from gerrit, kept on local disk as gzip
+compressed newline delimited JSON, so that changes can be stored again, e.g.
+after changing which comments are counted, without fetching them again
+
+Each page is kept in a file of its own, and listed in an index file along
+with the query it was fetched with, which includes the time window of the
+page, in the order pages were fetched. pygerrit parses query results without
+keeping their JSON, so changes are archived with the fields the leaderboard
+reads, named as in gerrit's query JSON.
+"""
+from datetime import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import uuid
+
+from pygerrit.models import Account, Change, Comment
+
+# file listing pages archived, one JSON object per line
+INDEX_FILE = "index.ndjson"
+
+
+def _account_to_json(account):
+    if account is None:
+        return None
+    return {"name": account.name, "username": account.username,
+            "email": account.email}
+
+
+def _account_from_json(data):
+    if data is None:
+        return None
+    account = Account([])
+    account.name = data.get('name')
+    account.username = data.get('username')
+    account.email = data.get('email')
+    return account
+
+
+def change_to_json(gerrit_change):
+    """Return given change as a dictionary that can be converted to JSON
+
+    :arg pygerrit.models.Change gerrit_change: change fetched from gerrit
+    :Returns: dictionary of change fields, named as in gerrit's query JSON
+    """
+    return {
+        "project": gerrit_change.project,
+        "id": gerrit_change.change_id,
+        "number": gerrit_change.number,
+        "subject": gerrit_change.subject,
+        "owner": _account_to_json(gerrit_change.owner),
+        "lastUpdated": gerrit_change.last_update_timestamp,
+        "comments": [{"timestamp": gerrit_comment.timestamp,
+                      "reviewer": _account_to_json(gerrit_comment.reviewer),
+                      "message": gerrit_comment.message}
+                     for gerrit_comment in gerrit_change.comments],
+        "allReviewers": [_account_to_json(reviewer)
+                         for reviewer in gerrit_change.reviewers],
+    }
+
+
+def change_from_json(data):
+    """Return change from dictionary returned by change_to_json()
+
+    :arg dict data: dictionary of change fields
+    :Returns: pygerrit.models.Change
+    """
+    gerrit_change = Change([])
+    gerrit_change.project = data.get('project')
+    gerrit_change.change_id = data.get('id')
+    gerrit_change.number = data.get('number')
+    gerrit_change.subject = data.get('subject')
+    gerrit_change.owner = _account_from_json(data.get('owner'))
+    gerrit_change.last_update_timestamp = data.get('lastUpdated')
+    gerrit_change.comments = []
+    for comment_data in data.get('comments', []):
+        gerrit_comment = Comment([])
+        gerrit_comment.timestamp = comment_data.get('timestamp')
+        gerrit_comment.reviewer = _account_from_json(
+            comment_data.get('reviewer'))
+        gerrit_comment.message = comment_data.get('message')
+        gerrit_change.comments.append(gerrit_comment)
+    gerrit_change.reviewers = [_account_from_json(reviewer) for reviewer in
+                               data.get('allReviewers', [])]
+    return gerrit_change
+
+
+class PageArchive:
+    """Archives pages of changes fetched in a directory, if one is set"""
+
+    def __init__(self, directory=None):
+        # directory to archive pages in, None to not archive them
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def write(self, gerrit_query, gerrit_changes):
+        """Archive page of changes fetched with given query
+
+        Errors writing the archive are logged rather than raised, so that
+        they don't stop changes fetched from being stored.
+
+        :arg str gerrit_query: gerrit query the changes were fetched with
+        :arg list gerrit_changes: pygerrit.models.Change objects fetched
+        """
+        directory = self.directory
+        if not directory or not gerrit_changes:
+            return
+        fetched = datetime.utcnow()
+        file_name = "%s-%s.ndjson.gz" % (fetched.strftime("%Y%m%dT%H%M%S%f"),
+                                         uuid.uuid4().hex[:8])
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with gzip.open(os.path.join(directory, file_name), 'wt',
+                           encoding='utf-8') as page_file:
+                for gerrit_change in gerrit_changes:
+                    page_file.write(json.dumps(change_to_json(gerrit_change)))
+                    page_file.write("\n")
+            # pages are listed once written, in the order they were fetched
+            with self._lock, open(os.path.join(directory, INDEX_FILE), 'a',
+                                  encoding='utf-8') as index_file:
+                index_file.write(json.dumps({
+                    "query": gerrit_query, "file": file_name,
+                    "fetched": fetched.isoformat(),
+                    "count": len(gerrit_changes),
+                    "oldest": min(
+                        float(gerrit_change.last_update_timestamp)
+                        for gerrit_change in gerrit_changes)}) + "\n")
+        except OSError as err:
+            logging.error("Unable to archive page of changes in %s: %s",
+                          directory, err)
+
+
+def read_index(directory, status=None):
+    """Return pages of changes archived in given directory, in the order they
+    were fetched, checking that each page's file exists
+
+    :arg str directory: directory pages were archived in
+    :arg str status: only return pages fetched with queries for changes with
+        given status, e.g. "merged", if specified
+    :Returns: list of dictionaries of the query each page was fetched with,
+        its file, when it was fetched, its count of changes, and the time in
+        seconds since epoch in UTC its oldest change was last updated
+    :Raises: OSError if the index can't be read, or a page's file is missing
+    """
+    entries = []
+    with open(os.path.join(directory, INDEX_FILE),
+              encoding='utf-8') as index_file:
+        for line in index_file:
+            try:
+                entry = json.loads(line)
+                gerrit_query = entry['query']
+                file_name = entry['file']
+            except (ValueError, KeyError, TypeError):
+                # e.g. a line left partly written
+                logging.warning("Ignoring invalid archive index entry: %s",
+                                line.strip()[:200])
+                continue
+            if status and "status:%s" % status not in gerrit_query.split():
+                continue
+            if not os.path.isfile(os.path.join(directory, file_name)):
+                raise FileNotFoundError(
+                    "Archived page %s not found in %s" % (file_name,
+                                                          directory))
+            entries.append(entry)
+    return entries
+
+
+def read_page(directory, entry):
+    """Read page of changes archived in given directory
+
+    :arg str directory: directory pages were archived in
+    :arg dict entry: page as returned by read_index()
+    :Returns: list of pygerrit.models.Change objects
+    :Raises: OSError if the page can't be read
+    """
+    with gzip.open(os.path.join(directory, entry['file']), 'rt',
+                   encoding='utf-8') as page_file:
+        return [change_from_json(json.loads(change_line))
+                for change_line in page_file if change_line.strip()]
+
+
+def read_pages(directory, status=None):
+    """Read pages of changes archived in given directory, a page at a time,
+    in the order they were fetched
+
+    :arg str directory: directory pages were archived in
+    :arg str status: only read pages fetched with queries for changes with
+        given status, e.g. "merged", if specified
+    :Yields: tuples of gerrit query and list of pygerrit.models.Change
+        objects
+    :Raises: OSError if the archive can't be read
+    """
+    for entry in read_index(directory, status):
+        yield entry['query'], read_page(directory, entry)
+
+
+# archive written to by all fetches in the process, replaced by one in the
+# configured directory when the leaderboard app is loaded
+pages = PageArchive()
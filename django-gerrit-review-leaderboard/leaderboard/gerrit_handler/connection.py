@@ -0,0 +1,217 @@
+"""Pool of gerrit SSH clients, so that consecutive queries to a gerrit server
+reuse an authenticated SSH connection instead of connecting for each query
+"""
+import functools
+import logging
+import threading
+import time
+
+from pygerrit.client import GerritClient
+from pygerrit.error import GerritError
+
+# number of seconds a connection can go unused before it is closed
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+class _PooledClient:
+    """A connected gerrit client along with the gerrit server version"""
+
+    def __init__(self, gerrit_client, version):
+        self.gerrit_client = gerrit_client
+        self.version = version
+        self.last_used = time.time()
+
+
+def _enable_compression(gerrit_client):
+    """Make gerrit client request SSH transport compression when it connects
+
+    pygerrit connects lazily, on the first command run, without a way to ask
+    for compression, so request it in the underlying paramiko client's
+    connect() call.
+    """
+    ssh_client = getattr(gerrit_client, '_ssh_client', None)
+    if ssh_client is None:
+        logging.warning("Unable to enable SSH compression for gerrit client")
+        return
+    ssh_client.connect = functools.partial(ssh_client.connect, compress=True)
+
+
+def _close(gerrit_client):
+    ssh_client = getattr(gerrit_client, '_ssh_client', None)
+    if ssh_client is None:
+        return
+    try:
+        ssh_client.close()
+    except (GerritError, OSError, EOFError) as err:
+        logging.warning("Error closing gerrit connection: %s", err)
+
+
+class GerritConnectionPool:
+    """Keeps one connected gerrit client per gerrit server, username and
+    port, reconnecting if a query fails, and closing connections that
+    haven't been used for idle_timeout seconds
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, compress=False):
+        self.idle_timeout = idle_timeout
+        # whether connections use SSH transport compression, which helps with
+        # large query results, set when the pool is built so that it applies
+        # to every pooled connection
+        self.compress = compress
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, hostname, username, port):
+        logging.info("Connecting to %s@%s:%d", username, hostname, port)
+        gerrit_client = GerritClient(host=hostname,
+                                     username=username,
+                                     port=port)
+        if self.compress:
+            _enable_compression(gerrit_client)
+        # connects, the version is cached as it doesn't change for the
+        # connection
+        version = gerrit_client.gerrit_version()
+        logging.info("Connected to Gerrit version [%s]", version)
+        return _PooledClient(gerrit_client, version)
+
+    def _close_idle(self):
+        now = time.time()
+        for key, pooled_client in list(self._clients.items()):
+            if now - pooled_client.last_used > self.idle_timeout:
+                logging.info("Closing idle connection to %s@%s:%d", key[1],
+                             key[0], key[2])
+                del self._clients[key]
+                _close(pooled_client.gerrit_client)
+
+    def _get(self, hostname, username, port):
+        key = (hostname, username, port)
+        with self._lock:
+            self._close_idle()
+            pooled_client = self._clients.get(key)
+            if pooled_client is None:
+                pooled_client = self._connect(hostname, username, port)
+                self._clients[key] = pooled_client
+            pooled_client.last_used = time.time()
+            return pooled_client
+
+    def _evict(self, hostname, username, port, pooled_client):
+        """Remove given client from the pool and close it, unless another
+        thread has already replaced it with a new one
+        """
+        key = (hostname, username, port)
+        with self._lock:
+            if self._clients.get(key) is not pooled_client:
+                return
+            del self._clients[key]
+        _close(pooled_client.gerrit_client)
+
+    def gerrit_version(self, hostname, username, port):
+        """Return version of gerrit server, connecting if necessary
+
+        :Raises: GerritError if unable to connect
+        """
+        return self._get(hostname, username, port).version
+
+    def _call(self, hostname, username, port, call):
+        """Call given function with a pooled gerrit client
+
+        If the call fails because of a connection error, for example if the
+        connection was dropped by the server, reconnects and retries once.
+        """
+        pooled_client = self._get(hostname, username, port)
+        try:
+            return call(pooled_client.gerrit_client)
+        except (GerritError, OSError, EOFError) as err:
+            logging.warning("Gerrit command failed, reconnecting to %s: %s",
+                            hostname, err)
+            self._evict(hostname, username, port, pooled_client)
+        pooled_client = self._get(hostname, username, port)
+        return call(pooled_client.gerrit_client)
+
+    def query(self, hostname, username, port, gerrit_query):
+        """Run gerrit query using a pooled connection
+
+        :arg str hostname: gerrit server hostname
+        :arg str username: gerrit username
+        :arg int port: port for gerrit service
+        :arg str gerrit_query: gerrit query to be executed via SSH
+        :Return: List of Change objects
+        :Raises: GerritError if unable to connect or run the query
+        """
+        return self._call(hostname, username, port,
+                          lambda gerrit_client: gerrit_client.query(
+                              gerrit_query))
+
+    def run_command(self, hostname, username, port, command):
+        """Run gerrit command using a pooled connection
+
+        :arg str hostname: gerrit server hostname
+        :arg str username: gerrit username
+        :arg int port: port for gerrit service
+        :arg str command: gerrit command to be executed via SSH, e.g.
+            "ls-projects"
+        :Return: output of the command as a string
+        :Raises: GerritError if unable to connect or run the command
+        """
+        def _run_command(gerrit_client):
+            output = gerrit_client.run_command(command).stdout.read()
+            if isinstance(output, bytes):
+                output = output.decode('utf-8')
+            return output
+        return self._call(hostname, username, port, _run_command)
+
+    def close_all(self):
+        """Close all connections"""
+        with self._lock:
+            pooled_clients = list(self._clients.values())
+            self._clients.clear()
+        for pooled_client in pooled_clients:
+            _close(pooled_client.gerrit_client)
+
+
+# connections shared by all fetches in the process, replaced by one built from
+# the fetch configuration when the leaderboard app is loaded
+pool = GerritConnectionPool()
+
+
+class EventStream:
+    """Lines of event JSON streamed from gerrit over a connection of its own,
+    which ends when the connection is closed
+    """
+
+    def __init__(self, gerrit_client, stdout):
+        self._gerrit_client = gerrit_client
+        self._stdout = stdout
+
+    def __iter__(self):
+        try:
+            for line in self._stdout:
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                yield line
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the connection, so that lines being read by another thread
+        stop being read
+        """
+        _close(self._gerrit_client)
+
+
+def open_event_stream(hostname, username, port):
+    """Connect to gerrit and start streaming events
+
+    The stream has a connection of its own, as it stays open for as long as
+    events are read, instead of a pooled one.
+
+    :arg str hostname: gerrit server hostname
+    :arg str username: gerrit username
+    :arg int port: port for gerrit service
+    :Return: EventStream of lines of event JSON
+    :Raises: GerritError if unable to connect
+    """
+    logging.info("Streaming events from %s@%s:%d", username, hostname, port)
+    gerrit_client = GerritClient(host=hostname, username=username, port=port)
+    return EventStream(gerrit_client,
+                       gerrit_client.run_command("stream-events").stdout)
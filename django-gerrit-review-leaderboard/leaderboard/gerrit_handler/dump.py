@@ -0,0 +1,63 @@
+"""Reads changes from files of gerrit query output, e.g. captured with
+`gerrit query --format=JSON --comments status:merged ...`, so that changes can
+be stored without connecting to gerrit
+
+Files are newline delimited JSON, one change per line followed by a line of
+query stats, and may be gzip compressed. They are read a line at a time, so
+that memory use doesn't depend on the size of the file.
+"""
+import gzip
+import json
+import logging
+
+from .archive import change_from_json
+
+# number of changes read at a time
+DEFAULT_BATCH_SIZE = 500
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_changes(path, status="MERGED", batch_size=DEFAULT_BATCH_SIZE):
+    """Read changes from gerrit query output in given file, batch_size at a
+    time
+
+    Query stats, lines that aren't valid JSON changes, and changes without
+    given status are skipped, invalid lines being logged.
+
+    :arg str path: file of gerrit query JSON output, gzip compressed if its
+        name ends with .gz
+    :arg str status: only read changes with given gerrit status, e.g.
+        "MERGED", all changes if None
+    :arg int batch_size: maximum number of changes in each batch
+    :Yields: lists of pygerrit.models.Change objects
+    :Raises: OSError if the file can't be read
+    """
+    batch = []
+    with _open(path) as dump_file:
+        for line_number, line in enumerate(dump_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and data.get('type') == "stats":
+                continue
+            if not isinstance(data, dict) or 'id' not in data:
+                logging.warning("Ignoring invalid change on line %d of %s: %s",
+                                line_number, path, line[:200])
+                continue
+            if status and data.get('status') != status:
+                continue
+            batch.append(change_from_json(data))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
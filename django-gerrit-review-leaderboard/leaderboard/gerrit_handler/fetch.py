@@ -7,77 +7,190 @@ from datetime import datetime, timedelta
 import logging
 import sys
 
-from pygerrit.client import GerritClient
 from pygerrit.error import GerritError
 
+from . import archive
+from . import connection
+
 # the maximum number of changes to fetch at a time. 500 seems to be the limit
 # for the maximum number of changes that can be fetched at a time via gerrit's
 # SSH API
 MAX_CHANGES_FETCH_COUNT = 500
+# maximum number of change numbers in a single query for changes by number
+MAX_CHANGE_NUMBERS_PER_QUERY = 100
+# gerrit query time format with second precision, in UTC
+GERRIT_QUERY_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S +0000"
 
 
-def _fetch(hostname, username, port, gerrit_query):
+def _fetch(hostname, username, port, gerrit_query, raise_errors=False):
     """ Fetch changes from gerrit by executing given query
 
-    Connects to gerrit at given hostname with given username via SSH and uses
-    given gerrit query to fetch changes
+    Connects to gerrit at given hostname with given username via SSH, reusing
+    any existing connection, and uses given gerrit query to fetch changes.
+    Changes fetched are archived, if an archive directory is set.
 
     :arg str hostname: gerrit server hostname
     :arg str username: gerrit username
     :arg int port: port for gerrit service
     :arg str gerrit_query: gerrit query to be executed via SSH
+    :arg bool raise_errors: whether to raise gerrit and connection errors
+        instead of returning an empty list
 
     :Return: List of Change objects if any, empty list on error
+    :Raises: GerritError, OSError, EOFError, or ValueError if raise_errors is
+        True
     """
-    try:
-        logging.info("Connecting to %s@%s:%d", username, hostname, port)
-        gerrit_client = GerritClient(host=hostname,
-                                     username=username,
-                                     port=port)
-        logging.info("Connected to Gerrit version [%s]",
-                     gerrit_client.gerrit_version())
-    except GerritError as err:
-        logging.error("Gerrit error: %s", err)
-        return []
-
     logging.info("Fetching changes with %s", gerrit_query)
     changes = []
     try:
-        changes = gerrit_client.query(gerrit_query)
+        changes = connection.pool.query(hostname, username, port,
+                                        gerrit_query)
+    except (GerritError, OSError, EOFError) as err:
+        logging.error("Gerrit error: %s", err)
+        if raise_errors:
+            raise
+        return []
     except ValueError as value_error:
         # should not happen as query above should have no errors
         logging.error("Query %s failed: %s!", gerrit_query, value_error)
+        if raise_errors:
+            raise
 
     logging.info("Number of changes fetched: %d", len(changes))
+    archive.pages.write(gerrit_query, changes)
     return changes
 
 
-def fetch_open_changes(hostname, username, port=29418):
-    """ Fetch all open changes from gerrit
+def _updated_changes_query(status, after_datetime_utc=None, skip=None,
+                           before_datetime_utc=None):
+    """Return query for a page of changes with given status, newest first
+
+    :arg str status: gerrit change status, e.g. "open" or "closed"
+    :arg datetime.datetime after_datetime_utc: time in UTC, changes should
+        have been last updated after time specified, if any
+    :arg int skip: count of changes to skip starting from newest, that were
+        last updated at before_datetime_utc if specified
+    :arg datetime.datetime before_datetime_utc: time in UTC, changes should
+        have been last updated at or before time specified, if any
+    :Return: gerrit query
+    """
+    fetch_query = "status:%s limit:%d" % (status, MAX_CHANGES_FETCH_COUNT)
+    if after_datetime_utc:
+        fetch_query += ' after:"%s"' % after_datetime_utc.strftime(
+            GERRIT_QUERY_DATETIME_FORMAT)
+    if before_datetime_utc:
+        fetch_query += ' before:"%s"' % before_datetime_utc.strftime(
+            GERRIT_QUERY_DATETIME_FORMAT)
+    if skip:
+        fetch_query += " -S %d" % skip
+    return fetch_query
+
+
+def fetch_open_changes(hostname, username, port=29418, raise_errors=False,
+                       after_datetime_utc=None, skip=None,
+                       before_datetime_utc=None):
+    """ Fetch open changes from gerrit
 
     Connects to gerrit at given hostname with given username via SSH and uses
-    gerrit query to fetch all open changes
+    gerrit query to fetch open changes, limited to 500 changes, newest first.
+    before_datetime_utc and skip, as returned by next_page_cursor() for the
+    changes fetched, can be used to fetch the next 500 changes.
+
+    :arg str hostname: gerrit server hostname
+    :arg str username: gerrit username
+    :arg int port: port for gerrit service
+    :arg bool raise_errors: whether to raise gerrit and connection errors
+        instead of returning an empty list
+    :arg datetime.datetime after_datetime_utc: time in UTC, only changes last
+        updated after time specified are fetched if specified
+    :arg int skip: count of changes to skip starting from newest, that were
+        last updated at before_datetime_utc if specified
+    :arg datetime.datetime before_datetime_utc: time in UTC, changes fetched
+        should have been last updated at or before time specified
+
+    :Return: List of Change objects if any, empty list otherwise
+    """
+    fetch_query = _updated_changes_query("open", after_datetime_utc, skip,
+                                         before_datetime_utc)
+    return _fetch(hostname, username, port, fetch_query, raise_errors)
+
+
+def fetch_closed_changes(hostname, username, port=29418, raise_errors=False,
+                         after_datetime_utc=None, skip=None,
+                         before_datetime_utc=None):
+    """ Fetch merged and abandoned changes from gerrit
+
+    Same as fetch_open_changes(), but for changes that are closed.
+
+    :Return: List of Change objects if any, empty list otherwise
+    """
+    fetch_query = _updated_changes_query("closed", after_datetime_utc, skip,
+                                         before_datetime_utc)
+    return _fetch(hostname, username, port, fetch_query, raise_errors)
+
+
+def fetch_changes(hostname, username, numbers, status, port=29418,
+                  raise_errors=False):
+    """Fetch changes with given numbers and status from gerrit
+
+    Changes are fetched with a query per MAX_CHANGE_NUMBERS_PER_QUERY
+    numbers.
 
     :arg str hostname: gerrit server hostname
     :arg str username: gerrit username
+    :arg iterable numbers: gerrit change numbers
+    :arg str status: gerrit change status, e.g. "merged" or "open", changes
+        that no longer have this status aren't fetched
     :arg int port: port for gerrit service
+    :arg bool raise_errors: whether to raise gerrit and connection errors
+        instead of leaving out changes that couldn't be fetched
 
     :Return: List of Change objects if any, empty list otherwise
     """
-    fetch_query = "status:open"
-    return _fetch(hostname, username, port, fetch_query)
+    numbers = sorted(numbers)
+    changes = []
+    for index in range(0, len(numbers), MAX_CHANGE_NUMBERS_PER_QUERY):
+        fetch_query = "status:%s (%s)" % (status, " OR ".join(
+            "change:%d" % number for number in
+            numbers[index:index + MAX_CHANGE_NUMBERS_PER_QUERY]))
+        changes.extend(_fetch(hostname, username, port, fetch_query,
+                              raise_errors))
+    return changes
+
+
+def fetch_projects(hostname, username, port=29418):
+    """Fetch names of all projects on gerrit server
+
+    :arg str hostname: gerrit server hostname
+    :arg str username: gerrit username
+    :arg int port: port for gerrit service
+
+    :Return: List of project names if any, empty list on error
+    """
+    logging.info("Fetching projects from %s", hostname)
+    try:
+        output = connection.pool.run_command(hostname, username, port,
+                                             "ls-projects")
+    except (GerritError, OSError, EOFError) as err:
+        logging.error("Gerrit error: %s", err)
+        return []
+    projects = [line.strip() for line in output.splitlines() if line.strip()]
+    logging.info("Number of projects fetched: %d", len(projects))
+    return projects
 
 
 def fetch_merged_changes(hostname, username, datetime_utc, port=29418,
-                         skip=None):
+                         skip=None, before_datetime_utc=None, project=None,
+                         raise_errors=False):
     """Fetch merged changes from gerrit after timestamp.
 
     Connects to gerrit at given hostname with given username via SSH and uses
     gerrit query to fetch all changes merged after given datetime, limited to
-    500 changes. If query result has more than 500 changes, skip parameter
-    can be used to specify count of already fetched changes (newest) to
-    skip. Expects given username's public key on current system to have been
-    installed on host with given hostname.
+    500 changes, newest first. If query result has more than 500 changes,
+    before_datetime_utc and skip, as returned by next_page_cursor() for the
+    changes fetched, can be used to fetch the next 500 changes. Expects given
+    username's public key on current system to have been installed on host
+    with given hostname.
 
     :arg str hostname: gerrit server hostname
     :arg str username: gerrit username
@@ -85,7 +198,16 @@ def fetch_merged_changes(hostname, username, datetime_utc, port=29418,
          in UTC, changes fetched should have been merged after time
          specified
     :arg int port: port for gerrit service
-    :arg int skip: count of changes to skip starting from newest
+    :arg int skip: count of changes to skip starting from newest, that were
+        last updated at before_datetime_utc if specified
+    :arg datetime.datetime before_datetime_utc: datetime obj specifying time
+         in UTC, changes fetched should have been last updated at or before
+         time specified
+    :arg str project: name of project to fetch changes for, changes for all
+        projects are fetched if not specified
+    :arg bool raise_errors: whether to raise gerrit and connection errors
+        instead of returning an empty list, so that a failed fetch isn't
+        mistaken for there being no more changes
 
     :Return: List of Change objects if any, empty list otherwise
     """
@@ -94,19 +216,61 @@ def fetch_merged_changes(hostname, username, datetime_utc, port=29418,
     #
     #     2006-01-02[ 15:04:05[.890][ -0700]]
     #
-    # NOTE: specifying anything other than the date results in the query
-    # failing to return any changes even though they exist. So this won't work:
-    # gerrit_query_time_format = "%Y-%m-%d %H:%M:%S".
+    # NOTE: times with anything other than the date have to be quoted,
+    # otherwise the query fails to return any changes even though they
+    # exist. So this won't work:
+    #
+    #     after:2006-01-02 15:04:05
+    #
+    # Day granularity is enough for 'after' as already stored changes are
+    # skipped, 'before' uses seconds to page through changes.
     gerrit_query_time_format = "%Y-%m-%d"
     # since we can't specify timezone, the query date is in UTC
     time_utc_str = datetime_utc.strftime(gerrit_query_time_format)
     fetch_query = "status:merged after:%s limit:%d" % (
         time_utc_str, MAX_CHANGES_FETCH_COUNT)
 
+    if project:
+        fetch_query = 'project:"%s" %s' % (project, fetch_query)
+
+    if before_datetime_utc:
+        fetch_query += ' before:"%s"' % before_datetime_utc.strftime(
+            GERRIT_QUERY_DATETIME_FORMAT)
+
     if skip:
         fetch_query += " -S %d" % skip
 
-    return _fetch(hostname, username, port, fetch_query)
+    return _fetch(hostname, username, port, fetch_query, raise_errors)
+
+
+def next_page_cursor(gerrit_changes, before_datetime_utc=None, skip=0):
+    """Return cursor for fetching the page of changes after given changes
+
+    Changes are fetched newest first, so the next page consists of changes
+    last updated at or before the oldest change fetched. Changes last updated
+    at the same time as the oldest change and already fetched are skipped.
+    Unlike skipping all changes already fetched, this keeps the cost of
+    fetching a page the same no matter how many pages were fetched before it.
+
+    :arg list gerrit_changes: non empty list of pygerrit.models.Change
+        objects fetched with before_datetime_utc and skip
+    :arg datetime.datetime before_datetime_utc: 'before' time in UTC that
+        changes were fetched with, if any
+    :arg int skip: count of changes skipped when fetching changes
+    :Return: tuple of 'before' time in UTC and count of changes to skip for
+        fetching the next page of changes
+    """
+    oldest_timestamp = min(int(float(gerrit_change.last_update_timestamp))
+                           for gerrit_change in gerrit_changes)
+    next_before_datetime_utc = datetime.utcfromtimestamp(oldest_timestamp)
+    next_skip = len([gerrit_change for gerrit_change in gerrit_changes
+                     if int(float(gerrit_change.last_update_timestamp)) ==
+                     oldest_timestamp])
+    if next_before_datetime_utc == before_datetime_utc:
+        # all changes fetched were updated at the same time, skip these along
+        # with the ones skipped to fetch them
+        next_skip += skip or 0
+    return next_before_datetime_utc, next_skip
 
 
 def _main():
@@ -0,0 +1,85 @@
+"""Management command that pulls a range of history from gerrit, in windows
+of days pulled in parallel, so that the database can be seeded quickly and
+an interrupted backfill can be continued
+"""
+import argparse
+from datetime import datetime, timedelta
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...config_handler.config import GerritFetchConfig
+from ...sync import fetcher
+
+# default number of days of changes pulled with each query window
+DEFAULT_SLICE_DAYS = 7
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Invalid date %s, expected YYYY-MM-DD" % value)
+
+
+class Command(BaseCommand):
+    help = ("Pulls changes last updated between two dates from the gerrit "
+            "server configured in fetcher.cfg, a window of days at a time, "
+            "and stores them in the database. Running it again with the same "
+            "arguments continues an interrupted backfill.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', type=_parse_date, required=True,
+            help="First day to pull changes for, as YYYY-MM-DD in UTC")
+        parser.add_argument(
+            '--until', type=_parse_date, default=None,
+            help="Last day to pull changes for, as YYYY-MM-DD in UTC. "
+                 "Defaults to today")
+        parser.add_argument(
+            '--slice-days', type=int, default=DEFAULT_SLICE_DAYS,
+            help="Number of days of changes pulled with each query window")
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help="Number of windows pulled at a time. Defaults to "
+                 "fetchconcurrency in fetcher.cfg")
+
+    def handle(self, *args, **options):
+        since = options['since']
+        until = (options['until'] or datetime.utcnow().date()) + \
+            timedelta(days=1)
+        if since >= until:
+            raise CommandError("--since must not be after --until")
+        if options['slice_days'] < 1:
+            raise CommandError("--slice-days must be at least 1")
+        workers = options['workers'] or GerritFetchConfig().fetch_concurrency()
+        progress = {'windows': 0, 'changes': 0}
+        start = time.time()
+
+        def report(window_state, window_count):
+            progress['windows'] += 1
+            progress['changes'] += window_state.change_count
+            elapsed = time.time() - start
+            eta = elapsed / progress['windows'] * (
+                window_count - progress['windows'])
+            self.stdout.write(
+                "%s: %d changes. %d/%d windows, %d changes, %.1f "
+                "changes/second, ETA %s" % (
+                    window_state.query_type, window_state.change_count,
+                    progress['windows'], window_count, progress['changes'],
+                    progress['changes'] / elapsed,
+                    timedelta(seconds=int(eta))))
+
+        try:
+            change_count, stored_count = fetcher.backfill_changes(
+                since, until, options['slice_days'], workers, report)
+        except Exception as err:
+            raise CommandError(
+                "Backfill failed after %d windows: %s. Run again to "
+                "continue." % (progress['windows'], err))
+        elapsed = time.time() - start
+        self.stdout.write(
+            "Backfilled %d changes in %d windows in %.1f seconds, %d windows "
+            "already backfilled" % (change_count, progress['windows'],
+                                    elapsed, stored_count))
@@ -0,0 +1,98 @@
+"""Management command that measures how fast fetched gerrit changes are stored
+in the database, using generated changes so that no gerrit server is needed
+"""
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pygerrit.models import Account
+from pygerrit.models import Change as GerritChange
+from pygerrit.models import Comment as GerritComment
+
+from ...gerrit_handler.fetch import MAX_CHANGES_FETCH_COUNT
+from ...sync import database_helper
+from ...sync.reviewer_cache import ReviewerCache
+
+
+class _Rollback(Exception):
+    """Raised to roll back benchmark writes"""
+
+
+def _make_account(name):
+    account = Account([])
+    account.name = name
+    return account
+
+
+def _make_gerrit_changes(change_count, comment_count, reviewer_count):
+    """Make gerrit changes, as they would be fetched, for benchmarking
+
+    :arg int change_count: number of changes to make
+    :arg int comment_count: number of comments per change
+    :arg int reviewer_count: number of distinct reviewers commenting
+    :Return: list of pygerrit.models.Change objects
+    """
+    now = time.time()
+    reviewer_names = ["Reviewer %d" % index for index in range(reviewer_count)]
+    gerrit_changes = []
+    for index in range(change_count):
+        gerrit_change = GerritChange([])
+        gerrit_change.last_update_timestamp = str(now - index * 60)
+        gerrit_change.owner = _make_account("Owner %d" % (index % 50))
+        gerrit_change.subject = "Benchmark change %d" % index
+        gerrit_change.project = "project-%d" % (index % 20)
+        gerrit_change.change_id = "I%040x" % index
+        gerrit_change.comments = []
+        for comment_index in range(comment_count):
+            gerrit_comment = GerritComment([])
+            gerrit_comment.timestamp = str(now - index * 60 + comment_index)
+            gerrit_comment.reviewer = _make_account(
+                random.choice(reviewer_names))
+            gerrit_comment.message = "Patch Set 1:\n\nComment %d" % (
+                comment_index)
+            gerrit_change.comments.append(gerrit_comment)
+        gerrit_changes.append(gerrit_change)
+    return gerrit_changes
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks storing fetched gerrit changes in the database and "
+            "prints changes stored per second. Writes are rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--changes', type=int, default=5000,
+                            help="Number of changes to store")
+        parser.add_argument('--comments', type=int, default=10,
+                            help="Number of comments per change")
+        parser.add_argument('--reviewers', type=int, default=300,
+                            help="Number of distinct reviewers")
+        parser.add_argument('--page-size', type=int,
+                            default=MAX_CHANGES_FETCH_COUNT,
+                            help="Number of changes stored at a time")
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        gerrit_changes = _make_gerrit_changes(
+            options['changes'], options['comments'], options['reviewers'])
+        page_size = options['page_size']
+        start = time.time()
+        # reviewers are cached across pages as they are for a sync
+        reviewer_cache = ReviewerCache()
+        reviewer_cache.warm()
+        try:
+            with transaction.atomic():
+                for index in range(0, len(gerrit_changes), page_size):
+                    database_helper.update(
+                        gerrit_changes[index:index + page_size],
+                        reviewer_cache)
+                elapsed = time.time() - start
+                raise _Rollback()
+        except _Rollback:
+            pass
+        self.stdout.write(
+            "Stored %d changes with %d comments each in %.2f seconds: "
+            "%.1f changes/second" % (
+                len(gerrit_changes), options['comments'], elapsed,
+                len(gerrit_changes) / elapsed))
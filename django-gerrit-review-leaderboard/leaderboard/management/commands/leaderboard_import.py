@@ -0,0 +1,56 @@
+"""Management command that stores merged changes from files of gerrit query
+output captured elsewhere, e.g. to seed a new instance or recover one, without
+connecting to gerrit
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...sync import fetcher
+
+# default maximum number of files read at a time
+DEFAULT_WORKERS = 4
+# number of changes stored between progress reports
+REPORT_INTERVAL = 10000
+
+
+class Command(BaseCommand):
+    help = ("Stores merged changes from files of "
+            "`gerrit query --format=JSON --comments status:merged ...` "
+            "output, gzip compressed if their names end with .gz. Changes "
+            "already stored are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files', nargs='+', metavar='file',
+            help="File of gerrit query JSON output")
+        parser.add_argument(
+            '--workers', type=int, default=DEFAULT_WORKERS,
+            help="Maximum number of files read at a time. Defaults to %d" %
+                 DEFAULT_WORKERS)
+
+    def handle(self, *args, **options):
+        start = time.time()
+        reported = [0]
+
+        def report(change_count, comment_count):
+            if change_count - reported[0] >= REPORT_INTERVAL:
+                reported[0] = change_count
+                elapsed = time.time() - start
+                self.stdout.write(
+                    "%d changes, %d comments, %.1f rows/second" % (
+                        change_count, comment_count,
+                        (change_count + comment_count) / elapsed))
+
+        try:
+            change_count, comment_count = fetcher.import_dumps(
+                options['files'], report, max(1, options['workers']))
+        except OSError as err:
+            raise CommandError("Unable to read gerrit query output: %s" % err)
+        # at least a millisecond, for imports of nothing
+        elapsed = max(time.time() - start, 0.001)
+        self.stdout.write(
+            "Imported %d changes with %d comments from %d files in %.1f "
+            "seconds, %.1f rows/second" % (
+                change_count, comment_count, len(options['files']), elapsed,
+                (change_count + comment_count) / elapsed))
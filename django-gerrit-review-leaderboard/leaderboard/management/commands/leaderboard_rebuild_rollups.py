@@ -0,0 +1,21 @@
+"""Management command that recounts reviewers' daily stats, which leaderboards
+are read from, from the changes and comments stored
+"""
+from django.core.management.base import BaseCommand
+
+from ...models import SyncState
+from ...sync import database_helper
+from ...sync import lease
+
+
+class Command(BaseCommand):
+    help = ("Recounts the changes reviewed and comments posted by each "
+            "reviewer per project per day from the changes stored, to repair "
+            "the daily stats leaderboards are read from. Waits for a sync "
+            "running meanwhile to finish.")
+
+    def handle(self, *args, **options):
+        # changes stored by a sync while recounting would not be counted
+        with lease.hold_when_free(SyncState.QUERY_MERGED):
+            stats_count = database_helper.rebuild_daily_stats()
+        self.stdout.write("Rebuilt %d daily stats" % stats_count)
@@ -0,0 +1,55 @@
+"""Management command that stores changes again from the pages of changes
+archived as they were fetched, e.g. after changing which comments are
+counted, without fetching them from gerrit again
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...config_handler.config import GerritFetchConfig
+from ...sync import fetcher
+
+# number of pages stored between progress reports
+REPORT_INTERVAL = 100
+
+
+class Command(BaseCommand):
+    help = ("Removes the changes, comments, and reviewers stored, and stores "
+            "them again from the pages of merged changes archived in "
+            "archivedir in fetcher.cfg. Only changes fetched while pages "
+            "were archived are stored, so it refuses to run if changes "
+            "stored are older than the oldest change archived.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--archive-dir', default=None,
+            help="Directory pages were archived in. Defaults to archivedir "
+                 "in fetcher.cfg")
+
+    def handle(self, *args, **options):
+        archive_dir = options['archive_dir'] or \
+            GerritFetchConfig().archive_dir()
+        if not archive_dir:
+            raise CommandError("No archive to reprocess, set archivedir in "
+                               "fetcher.cfg or use --archive-dir")
+        start = time.time()
+
+        def report(page_count, change_count):
+            if page_count % REPORT_INTERVAL == 0:
+                self.stdout.write(
+                    "%d pages, %d changes, %.1f changes/second" % (
+                        page_count, change_count,
+                        change_count / (time.time() - start)))
+
+        try:
+            page_count, change_count = fetcher.reprocess_archive(archive_dir,
+                                                                 report)
+        except OSError as err:
+            raise CommandError("Unable to read archive in %s: %s" %
+                               (archive_dir, err))
+        except ValueError as err:
+            raise CommandError("Unable to reprocess archive in %s: %s" %
+                               (archive_dir, err))
+        self.stdout.write(
+            "Stored %d changes from %d archived pages in %.1f seconds" % (
+                change_count, page_count, time.time() - start))
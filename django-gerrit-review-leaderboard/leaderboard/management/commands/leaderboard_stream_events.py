@@ -0,0 +1,36 @@
+"""Management command that applies events from gerrit's event stream to the
+changes stored as they happen, so that leaderboards don't wait for the next
+sync
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from ...config_handler.config import GerritFetchConfig
+from ...sync import events
+
+
+class Command(BaseCommand):
+    help = ("Streams events from the gerrit server configured in fetcher.cfg "
+            "and applies them to the changes stored as they happen")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window', type=float, default=events.BATCH_WINDOW,
+            help="Seconds to collect events for before applying them "
+                 "together")
+        parser.add_argument(
+            '--replay', metavar='FILE',
+            help="Apply events recorded from gerrit stream-events in FILE, "
+                 "one JSON event per line, instead of streaming events")
+
+    def handle(self, *args, **options):
+        if options['replay']:
+            with open(options['replay']) as event_file:
+                event_count = events.consume(
+                    events.read_events(event_file), GerritFetchConfig(),
+                    window=options['window'])
+            self.stdout.write("Applied %d events" % event_count)
+            return
+
+        if not events.run(options['window']):
+            raise CommandError("Events are already being streamed by another "
+                               "process")
@@ -0,0 +1,50 @@
+"""Management command that keeps the database in sync with gerrit by pulling
+changes in the background, so that page loads only read from the database
+"""
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from ...config_handler.config import GerritFetchConfig
+from ...sync import fetcher
+
+
+class Command(BaseCommand):
+    help = ("Periodically pulls changes from the gerrit server configured in "
+            "fetcher.cfg and stores them in the database")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=None,
+            help="Seconds to wait between syncs. Defaults to syncinterval "
+                 "in fetcher.cfg")
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Sync once and exit instead of running as a daemon")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            try:
+                change_count = fetcher.pull_and_store_changes()
+            except Exception as err:
+                raise CommandError("Sync failed: %s" % err)
+            if change_count is None:
+                self.stdout.write("Changes are already being synced")
+            else:
+                self.stdout.write("Synced %d changes" % change_count)
+            return
+
+        interval = options['interval'] or GerritFetchConfig().sync_interval()
+        logging.info("Syncing changes every %d seconds", interval)
+        while True:
+            try:
+                fetcher.pull_and_store_changes()
+            except Exception:
+                # already recorded in the sync state, keep the daemon going
+                logging.exception("Sync failed, retrying in %d seconds",
+                                  interval)
+            # don't hold on to database connections while sleeping
+            close_old_connections()
+            time.sleep(interval)
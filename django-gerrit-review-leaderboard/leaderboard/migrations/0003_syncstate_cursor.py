@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0002_syncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='query_type',
+            field=models.CharField(max_length=255, default='merged'),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='watermark',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='fetch_after',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='syncstate',
+            name='fetch_skip',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='syncstate',
+            name='hostname',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AlterUniqueTogether(
+            name='syncstate',
+            unique_together=set([('hostname', 'query_type')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0003_syncstate_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='fetch_before',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
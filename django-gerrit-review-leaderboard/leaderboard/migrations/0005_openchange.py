@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0004_syncstate_fetch_before'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpenChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('number', models.IntegerField(unique=True)),
+                ('project_name', models.CharField(max_length=50)),
+                ('timestamp', models.DateTimeField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='OpenChangeReviewer',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('reviewer_name', models.CharField(max_length=70)),
+                ('change', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='leaderboard.OpenChange')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='openchangereviewer',
+            unique_together=set([('change', 'reviewer_name')]),
+        ),
+        migrations.CreateModel(
+            name='OpenReviewerLoad',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('project_name', models.CharField(max_length=50)),
+                ('reviewer_name', models.CharField(max_length=70)),
+                ('open_count', models.IntegerField(default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='openreviewerload',
+            unique_together=set([('project_name', 'reviewer_name')]),
+        ),
+    ]
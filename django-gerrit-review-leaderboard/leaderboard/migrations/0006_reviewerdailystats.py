@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def build_daily_stats(apps, schema_editor):
+    """Count changes and comments already stored, the same way as
+    leaderboard.sync.database_helper.rebuild_daily_stats() as of this
+    migration
+    """
+    Reviewer = apps.get_model('leaderboard', 'Reviewer')
+    ReviewerDailyStats = apps.get_model('leaderboard', 'ReviewerDailyStats')
+    daily_counts = {}
+    for index, (through, timestamp_field, project_field) in enumerate([
+            (Reviewer.changes.through, 'change__timestamp',
+             'change__project_name'),
+            (Reviewer.comments.through, 'comment__timestamp',
+             'comment__change__project_name')]):
+        for reviewer_id, project_name, day, count in \
+                through.objects.annotate(day=TruncDate(timestamp_field)).\
+                values('reviewer_id', project_field, 'day').annotate(
+                    count=Count('id')).order_by().values_list(
+                        'reviewer_id', project_field, 'day', 'count'):
+            daily_counts.setdefault((reviewer_id, project_name, day),
+                                    [0, 0])[index] = count
+    ReviewerDailyStats.objects.bulk_create([
+        ReviewerDailyStats(reviewer_id=reviewer_id, project_name=project_name,
+                           day=day, review_count=review_count,
+                           comment_count=comment_count)
+        for (reviewer_id, project_name, day), (review_count, comment_count)
+        in daily_counts.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0005_openchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReviewerDailyStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('project_name', models.CharField(max_length=50)),
+                ('day', models.DateField()),
+                ('review_count', models.IntegerField(default=0)),
+                ('comment_count', models.IntegerField(default=0)),
+                ('reviewer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='leaderboard.Reviewer')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='reviewerdailystats',
+            unique_together=set([('reviewer', 'project_name', 'day')]),
+        ),
+        migrations.RunPython(build_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def merge_duplicate_reviewers(apps, schema_editor):
+    """Merge reviewers with the same name, once surrounding and repeated
+    whitespace is removed as reviewer names are now normalized, into the
+    first one created, so that reviewer names can be unique
+    """
+    Reviewer = apps.get_model('leaderboard', 'Reviewer')
+    ReviewerDailyStats = apps.get_model('leaderboard', 'ReviewerDailyStats')
+    # IDs of reviewers by normalized name, as normalize_reviewer_name() would
+    # return at the time of writing
+    reviewer_ids = {}
+    unnormalized_names = set()
+    for reviewer_id, full_name in Reviewer.objects.order_by(
+            'id').values_list('id', 'full_name'):
+        normalized_name = " ".join(full_name.split())
+        reviewer_ids.setdefault(normalized_name, []).append(reviewer_id)
+        if normalized_name != full_name:
+            unnormalized_names.add(normalized_name)
+    for full_name, ids in reviewer_ids.items():
+        if len(ids) == 1 and full_name not in unnormalized_names:
+            continue
+        reviewers = list(Reviewer.objects.filter(id__in=ids).order_by('id'))
+        reviewer = reviewers[0]
+        for duplicate in reviewers[1:]:
+            reviewer.changes.add(*duplicate.changes.all())
+            reviewer.comments.add(*duplicate.comments.all())
+            duplicate.delete()
+        if reviewer.full_name != full_name:
+            reviewer.full_name = full_name
+            reviewer.save()
+        if len(reviewers) == 1:
+            continue
+        # count daily stats again, as changes reviewed by more than one of the
+        # duplicates are now only counted once
+        daily_counts = {}
+        for project_name, timestamp in reviewer.changes.values_list(
+                'project_name', 'timestamp'):
+            daily_counts.setdefault((project_name, timestamp.date()),
+                                    [0, 0])[0] += 1
+        for project_name, timestamp in reviewer.comments.values_list(
+                'change__project_name', 'timestamp'):
+            daily_counts.setdefault((project_name, timestamp.date()),
+                                    [0, 0])[1] += 1
+        ReviewerDailyStats.objects.filter(reviewer=reviewer).delete()
+        ReviewerDailyStats.objects.bulk_create([
+            ReviewerDailyStats(reviewer=reviewer, project_name=project_name,
+                               day=day, review_count=review_count,
+                               comment_count=comment_count)
+            for (project_name, day), (review_count, comment_count)
+            in daily_counts.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0007_datageneration'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_reviewers,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='reviewer',
+            name='full_name',
+            field=models.CharField(max_length=70, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['project_name', 'timestamp'], name='leaderboard_change_project'),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['timestamp'], name='leaderboard_change_timestamp'),
+        ),
+    ]
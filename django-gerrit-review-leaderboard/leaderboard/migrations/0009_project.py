@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+# number of rows copied with each insert
+BATCH_SIZE = 500
+
+
+def _bulk_create(model, objects):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+    model.objects.bulk_create(batch)
+
+
+def copy_to_integer_keys(apps, schema_editor):
+    """Create projects for project names stored, and copy changes to the new
+    table with integer keys, pointing comments, reviewers, and daily stats at
+    them
+    """
+    Project = apps.get_model('leaderboard', 'Project')
+    Change = apps.get_model('leaderboard', 'Change')
+    NewChange = apps.get_model('leaderboard', 'NewChange')
+    Comment = apps.get_model('leaderboard', 'Comment')
+    Reviewer = apps.get_model('leaderboard', 'Reviewer')
+    ReviewerDailyStats = apps.get_model('leaderboard', 'ReviewerDailyStats')
+
+    project_names = set(Change.objects.values_list(
+        'project_name', flat=True).distinct())
+    project_names.update(ReviewerDailyStats.objects.values_list(
+        'project_name', flat=True).distinct())
+    Project.objects.bulk_create(
+        [Project(name=name) for name in sorted(project_names)])
+    project_ids = dict(Project.objects.values_list('name', 'id'))
+
+    _bulk_create(NewChange, (
+        NewChange(timestamp=timestamp, owner_full_name=owner_full_name,
+                  subject=subject, project_id=project_ids[project_name],
+                  change_id=change_id)
+        for timestamp, owner_full_name, subject, project_name, change_id in
+        Change.objects.order_by('timestamp').values_list(
+            'timestamp', 'owner_full_name', 'subject', 'project_name',
+            'change_id').iterator()))
+    Comment.objects.update(new_change=Subquery(NewChange.objects.filter(
+        change_id=OuterRef('change_id')).values('id')[:1]))
+    new_change_ids = dict(NewChange.objects.values_list('change_id', 'id'))
+    ReviewerNewChange = Reviewer.new_changes.through
+    _bulk_create(ReviewerNewChange, (
+        ReviewerNewChange(reviewer_id=reviewer_id,
+                          newchange_id=new_change_ids[change_id])
+        for reviewer_id, change_id in
+        Reviewer.changes.through.objects.values_list(
+            'reviewer_id', 'change_id').iterator()))
+    ReviewerDailyStats.objects.update(project=Subquery(Project.objects.filter(
+        name=OuterRef('project_name')).values('id')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0008_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Project',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=50, unique=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        # changes are copied to a new table, as their primary key changes
+        migrations.CreateModel(
+            name='NewChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('timestamp', models.DateTimeField()),
+                ('owner_full_name', models.CharField(max_length=70)),
+                ('subject', models.CharField(max_length=200)),
+                ('change_id', models.CharField(max_length=50, unique=True)),
+                ('project', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='leaderboard.Project')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='new_change',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='leaderboard.NewChange'),
+        ),
+        migrations.AddField(
+            model_name='reviewer',
+            name='new_changes',
+            field=models.ManyToManyField(to='leaderboard.NewChange'),
+        ),
+        migrations.AddField(
+            model_name='reviewerdailystats',
+            name='project',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='leaderboard.Project'),
+        ),
+        migrations.RunPython(copy_to_integer_keys, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='reviewerdailystats',
+            unique_together=set([]),
+        ),
+        migrations.RemoveField(
+            model_name='reviewerdailystats',
+            name='project_name',
+        ),
+        migrations.RemoveField(
+            model_name='comment',
+            name='change',
+        ),
+        migrations.RemoveField(
+            model_name='reviewer',
+            name='changes',
+        ),
+        migrations.DeleteModel(
+            name='Change',
+        ),
+        migrations.RenameModel(
+            old_name='NewChange',
+            new_name='Change',
+        ),
+        migrations.RenameField(
+            model_name='comment',
+            old_name='new_change',
+            new_name='change',
+        ),
+        migrations.RenameField(
+            model_name='reviewer',
+            old_name='new_changes',
+            new_name='changes',
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='change',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='leaderboard.Change'),
+        ),
+        migrations.AlterField(
+            model_name='reviewerdailystats',
+            name='project',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='leaderboard.Project'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='reviewerdailystats',
+            unique_together=set([('reviewer', 'project', 'day')]),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['project', 'timestamp'], name='leaderboard_change_project'),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['timestamp'], name='leaderboard_change_timestamp'),
+        ),
+    ]
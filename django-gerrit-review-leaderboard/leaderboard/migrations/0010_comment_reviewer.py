@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def copy_comment_reviewers(apps, schema_editor):
+    """Point each comment at the reviewer linked to it, and remove comments
+    no reviewer is linked to, as they were never counted
+    """
+    Comment = apps.get_model('leaderboard', 'Comment')
+    Reviewer = apps.get_model('leaderboard', 'Reviewer')
+    Comment.objects.update(new_reviewer=Subquery(
+        Reviewer.comments.through.objects.filter(
+            comment_id=OuterRef('id')).order_by('reviewer_id').values(
+                'reviewer_id')[:1]))
+    Comment.objects.filter(new_reviewer__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0009_project'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='new_reviewer',
+            field=models.ForeignKey(null=True, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='leaderboard.Reviewer'),
+        ),
+        migrations.RunPython(copy_comment_reviewers,
+                             migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='reviewer',
+            name='comments',
+        ),
+        migrations.RenameField(
+            model_name='comment',
+            old_name='new_reviewer',
+            new_name='reviewer',
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='reviewer',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='comments', to='leaderboard.Reviewer'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['reviewer', 'timestamp'], name='leaderboard_comment_reviewer'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_comments(apps, schema_editor):
+    """Count comments already stored for each change"""
+    Change = apps.get_model('leaderboard', 'Change')
+    Comment = apps.get_model('leaderboard', 'Comment')
+    Change.objects.update(comment_count=Coalesce(Subquery(
+        Comment.objects.filter(change=OuterRef('pk')).order_by().values(
+            'change').annotate(count=Count('id')).values('count')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0011_synclease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_comments, migrations.RunPython.noop),
+    ]
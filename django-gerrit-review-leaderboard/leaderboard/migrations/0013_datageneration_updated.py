@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0012_change_comment_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datageneration',
+            name='updated',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -4,6 +4,17 @@ from __future__ import unicode_literals
 from django.db import models
 
 
+class Project(models.Model):
+    """A gerrit project, which changes and reviewers' daily stats refer to by
+    its integer key rather than its name
+    """
+    # Gerrit project name
+    name = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return u"<Project %s>" % (self.name)
+
+
 class Change(models.Model):
     """A gerrit change for a project which can have multiple Comments
     and Reviewers
@@ -14,10 +25,25 @@ class Change(models.Model):
     owner_full_name = models.CharField(max_length=70)
     # Gerrit change's subject, this is the commit summary message
     subject = models.CharField(max_length=200)
-    # Gerrit project name
-    project_name = models.CharField(max_length=50)
-    # Gerrit change ID hash
-    change_id = models.CharField(max_length=50, primary_key=True)
+    # Gerrit project, indexed along with timestamp below
+    project = models.ForeignKey(Project, on_delete=models.CASCADE,
+                                db_index=False)
+    # Gerrit change ID hash, changes are looked up by it as they are stored
+    change_id = models.CharField(max_length=50, unique=True)
+    # Count of comments stored, so that a change fetched again is only
+    # compared with the comments stored if it has more comments or was
+    # updated since
+    comment_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # changes of a project updated in a period of time
+            models.Index(fields=['project', 'timestamp'],
+                         name='leaderboard_change_project'),
+            # latest change stored, and changes updated in a period of time
+            models.Index(fields=['timestamp'],
+                         name='leaderboard_change_timestamp'),
+        ]
 
     def __str__(self):
         return u"<Change %s %s %s %s>" % (
@@ -35,17 +61,198 @@ class Comment(models.Model):
     message = models.CharField(max_length=2000)
     # Each Comment is associated with a single Change
     change = models.ForeignKey(Change, on_delete=models.CASCADE)
+    # Reviewer who posted the comment, indexed along with timestamp below
+    reviewer = models.ForeignKey('Reviewer', on_delete=models.CASCADE,
+                                 related_name='comments', db_index=False)
+
+    class Meta:
+        indexes = [
+            # comments of a reviewer posted in a period of time
+            models.Index(fields=['reviewer', 'timestamp'],
+                         name='leaderboard_comment_reviewer'),
+        ]
 
     def __str__(self):
         return u"<Comment %s %s>" % (self.message[:50], self.timestamp)
 
 
 class Reviewer(models.Model):
-    full_name = models.CharField(max_length=70)
+    # Normalized name, reviewers are looked up by name as changes are stored
+    full_name = models.CharField(max_length=70, unique=True)
     # A reviewer may review many changes
     changes = models.ManyToManyField(Change)
-    # A reviewer may have many comments
-    comments = models.ManyToManyField(Comment)
 
     def __str__(self):
         return u"<Reviewer %s>" % (self.full_name)
+
+
+class ReviewerDailyStats(models.Model):
+    """Count of changes a reviewer reviewed and comments they posted in a
+    project on a day, maintained as changes are stored so that leaderboards
+    don't need to count changes and comments
+    """
+    # Reviewer the counts are for
+    reviewer = models.ForeignKey(Reviewer, on_delete=models.CASCADE)
+    # Gerrit project
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    # Day in UTC, changes are counted on the day they were last updated and
+    # comments on the day they were posted
+    day = models.DateField()
+    # Count of changes reviewed
+    review_count = models.IntegerField(default=0)
+    # Count of comments posted
+    comment_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('reviewer', 'project', 'day')
+
+    def __str__(self):
+        return u"<ReviewerDailyStats %s %s %s %d %d>" % (
+            self.reviewer_id, self.project_id, self.day, self.review_count,
+            self.comment_count)
+
+
+class SyncState(models.Model):
+    """State of syncing changes from a gerrit server into the database, for a
+    type of gerrit query. This is updated by the background sync so that
+    views only need to read from the database. Its cursor is committed with
+    each page of changes stored, so that an interrupted sync can be resumed.
+    """
+    # query for merged changes
+    QUERY_MERGED = "merged"
+    # query for merged changes of a project, used by a sharded sync
+    QUERY_MERGED_PROJECT = "merged project:%s"
+    # query for merged changes last updated in a window of days, used by a
+    # backfill
+    QUERY_BACKFILL = "backfill %s..%s"
+    # query for open changes, and closed changes to retire from them
+    QUERY_OPEN = "open"
+    # merged changes stored as gerrit's event stream reports them
+    QUERY_EVENTS = "stream-events"
+
+    STATUS_IDLE = "idle"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_IDLE, "Idle"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCEEDED, "Succeeded"),
+        (STATUS_FAILED, "Failed"),
+    )
+    # Gerrit server hostname changes are synced from
+    hostname = models.CharField(max_length=255)
+    # Type of gerrit query used to sync changes
+    query_type = models.CharField(max_length=255, default=QUERY_MERGED)
+    # Time in UTC the last sync was started
+    started = models.DateTimeField(null=True)
+    # Time in UTC the last sync finished, successfully or not
+    finished = models.DateTimeField(null=True)
+    # Status of the last sync
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=STATUS_IDLE)
+    # Count of changes fetched by the last sync
+    change_count = models.IntegerField(default=0)
+    # Error message if the last sync failed
+    message = models.CharField(max_length=2000, blank=True)
+    # Time in UTC of latest change stored by the last successful sync
+    watermark = models.DateTimeField(null=True)
+    # Time in UTC changes are being fetched after by a sync in progress or
+    # interrupted, None if the last sync completed
+    fetch_after = models.DateTimeField(null=True)
+    # Time in UTC of oldest change stored by a sync in progress or
+    # interrupted, changes are fetched newest first
+    fetch_before = models.DateTimeField(null=True)
+    # Count of changes updated at fetch_before and already stored by a sync
+    # in progress or interrupted
+    fetch_skip = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('hostname', 'query_type')
+
+    def __str__(self):
+        return u"<SyncState %s %s %s %s>" % (
+            self.hostname, self.query_type, self.status, self.finished)
+
+
+class SyncLease(models.Model):
+    """Lease held by the process running a type of sync, so that only one
+    such sync runs at a time across all processes. The holder renews it
+    while syncing, so a lease that isn't renewed, e.g. as its process died,
+    expires and can be taken over.
+    """
+    # Name of what the lease is held for, e.g. a SyncState query type
+    name = models.CharField(max_length=255, unique=True)
+    # Host, process, and thread holding the lease, blank once released
+    holder = models.CharField(max_length=255, blank=True)
+    # Time in UTC the lease expires unless renewed, None once released
+    expires = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return u"<SyncLease %s %s %s>" % (self.name, self.holder,
+                                          self.expires)
+
+
+class DataGeneration(models.Model):
+    """Counter bumped each time a sync commits changes, so that results
+    computed from the changes stored can be cached until it changes. There
+    is a single row, created by the first sync.
+    """
+    # Number of times changes stored have been committed
+    generation = models.IntegerField(default=0)
+    # Time in UTC changes stored were last committed, None if not recorded
+    # since the generation was last bumped
+    updated = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return u"<DataGeneration %d>" % self.generation
+
+
+class OpenChange(models.Model):
+    """A gerrit change that is open. Only changes updated since the last
+    refresh are fetched to keep these up to date.
+    """
+    # Gerrit change number
+    number = models.IntegerField(unique=True)
+    # Gerrit project name
+    project_name = models.CharField(max_length=50)
+    # Time in UTC change was last updated
+    timestamp = models.DateTimeField()
+
+    def __str__(self):
+        return u"<OpenChange %s %s %s>" % (
+            self.number, self.project_name, self.timestamp)
+
+
+class OpenChangeReviewer(models.Model):
+    """A reviewer of an open change"""
+    # Each reviewer is for a single open change
+    change = models.ForeignKey(OpenChange, on_delete=models.CASCADE)
+    # Reviewer name
+    reviewer_name = models.CharField(max_length=70)
+
+    class Meta:
+        unique_together = ('change', 'reviewer_name')
+
+    def __str__(self):
+        return u"<OpenChangeReviewer %s %s>" % (
+            self.change_id, self.reviewer_name)
+
+
+class OpenReviewerLoad(models.Model):
+    """Count of open changes a reviewer is reviewing in a project, adjusted
+    as open changes are added, updated, and retired
+    """
+    # Gerrit project name
+    project_name = models.CharField(max_length=50)
+    # Reviewer name
+    reviewer_name = models.CharField(max_length=70)
+    # Count of open changes in the project the reviewer is reviewing
+    open_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('project_name', 'reviewer_name')
+
+    def __str__(self):
+        return u"<OpenReviewerLoad %s %s %d>" % (
+            self.project_name, self.reviewer_name, self.open_count)
@@ -0,0 +1,140 @@
+"""In-memory index of cumulative review and comment counts per reviewer per
+day, so that leaderboards for any range of days are answered with two lookups
+per reviewer
+
+The index is built from reviewers' daily stats, and built again once the data
+generation has changed since it was built, i.e. a sync has committed changes.
+"""
+from bisect import bisect_left, bisect_right
+import logging
+import threading
+
+from .models import ReviewerDailyStats
+from .sync import database_helper
+
+# key of counts across all projects
+ALL_PROJECTS = None
+
+
+class _CumulativeCounts:
+    """Review and comment counts of a reviewer summed up to each day they
+    have counts for
+    """
+
+    def __init__(self):
+        # days with counts, in ascending order
+        self.days = []
+        # counts up to, not including, the day at the same index in days, with
+        # a last element for the counts up to and including the last day
+        self.review_counts = [0]
+        self.comment_counts = [0]
+
+    def add(self, day, review_count, comment_count):
+        """Add counts for a day, which must not be before days already added
+
+        :arg datetime.date day: day in UTC
+        :arg int review_count: count of changes reviewed on day
+        :arg int comment_count: count of comments posted on day
+        """
+        if not self.days or self.days[-1] != day:
+            self.days.append(day)
+            self.review_counts.append(self.review_counts[-1])
+            self.comment_counts.append(self.comment_counts[-1])
+        self.review_counts[-1] += review_count
+        self.comment_counts[-1] += comment_count
+
+    def get(self, from_day, to_day):
+        """Return counts between given days, inclusive
+
+        :arg datetime.date from_day: first day in UTC, None for no limit
+        :arg datetime.date to_day: last day in UTC, None for no limit
+        :Return: tuple of review count and comment count
+        """
+        start = bisect_left(self.days, from_day) if from_day else 0
+        end = bisect_right(self.days, to_day) if to_day else len(self.days)
+        if end <= start:
+            return 0, 0
+        return (self.review_counts[end] - self.review_counts[start],
+                self.comment_counts[end] - self.comment_counts[start])
+
+
+class RangeIndex:
+    """Cumulative counts per reviewer per day, for each project and across
+    all projects
+    """
+
+    def __init__(self, daily_stats):
+        """Build index from given daily stats
+
+        :arg iterable daily_stats: tuples of reviewer name, project name, day,
+            review count, and comment count, ordered by reviewer name and day
+        """
+        # dictionary of project names, and ALL_PROJECTS, to dictionaries of
+        # reviewer names to _CumulativeCounts
+        self._counts = {}
+        for reviewer_name, project_name, day, review_count, comment_count in \
+                daily_stats:
+            for key in (project_name, ALL_PROJECTS):
+                self._counts.setdefault(key, {}).setdefault(
+                    reviewer_name, _CumulativeCounts()).add(
+                        day, review_count, comment_count)
+
+    def get_reviewers_and_counts(self, project_name, from_day, to_day=None):
+        """Return reviewers with changes between given days, inclusive, with
+        their counts
+
+        :arg str project_name: project to count changes and comments in,
+            ALL_PROJECTS to count them in all projects
+        :arg datetime.date from_day: first day in UTC, None for no limit
+        :arg datetime.date to_day: last day in UTC, None for no limit
+        :Return: list of tuples of reviewer name, review count, and comment
+            count
+        """
+        reviewers = []
+        for reviewer_name, counts in self._counts.get(project_name,
+                                                      {}).items():
+            review_count, comment_count = counts.get(from_day, to_day)
+            if review_count:
+                reviewers.append((reviewer_name, review_count, comment_count))
+        return reviewers
+
+
+_index = None
+# data generation _index was built for
+_index_generation = None
+_index_lock = threading.Lock()
+
+
+def _build():
+    return RangeIndex(ReviewerDailyStats.objects.order_by(
+        'reviewer__full_name', 'day').values_list(
+            'reviewer__full_name', 'project__name', 'day', 'review_count',
+            'comment_count').iterator())
+
+
+def get_index(generation=None):
+    """Return index, building it if the data generation has changed since it
+    was built
+
+    :arg int generation: current data generation, looked up if None
+    :Return: RangeIndex
+    """
+    global _index, _index_generation
+    if generation is None:
+        generation = database_helper.get_generation()
+    with _index_lock:
+        if _index is None or generation != _index_generation:
+            logging.info("Building range index for data generation %d",
+                         generation)
+            _index = _build()
+            _index_generation = generation
+        return _index
+
+
+def invalidate():
+    """Build index again when it is next used, e.g. as the data generation
+    was reset
+    """
+    global _index
+    with _index_lock:
+        _index = None
@@ -1,8 +1,33 @@
 """For converting and persisting pygerrit Changes as leaderboard Reviewers,
-Changes, and Comments
+Changes, and Comments, along with reviewers' daily stats
 """
+from collections import Counter, OrderedDict
 from datetime import datetime
-from ..models import Change, Reviewer, Comment
+import logging
+
+from django.db import transaction
+from django.db.models import Count, F, Max
+from django.db.models.functions import TruncDate
+
+from ..models import Change, Reviewer, Comment, DataGeneration, Project, \
+    ReviewerDailyStats, SyncState
+from .reviewer_cache import ReviewerCache, normalize_reviewer_name
+
+# maximum number of values in a single "IN" lookup, kept well below sqlite's
+# limit of 999 query parameters
+MAX_LOOKUP_COUNT = 500
+
+
+def chunks(values, size=MAX_LOOKUP_COUNT):
+    """Split given values into lists of at most size values each
+
+    :arg iterable values: values to split up
+    :arg int size: maximum number of values in each list
+    :Returns: generator of lists of values
+    """
+    values = list(values)
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
 
 
 def convert_to_utc_datetime(timestamp_utc):
@@ -17,35 +42,338 @@ def convert_to_utc_datetime(timestamp_utc):
     return datetime.utcfromtimestamp(float(timestamp_utc))
 
 
-def get_last_synced_change_timestamp():
+def get_last_synced_change_timestamp(project=None):
     """Return the last synced change's UTC datetime
 
+    :arg str project: name of project to return the last synced change of,
+        changes of all projects are included if not specified
     :Returns: Latest change UTC datetime among changes in database,
               None if there are no changes
     """
+    changes = Change.objects.all()
+    if project:
+        changes = changes.filter(project__name=project)
     try:
-        change = Change.objects.latest('timestamp')
+        change = changes.latest('timestamp')
         return change.timestamp
     except Change.DoesNotExist:
         return None
 
 
-def _get_or_create_reviewer(reviewer_name):
+def get_first_synced_change_timestamp():
+    """Return the first synced change's UTC datetime
+
+    :Returns: Earliest change UTC datetime among changes in database,
+              None if there are no changes
+    """
     try:
-        reviewer = Reviewer.objects.get(full_name=reviewer_name)
-    except Reviewer.DoesNotExist:
-        # add new reviewer
-        reviewer = Reviewer(full_name=reviewer_name)
-        reviewer.save()
-    return reviewer
+        change = Change.objects.earliest('timestamp')
+        return change.timestamp
+    except Change.DoesNotExist:
+        return None
+
 
+def start_sync(hostname, query_type=SyncState.QUERY_MERGED):
+    """Record that a sync from given gerrit server has started
 
-def _change_exists(change_id):
-    """Check if change exists in database
+    If the last sync for the gerrit server and query type was interrupted,
+    its cursor is kept so that the sync can be resumed.
+
+    :arg str hostname: gerrit server hostname
+    :arg str query_type: type of gerrit query used to sync
+    :Returns: :class:`..models.SyncState` for the gerrit server and query type
     """
-    # change ID is unique
-    change_count = Change.objects.filter(change_id=change_id).count()
-    return change_count != 0
+    sync_state, _ = SyncState.objects.get_or_create(hostname=hostname,
+                                                    query_type=query_type)
+    if sync_state.fetch_after:
+        logging.info("Resuming %s sync of changes after %s, continuing "
+                     "from %s", query_type, sync_state.fetch_after,
+                     sync_state.fetch_before)
+    sync_state.started = datetime.utcnow()
+    sync_state.status = SyncState.STATUS_RUNNING
+    sync_state.save()
+    return sync_state
+
+
+def advance_sync(sync_state, fetch_before, fetch_skip):
+    """Record that a page of changes has been stored by a sync
+
+    Should be called in the same transaction the changes are stored in, so
+    that the sync's cursor always matches the changes stored.
+
+    :arg models.SyncState sync_state: state returned by start_sync()
+    :arg datetime fetch_before: time in UTC of oldest change stored
+    :arg int fetch_skip: count of changes stored updated at fetch_before
+    """
+    sync_state.fetch_before = fetch_before
+    sync_state.fetch_skip = fetch_skip
+    sync_state.save()
+
+
+def finish_sync(sync_state, change_count, error=None, watermark=None,
+                project=None, stored=True):
+    """Record that a sync has finished
+
+    A successful sync moves the watermark up to the latest change stored, or
+    to given watermark, and resets the cursor. A failed sync keeps its cursor
+    so it can be resumed. Syncs of merged changes bump the data generation,
+    unless they stored nothing.
+
+    :arg models.SyncState sync_state: state returned by start_sync()
+    :arg int change_count: count of changes fetched by the sync
+    :arg Exception error: error the sync failed with, None if it succeeded
+    :arg datetime watermark: time in UTC of latest change synced, for syncs
+        that don't store merged changes
+    :arg str project: name of project synced, for syncs of a single project,
+        whose watermark is the latest change stored for the project
+    :arg bool stored: whether the sync may have committed changes, False if
+        it is known not to have, e.g. if all changes fetched were already
+        stored
+    """
+    sync_state.finished = datetime.utcnow()
+    sync_state.change_count = change_count
+    if error:
+        sync_state.status = SyncState.STATUS_FAILED
+        sync_state.message = str(error)[:2000]
+    else:
+        sync_state.status = SyncState.STATUS_SUCCEEDED
+        sync_state.message = ""
+        sync_state.watermark = watermark or \
+            get_last_synced_change_timestamp(project)
+        sync_state.fetch_after = None
+        sync_state.fetch_before = None
+        sync_state.fetch_skip = 0
+    sync_state.save()
+    if stored and sync_state.query_type != SyncState.QUERY_OPEN:
+        # pages of changes stored by the sync have been committed, even if
+        # it failed
+        bump_generation()
+
+
+def is_sync_succeeded(hostname, query_type):
+    """Return whether the last sync from given gerrit server with given query
+    type succeeded
+
+    :arg str hostname: gerrit server hostname
+    :arg str query_type: type of gerrit query used to sync
+    :Returns: True if the last sync succeeded, False otherwise
+    """
+    return SyncState.objects.filter(
+        hostname=hostname, query_type=query_type,
+        status=SyncState.STATUS_SUCCEEDED).exists()
+
+
+def get_last_sync_state():
+    """Return state of the most recently started sync of merged changes
+
+    The state of each project synced by a sharded sync isn't included, as the
+    sync as a whole is recorded as well.
+
+    :Returns: :class:`..models.SyncState`, None if no sync has been started
+    """
+    return SyncState.objects.filter(
+        query_type=SyncState.QUERY_MERGED).exclude(
+            started=None).order_by('-started').first()
+
+
+def get_last_sync_finished(open_changes=False):
+    """Return when changes were last synced
+
+    :arg bool open_changes: whether to return when open changes were last
+        refreshed, instead of when merged changes were last synced
+    :Returns: time in UTC the most recently finished sync finished, None if
+        no sync has finished
+    """
+    sync_states = SyncState.objects.all()
+    if open_changes:
+        sync_states = sync_states.filter(query_type=SyncState.QUERY_OPEN)
+    else:
+        sync_states = sync_states.exclude(query_type=SyncState.QUERY_OPEN)
+    return sync_states.aggregate(finished=Max('finished'))['finished']
+
+
+def get_generation():
+    """Return the data generation, which changes each time a sync commits
+    changes
+
+    :Returns: int generation, 0 if no sync has finished
+    """
+    generation = DataGeneration.objects.values_list(
+        'generation', flat=True).first()
+    return generation or 0
+
+
+def get_generation_updated():
+    """Return when the data generation last changed
+
+    :Returns: time in UTC the generation was last bumped, None if it hasn't
+        been since this was recorded
+    """
+    return DataGeneration.objects.values_list('updated', flat=True).first()
+
+
+def bump_generation():
+    """Record that changes stored have been committed, so that results
+    cached for the previous data generation are no longer used
+    """
+    now = datetime.utcnow()
+    if not DataGeneration.objects.update(generation=F('generation') + 1,
+                                         updated=now):
+        DataGeneration.objects.create(generation=1, updated=now)
+
+
+def get_project_names():
+    """Return names of projects that changes have been stored for
+
+    :Returns: sorted list of project names
+    """
+    return list(Project.objects.order_by('name').values_list(
+        'name', flat=True))
+
+
+def _get_account_name(account):
+    """Return name for given pygerrit account
+
+    :arg pygerrit.models.Account account: change owner or reviewer
+    :Returns: account's name, or username if account doesn't have a name
+    """
+    return account.name if account.name else account.username
+
+
+def _get_or_create_reviewer_ids(reviewer_names, reviewer_cache):
+    """Return database IDs of reviewers with given names
+
+    Reviewers are looked up in reviewer_cache first. Reviewers not cached are
+    looked up in the database, and any that don't exist are created, after
+    which they are added to reviewer_cache.
+
+    :arg set reviewer_names: normalized names of reviewers
+    :arg ReviewerCache reviewer_cache: cache of reviewer IDs
+    :Returns: dictionary of reviewer names to reviewer IDs
+    """
+    reviewer_ids = {}
+    uncached_reviewer_names = set()
+    for reviewer_name in reviewer_names:
+        reviewer_id = reviewer_cache.get(reviewer_name)
+        if reviewer_id is None:
+            uncached_reviewer_names.add(reviewer_name)
+        else:
+            reviewer_ids[reviewer_name] = reviewer_id
+    if not uncached_reviewer_names:
+        return reviewer_ids
+
+    found_reviewer_ids = {}
+    for names in chunks(uncached_reviewer_names):
+        found_reviewer_ids.update(Reviewer.objects.filter(
+            full_name__in=names).values_list('full_name', 'id'))
+    new_reviewer_names = uncached_reviewer_names.difference(
+        found_reviewer_ids)
+    if new_reviewer_names:
+        Reviewer.objects.bulk_create(
+            [Reviewer(full_name=name) for name in new_reviewer_names])
+        # bulk_create() doesn't set primary keys for sqlite, look them up
+        for names in chunks(new_reviewer_names):
+            found_reviewer_ids.update(Reviewer.objects.filter(
+                full_name__in=names).values_list('full_name', 'id'))
+    for reviewer_name, reviewer_id in found_reviewer_ids.items():
+        reviewer_cache.add(reviewer_name, reviewer_id)
+    reviewer_ids.update(found_reviewer_ids)
+    return reviewer_ids
+
+
+def _get_or_create_project_ids(project_names):
+    """Return database IDs of projects with given names, creating any that
+    don't exist
+
+    :arg set project_names: gerrit project names
+    :Returns: dictionary of project names to project IDs
+    """
+    project_ids = {}
+    for names in chunks(project_names):
+        project_ids.update(Project.objects.filter(
+            name__in=names).values_list('name', 'id'))
+    new_project_names = set(project_names).difference(project_ids)
+    if new_project_names:
+        Project.objects.bulk_create(
+            [Project(name=name) for name in new_project_names])
+        # bulk_create() doesn't set primary keys for sqlite, look them up
+        for names in chunks(new_project_names):
+            project_ids.update(Project.objects.filter(
+                name__in=names).values_list('name', 'id'))
+    return project_ids
+
+
+def _set_change_ids(changes):
+    """Set primary keys of changes just bulk created
+
+    bulk_create() doesn't set primary keys for sqlite, so they are looked up
+    by gerrit change ID.
+    """
+    if not changes or changes[0].pk is not None:
+        return
+    change_ids = {}
+    for chunk in chunks(changes):
+        change_ids.update(Change.objects.filter(
+            change_id__in=[change.change_id for change in chunk]).values_list(
+                'change_id', 'id'))
+    for change in changes:
+        change.pk = change_ids[change.change_id]
+
+
+def _get_stored_changes(change_ids):
+    """Return changes with given IDs that are already stored
+
+    Looks up changes in chunks so that a page of fetched changes only needs a
+    query per MAX_LOOKUP_COUNT changes instead of one query per change.
+
+    :arg iterable change_ids: gerrit change IDs to look up
+    :Returns: dictionary of change IDs found in database to tuples of
+        primary key, project ID, timestamp, and comment count
+    """
+    stored_changes = {}
+    for chunk in chunks(change_ids):
+        for change_id, pk, project_id, timestamp, comment_count in \
+                Change.objects.filter(change_id__in=chunk).values_list(
+                    'change_id', 'id', 'project_id', 'timestamp',
+                    'comment_count'):
+            stored_changes[change_id] = (pk, project_id, timestamp,
+                                         comment_count)
+    return stored_changes
+
+
+def _get_stored_comments(change_pks):
+    """Return comments and reviewers stored for given changes
+
+    :arg iterable change_pks: primary keys of changes
+    :Returns: tuple of dictionary of change primary keys to Counters of
+        tuples of comment timestamp and reviewer ID, and dictionary of change
+        primary keys to sets of IDs of reviewers of the change
+    """
+    stored_comments = {}
+    stored_reviewer_ids = {}
+    for chunk in chunks(change_pks):
+        for change_pk, timestamp, reviewer_id in Comment.objects.filter(
+                change_id__in=chunk).values_list('change_id', 'timestamp',
+                                                 'reviewer_id'):
+            stored_comments.setdefault(change_pk, Counter())[
+                (timestamp, reviewer_id)] += 1
+        for change_pk, reviewer_id in Reviewer.changes.through.objects.filter(
+                change_id__in=chunk).values_list('change_id', 'reviewer_id'):
+            stored_reviewer_ids.setdefault(change_pk, set()).add(reviewer_id)
+    return stored_comments, stored_reviewer_ids
+
+
+def _get_comments(gerrit_change):
+    """Return comments of given change to store, with their reviewers' names
+
+    :arg pygerrit.models.Change gerrit_change: change fetched from gerrit
+    :Returns: list of tuples of pygerrit.models.Comment and normalized
+        reviewer name
+    """
+    return [(gerrit_comment, normalize_reviewer_name(
+        _get_account_name(gerrit_comment.reviewer)))
+        for gerrit_comment in gerrit_change.comments
+        if not _ignore_comment(gerrit_change, gerrit_comment)]
 
 
 def _ignore_comment(gerrit_change, gerrit_comment):
@@ -56,9 +384,7 @@ def _ignore_comment(gerrit_change, gerrit_comment):
     :Returns: True if comment should be ignored, False otherwise
     """
     # reviewer might not have a name, but will have a username
-    reviewer_name = (
-        gerrit_comment.reviewer.name if gerrit_comment.reviewer.name
-        else gerrit_comment.reviewer.username)
+    reviewer_name = _get_account_name(gerrit_comment.reviewer)
     # ignore Jenkins Build or Gerrit Code Review comments
     if "Jenkins" in reviewer_name or "Gerrit" in reviewer_name:
         return True
@@ -77,59 +403,289 @@ def _ignore_comment(gerrit_change, gerrit_comment):
     return False
 
 
-def update(gerrit_changes):
+def _add_daily_stats(daily_counts):
+    """Add given counts to reviewers' daily stats
+
+    Stats that already exist are looked up with a query per MAX_LOOKUP_COUNT
+    reviewers, and replaced along with new stats with bulk inserts, so that
+    the number of queries doesn't depend on the number of stats.
+
+    :arg dict daily_counts: dictionary of tuples of reviewer ID, project ID,
+        and day to lists of review count and comment count to add
+    """
+    if not daily_counts:
+        return
+    days = [day for _, _, day in daily_counts]
+    existing_stats_ids = []
+    for reviewer_ids in chunks(set(
+            reviewer_id for reviewer_id, _, _ in daily_counts)):
+        for stats in ReviewerDailyStats.objects.filter(
+                reviewer_id__in=reviewer_ids, day__gte=min(days),
+                day__lte=max(days)):
+            key = (stats.reviewer_id, stats.project_id, stats.day)
+            if key in daily_counts:
+                daily_counts[key][0] += stats.review_count
+                daily_counts[key][1] += stats.comment_count
+                existing_stats_ids.append(stats.id)
+    for stats_ids in chunks(existing_stats_ids):
+        ReviewerDailyStats.objects.filter(id__in=stats_ids).delete()
+    # reviews moved to another day can leave stats with nothing counted
+    ReviewerDailyStats.objects.bulk_create([
+        ReviewerDailyStats(reviewer_id=reviewer_id, project_id=project_id,
+                           day=day, review_count=review_count,
+                           comment_count=comment_count)
+        for (reviewer_id, project_id, day), (review_count, comment_count)
+        in daily_counts.items() if review_count or comment_count])
+
+
+def _count_daily(model, timestamp_field, project_field):
+    """Return count of rows of a reviewer relation per reviewer, project, and
+    day
+
+    :arg Model model: model linking reviewers to changes, or Comment
+    :arg str timestamp_field: lookup of the time in UTC rows are counted on
+    :arg str project_field: lookup of the ID of the project rows are counted
+        for
+    :Returns: list of tuples of reviewer ID, project ID, day, and count
+    """
+    return model.objects.annotate(
+        day=TruncDate(timestamp_field)).values(
+            'reviewer_id', project_field, 'day').annotate(
+                count=Count('id')).order_by().values_list(
+                    'reviewer_id', project_field, 'day', 'count')
+
+
+def rebuild_daily_stats():
+    """Recount reviewers' daily stats from the changes and comments stored
+
+    Daily stats are kept up to date by update(), this repairs them if they
+    weren't, e.g. if changes were stored or removed some other way.
+
+    :Returns: count of daily stats stored
+    """
+    daily_counts = {}
+    with transaction.atomic():
+        for reviewer_id, project_id, day, count in _count_daily(
+                Reviewer.changes.through, 'change__timestamp',
+                'change__project_id'):
+            daily_counts.setdefault((reviewer_id, project_id, day),
+                                    [0, 0])[0] = count
+        for reviewer_id, project_id, day, count in _count_daily(
+                Comment, 'timestamp', 'change__project_id'):
+            daily_counts.setdefault((reviewer_id, project_id, day),
+                                    [0, 0])[1] = count
+        ReviewerDailyStats.objects.all().delete()
+        _add_daily_stats(daily_counts)
+        bump_generation()
+    return len(daily_counts)
+
+
+def _delete_all(model):
+    """Remove all rows of given model, a chunk at a time, so that they don't
+    all need to be loaded to delete the rows referring to them
+    """
+    while True:
+        ids = list(model.objects.values_list('id', flat=True)[
+            :MAX_LOOKUP_COUNT])
+        if not ids:
+            return
+        model.objects.filter(id__in=ids).delete()
+
+
+def delete_changes():
+    """Remove all changes, comments, reviewers, projects, and daily stats
+    stored, e.g. before storing changes again
+    """
+    with transaction.atomic():
+        # nothing refers to these, so they are deleted with a query each
+        ReviewerDailyStats.objects.all().delete()
+        Comment.objects.all().delete()
+        Reviewer.changes.through.objects.all().delete()
+        for model in (Change, Reviewer, Project):
+            _delete_all(model)
+
+
+def _add_reviews(daily_counts, reviewer_ids, project_id, day, count=1):
+    for reviewer_id in reviewer_ids:
+        daily_counts.setdefault((reviewer_id, project_id, day),
+                                [0, 0])[0] += count
+
+
+def _update_changes(gerrit_changes, stored_changes, change_comments,
+                    reviewer_ids, daily_counts):
+    """Store comments and reviewers added to given changes since they were
+    stored
+
+    Comments are matched with the ones stored by time posted and reviewer,
+    and only ones that aren't stored yet are added. Changes reviewed are
+    counted on the day changes were last updated, so if that changed, the
+    reviews of reviewers already stored are moved to the new day.
+
+    :arg list gerrit_changes: pygerrit.models.Change objects already stored
+    :arg dict stored_changes: dictionary returned by _get_stored_changes()
+    :arg dict change_comments: dictionary of change IDs to lists returned by
+        _get_comments()
+    :arg dict reviewer_ids: dictionary of reviewer names to reviewer IDs
+    :arg dict daily_counts: dictionary of tuples of reviewer ID, project ID,
+        and day to lists of review count and comment count to add to
+    :Returns: tuple of list of Comment objects and set of tuples of reviewer
+        ID and change primary key to add
+    """
+    stored_comments, stored_reviewer_ids = _get_stored_comments(
+        stored_changes[gerrit_change.change_id][0]
+        for gerrit_change in gerrit_changes)
+    comments = []
+    reviewer_changes = set()
+    for gerrit_change in gerrit_changes:
+        pk, project_id, stored_timestamp, comment_count = \
+            stored_changes[gerrit_change.change_id]
+        timestamp = max(stored_timestamp, convert_to_utc_datetime(
+            gerrit_change.last_update_timestamp))
+        comment_keys = stored_comments.get(pk, Counter())
+        change_reviewer_ids = stored_reviewer_ids.get(pk, set())
+        if timestamp.date() != stored_timestamp.date():
+            _add_reviews(daily_counts, change_reviewer_ids, project_id,
+                         stored_timestamp.date(), -1)
+            _add_reviews(daily_counts, change_reviewer_ids, project_id,
+                         timestamp.date())
+        new_reviewer_ids = set()
+        for gerrit_comment, reviewer_name in \
+                change_comments[gerrit_change.change_id]:
+            comment = Comment(
+                timestamp=convert_to_utc_datetime(gerrit_comment.timestamp),
+                message=gerrit_comment.message, change_id=pk,
+                reviewer_id=reviewer_ids[reviewer_name])
+            key = (comment.timestamp, comment.reviewer_id)
+            if comment_keys[key]:
+                # already stored
+                comment_keys[key] -= 1
+                continue
+            comments.append(comment)
+            comment_count += 1
+            daily_counts.setdefault(
+                (comment.reviewer_id, project_id, comment.timestamp.date()),
+                [0, 0])[1] += 1
+            if comment.reviewer_id not in change_reviewer_ids:
+                new_reviewer_ids.add(comment.reviewer_id)
+        _add_reviews(daily_counts, new_reviewer_ids, project_id,
+                     timestamp.date())
+        reviewer_changes.update((reviewer_id, pk)
+                                for reviewer_id in new_reviewer_ids)
+        Change.objects.filter(pk=pk).update(timestamp=timestamp,
+                                            comment_count=comment_count)
+    return comments, reviewer_changes
+
+
+def update(gerrit_changes, reviewer_cache=None):
     """Update database based on given gerrit changes
 
     Update Change, Comment, and Reviewer tables with information in
     list of gerrit changes. Adds comments and changes to reviewers,
-    creating new reviewers if they don't exist. Ignores duplicate
-    changes if any.
+    creating new reviewers if they don't exist, and adds them to reviewers'
+    daily stats. Changes already stored that were updated or have more
+    comments since, e.g. comments posted after they were merged, only have
+    the comments not stored yet added. Ignores duplicate changes if any.
+
+    Changes that already exist are found with a query per MAX_LOOKUP_COUNT
+    changes, so that storing changes that haven't changed costs next to
+    nothing. Changes are stored in a single transaction with bulk
+    inserts, so that the number of queries doesn't depend on the number of
+    comments and reviewers. Reviewers are resolved using
+    reviewer_cache, which should be shared across calls made by a sync so
+    that reviewers are usually found without querying the database. If
+    storing fails, the reviewers are removed from reviewer_cache, as any
+    created have been rolled back.
     :arg List of pygerrit.models.Change: list of changes fetched using
         pygerrit from gerrit
+    :arg ReviewerCache reviewer_cache: cache of reviewer IDs, an empty one
+        is used if not specified
+    :Return: count of changes stored or updated
     """
+    stored_changes = _get_stored_changes(
+        set(gerrit_change.change_id for gerrit_change in gerrit_changes))
+    new_gerrit_changes = OrderedDict()
+    updated_gerrit_changes = []
+    # comments to store for each change, with their reviewers' names
+    change_comments = {}
     for gerrit_change in gerrit_changes:
-        if _change_exists(gerrit_change.change_id):
-            # This could happen either because of a fetch overlap or because of
-            # a comment added to a merged change. Ignore both.
+        if gerrit_change.change_id in change_comments:
+            # fetch overlap, changes are fetched newest first
             continue
-        change_timestamp = convert_to_utc_datetime(
-            gerrit_change.last_update_timestamp)
-
-        # owner might not have a name, but will have a username
-        owner = (
-            gerrit_change.owner.name if gerrit_change.owner.name
-            else gerrit_change.owner.username)
-        # create change
-        change = Change(
-            timestamp=change_timestamp,
-            owner_full_name=owner,
-            subject=gerrit_change.subject,
-            project_name=gerrit_change.project,
-            change_id=gerrit_change.change_id
-        )
-        # commit change to database
-        change.save()
-        # process comments, add comment and change to reviewer
-        for gerrit_comment in gerrit_change.comments:
-            # ignore comment if necessary
-            if _ignore_comment(gerrit_change, gerrit_comment):
-                continue
-            # create comment
-            comment_timestamp = convert_to_utc_datetime(
-                gerrit_comment.timestamp)
-            comment = Comment(
-                timestamp=comment_timestamp,
-                message=gerrit_comment.message,
-                change=change)
-            comment.save()
-            # get reviewer, creating if necessary
-            # reviewer might not have a name, but will have a username
-            reviewer_name = (
-                gerrit_comment.reviewer.name if gerrit_comment.reviewer.name
-                else gerrit_comment.reviewer.username)
-            reviewer = _get_or_create_reviewer(reviewer_name)
-            # link comment to reviewer
-            reviewer.comments.add(comment)
-            # link change to reviewer (change already linked will just get
-            # updated
-            reviewer.changes.add(change)
+        comments = _get_comments(gerrit_change)
+        change_comments[gerrit_change.change_id] = comments
+        stored_change = stored_changes.get(gerrit_change.change_id)
+        if stored_change is None:
+            new_gerrit_changes[gerrit_change.change_id] = gerrit_change
+        elif convert_to_utc_datetime(gerrit_change.last_update_timestamp) > \
+                stored_change[2] or len(comments) > stored_change[3]:
+            updated_gerrit_changes.append(gerrit_change)
+    if not new_gerrit_changes and not updated_gerrit_changes:
+        return 0
+
+    if reviewer_cache is None:
+        reviewer_cache = ReviewerCache()
+    reviewer_names = set(
+        reviewer_name for gerrit_change in
+        list(new_gerrit_changes.values()) + updated_gerrit_changes
+        for _, reviewer_name in change_comments[gerrit_change.change_id])
+    try:
+        with transaction.atomic():
+            # resolve comments' reviewers, creating reviewers if necessary
+            reviewer_ids = _get_or_create_reviewer_ids(reviewer_names,
+                                                       reviewer_cache)
+            # review and comment counts keyed by reviewer, project, and day
+            daily_counts = {}
+            comments, reviewer_changes = _update_changes(
+                updated_gerrit_changes, stored_changes, change_comments,
+                reviewer_ids, daily_counts)
+
+            project_ids = _get_or_create_project_ids(set(
+                gerrit_change.project
+                for gerrit_change in new_gerrit_changes.values()))
+            changes = []
+            new_comments = []
+            for gerrit_change in new_gerrit_changes.values():
+                change = Change(
+                    timestamp=convert_to_utc_datetime(
+                        gerrit_change.last_update_timestamp),
+                    owner_full_name=_get_account_name(gerrit_change.owner),
+                    subject=gerrit_change.subject,
+                    project_id=project_ids[gerrit_change.project],
+                    change_id=gerrit_change.change_id,
+                    comment_count=len(change_comments[gerrit_change.change_id])
+                )
+                changes.append(change)
+                for gerrit_comment, reviewer_name in \
+                        change_comments[gerrit_change.change_id]:
+                    new_comments.append(Comment(
+                        timestamp=convert_to_utc_datetime(
+                            gerrit_comment.timestamp),
+                        message=gerrit_comment.message,
+                        change=change,
+                        reviewer_id=reviewer_ids[reviewer_name]))
+            Change.objects.bulk_create(changes)
+            _set_change_ids(changes)
+
+            # link new changes to the reviewers who commented on them
+            for comment in new_comments:
+                # comments were made before their changes had primary keys
+                comment.change_id = comment.change.pk
+                change = comment.change
+                if (comment.reviewer_id, change.pk) not in reviewer_changes:
+                    reviewer_changes.add((comment.reviewer_id, change.pk))
+                    _add_reviews(daily_counts, [comment.reviewer_id],
+                                 change.project_id, change.timestamp.date())
+                daily_counts.setdefault(
+                    (comment.reviewer_id, change.project_id,
+                     comment.timestamp.date()), [0, 0])[1] += 1
+            Comment.objects.bulk_create(comments + new_comments)
+            ReviewerChange = Reviewer.changes.through
+            ReviewerChange.objects.bulk_create([
+                ReviewerChange(reviewer_id=reviewer_id, change_id=change_id)
+                for reviewer_id, change_id in reviewer_changes])
+            _add_daily_stats(daily_counts)
+    except Exception:
+        # reviewers created have been rolled back, don't use their IDs
+        reviewer_cache.discard(reviewer_names)
+        raise
+    return len(new_gerrit_changes) + len(updated_gerrit_changes)
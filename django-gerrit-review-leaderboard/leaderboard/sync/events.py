@@ -0,0 +1,330 @@
+"""For applying events from gerrit's event stream to the changes and open
+changes stored as they happen, instead of waiting for the next sync
+
+Events are read in a background thread and applied in batches collected over
+a short time window, so that the changes of a batch are fetched from gerrit
+with a query per MAX_CHANGE_NUMBERS_PER_QUERY changes and stored together.
+Each time the stream is connected, changes missed while it wasn't are caught
+up on by syncing merged changes since the last sync, and refreshing open
+changes updated since the last refresh.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+
+from django.db import close_old_connections, transaction
+
+from . import database_helper
+from . import fetcher
+from . import lease
+from .reviewer_cache import ReviewerCache
+from ..config_handler.config import GerritFetchConfig
+from ..current_load import current_load_fetcher
+from ..current_load import database_helper as current_load_database_helper
+from ..current_load import open_load_cache
+from ..gerrit_handler import connection, fetch
+from ..models import SyncState
+
+EVENT_CHANGE_MERGED = "change-merged"
+EVENT_CHANGE_ABANDONED = "change-abandoned"
+EVENT_COMMENT_ADDED = "comment-added"
+EVENT_REVIEWER_ADDED = "reviewer-added"
+# events that change the changes and open changes stored, others are ignored
+EVENT_TYPES = (EVENT_CHANGE_MERGED, EVENT_CHANGE_ABANDONED,
+               EVENT_COMMENT_ADDED, EVENT_REVIEWER_ADDED)
+# seconds events are collected for after the first one, before being applied
+# together
+BATCH_WINDOW = 2
+# maximum number of events applied together
+MAX_BATCH_SIZE = 500
+# maximum number of events read ahead of those being applied, after which the
+# reader waits for a batch to be applied
+MAX_QUEUED_EVENTS = 10 * MAX_BATCH_SIZE
+# seconds the reader waits for room in the queue before checking whether
+# events are still being applied
+QUEUE_POLL_INTERVAL = 1
+# seconds to wait before connecting again after the stream is disconnected
+RECONNECT_DELAY = 10
+
+
+class _End:
+    """Put in the queue by the reader thread when there are no more events"""
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def read_events(lines):
+    """Parse events from lines of event JSON, e.g. as streamed by gerrit
+    stream-events or recorded from it
+
+    Lines that aren't valid JSON events are logged and skipped.
+
+    :arg iterable lines: lines of JSON, one event per line
+    :Yields: dictionaries of events
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            event = None
+        if not isinstance(event, dict):
+            logging.warning("Ignoring invalid event: %s", line[:200])
+            continue
+        yield event
+
+
+def _get_change_number(event):
+    """Return number of change given event is for
+
+    :arg dict event: gerrit event
+    :Returns: int gerrit change number, None if the event isn't for a change
+    """
+    try:
+        return int(event['change']['number'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def apply_events(events, config, reviewer_cache):
+    """Apply a batch of events to the changes and open changes stored
+
+    Changes merged are fetched along with their comments and stored, and are
+    retired from open changes along with changes abandoned. Changes commented
+    on or with reviewers added are fetched, and if merged, have their
+    comments added to the changes stored, or if open, their reviewers' open
+    change counts updated. Other events are ignored.
+
+    Stores are made while holding the same leases as syncs and refreshes, so
+    that they don't store the same changes at the same time.
+
+    :arg list events: dictionaries of events, oldest first
+    :arg GerritFetchConfig config: gerrit server configuration
+    :arg ReviewerCache reviewer_cache: cache of reviewer IDs, shared by
+        batches
+    :Return: count of events applied
+    :Raises: GerritError, OSError, or EOFError if fetching changes fails
+    """
+    merged_numbers = set()
+    closed_numbers = set()
+    updated_numbers = set()
+    applied_count = 0
+    for event in events:
+        number = _get_change_number(event)
+        if event.get('type') not in EVENT_TYPES or number is None:
+            continue
+        applied_count += 1
+        if event['type'] == EVENT_CHANGE_MERGED:
+            merged_numbers.add(number)
+            closed_numbers.add(number)
+        elif event['type'] == EVENT_CHANGE_ABANDONED:
+            closed_numbers.add(number)
+        else:
+            updated_numbers.add(number)
+    updated_numbers -= closed_numbers
+
+    gerrit_changes = []
+    if merged_numbers or updated_numbers:
+        # changes commented on may have been merged already, their comments
+        # are added to the changes stored
+        gerrit_changes = fetch.fetch_changes(
+            config.hostname(), config.username(),
+            merged_numbers | updated_numbers, "merged", config.port(),
+            raise_errors=True)
+    if gerrit_changes:
+        with lease.hold_when_free(SyncState.QUERY_MERGED):
+            sync_state = database_helper.start_sync(config.hostname(),
+                                                    SyncState.QUERY_EVENTS)
+            try:
+                stored_count = database_helper.update(gerrit_changes,
+                                                      reviewer_cache)
+            except Exception as err:
+                # nothing was stored, changes are stored in one transaction
+                database_helper.finish_sync(sync_state, 0, err, stored=False)
+                raise
+            # results cached aren't recomputed unless changes were stored
+            database_helper.finish_sync(sync_state, len(gerrit_changes),
+                                        stored=stored_count > 0)
+
+    open_changes = []
+    if updated_numbers:
+        # changes closed since are left out, and retired by their own event
+        open_changes = fetch.fetch_changes(
+            config.hostname(), config.username(), updated_numbers, "open",
+            config.port(), raise_errors=True)
+    if open_changes or closed_numbers:
+        with lease.hold_when_free(SyncState.QUERY_OPEN):
+            with transaction.atomic():
+                current_load_database_helper.update(open_changes)
+                current_load_database_helper.retire(closed_numbers)
+        open_load_cache.invalidate()
+    logging.info("Applied %d events, storing %d merged changes and updating "
+                 "%d open changes", applied_count, len(gerrit_changes),
+                 len(open_changes))
+    return applied_count
+
+
+def _put(event_queue, item, stopped):
+    """Put item in queue once there is room, unless stopped meanwhile
+
+    :Return: False if stopped, True otherwise
+    """
+    while not stopped.is_set():
+        try:
+            event_queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read(events, event_queue, stopped):
+    try:
+        for event in events:
+            if not _put(event_queue, event, stopped):
+                return
+    except Exception as err:
+        _put(event_queue, _End(err), stopped)
+        return
+    _put(event_queue, _End(), stopped)
+
+
+def _get_batch(event_queue, window):
+    """Return events received up to window seconds after the next one
+
+    :arg queue.Queue event_queue: queue of events put by the reader thread
+    :arg float window: seconds to collect events for
+    :Return: tuple of list of events and _End if there are no more events,
+        None otherwise
+    """
+    batch = [event_queue.get()]
+    deadline = time.time() + window
+    while not isinstance(batch[-1], _End) and len(batch) < MAX_BATCH_SIZE:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(event_queue.get(timeout=timeout))
+        except queue.Empty:
+            break
+    if isinstance(batch[-1], _End):
+        return batch[:-1], batch[-1]
+    return batch, None
+
+
+def consume(events, config, reviewer_cache=None, window=BATCH_WINDOW,
+            stream=None):
+    """Apply events as they are received, until there are no more
+
+    Events are read in a background thread, so that events received while a
+    batch is being applied are collected for the next batch. Up to
+    MAX_QUEUED_EVENTS events are read ahead. If applying events fails, the
+    stream is closed and the reader stopped before the error is raised.
+
+    :arg iterable events: dictionaries of events, e.g. from read_events()
+    :arg GerritFetchConfig config: gerrit server configuration
+    :arg ReviewerCache reviewer_cache: cache of reviewer IDs, an empty one
+        is used if not specified
+    :arg float window: seconds to collect events for before applying them
+    :arg stream: stream events are read from, e.g. as returned by
+        connection.open_event_stream(), closed once events are no longer
+        applied so that the reader stops waiting for more
+    :Return: count of events applied
+    :Raises: GerritError, OSError, or EOFError if reading events or fetching
+        changes fails
+    """
+    if reviewer_cache is None:
+        reviewer_cache = ReviewerCache()
+    event_queue = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+    stopped = threading.Event()
+    reader = threading.Thread(target=_read,
+                              args=(events, event_queue, stopped),
+                              name="leaderboard-event-reader", daemon=True)
+    reader.start()
+    applied_count = 0
+    end = None
+    try:
+        while end is None:
+            batch, end = _get_batch(event_queue, window)
+            if batch:
+                applied_count += apply_events(batch, config, reviewer_cache)
+    finally:
+        stopped.set()
+        if stream is not None:
+            stream.close()
+        reader.join()
+        # once the reader is done with it
+        if hasattr(events, 'close'):
+            events.close()
+    if end.error:
+        raise end.error
+    return applied_count
+
+
+def catch_up():
+    """Store changes merged, and refresh open changes updated, since the
+    last sync, e.g. while the event stream was disconnected
+
+    Merged changes are only fetched since the last sync, up to maxdays days.
+
+    :Raises: GerritError, OSError, or EOFError if fetching changes fails
+    """
+    fetcher.pull_and_store_changes(wait=True)
+    current_load_fetcher.refresh_open_changes()
+
+
+def run(window=BATCH_WINDOW, reconnect_delay=RECONNECT_DELAY,
+        connection_count=None):
+    """Apply events from gerrit's event stream as they happen
+
+    Whenever the stream is connected, changes missed while it wasn't are
+    caught up on. The stream is connected before catching up, so that events
+    meanwhile are kept by the stream until they are read. Only one process
+    streams events at a time.
+
+    :arg float window: seconds to collect events for before applying them
+    :arg float reconnect_delay: seconds to wait before connecting again after
+        the stream is disconnected
+    :arg int connection_count: number of times to connect to the stream,
+        None to keep connecting again until interrupted
+    :Return: False if events are already being streamed by another process,
+        True once connected connection_count times
+    """
+    config = GerritFetchConfig()
+    with lease.hold(SyncState.QUERY_EVENTS) as acquired:
+        if not acquired:
+            logging.info("Events are already being streamed")
+            return False
+        reviewer_cache = ReviewerCache()
+        connection_index = 0
+        while connection_count is None or connection_index < connection_count:
+            connection_index += 1
+            try:
+                stream = connection.open_event_stream(
+                    config.hostname(), config.username(), config.port())
+                try:
+                    catch_up()
+                except Exception:
+                    stream.close()
+                    raise
+                consume(read_events(stream), config, reviewer_cache, window,
+                        stream)
+                logging.warning("Event stream from %s closed",
+                                config.hostname())
+            except Exception:
+                # keep streaming, changes missed are caught up on
+                logging.exception("Streaming events from %s failed, "
+                                  "connecting again in %d seconds",
+                                  config.hostname(), reconnect_delay)
+                # don't keep reviewers cached by a batch that failed
+                reviewer_cache = ReviewerCache()
+            # don't hold on to database connections while waiting
+            close_old_connections()
+            if connection_count is None or connection_index < connection_count:
+                time.sleep(reconnect_delay)
+    return True
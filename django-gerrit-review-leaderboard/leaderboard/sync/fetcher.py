@@ -1,74 +1,109 @@
 """For pulling gerrit changes based on existing changes in database and
 persisting
 """
+import copy
 from datetime import datetime, timedelta
 import logging
 
+from django.db import transaction
+
 from . import database_helper
+from . import lease
+from . import pipeline
+from .reviewer_cache import ReviewerCache
 from ..config_handler.config import GerritFetchConfig
-from ..gerrit_handler import fetch
+from ..current_load import open_load_cache
+from ..gerrit_handler import archive, dump, fetch
+from ..models import SyncState
 
 
-fetch_after_datetime_utc = None
+def _set_fetch_after(max_days, sync_state, project=None):
+    """Set the time to start fetching changes from for a new sync
 
+    Changes created after the last synced change are fetched, limited to a
+    maximum time period of max_days.
 
-def _do_pull(hostname, username, port, max_days, skip):
+    :arg int max_days: maximum number of days of outstanding changes
+        to pull
+    :arg models.SyncState sync_state: state of the sync to set fetch_after
+        for
+    :arg str project: name of project the sync is for, whose last synced
+        change is used, the last synced change of all projects is used if
+        not specified
+    """
+    # Latest timestamp found for a change in the database. Changes after
+    # this timestamp will be pulled, but the time is limited to max_days
+    last_synced_change_datetime_utc = (
+        sync_state.watermark or
+        database_helper.get_last_synced_change_timestamp(project))
+    logging.info("Last pulled change has UTC datetime: %s",
+                 last_synced_change_datetime_utc)
+    current_datetime_utc = datetime.utcnow()
+    # If no changes found, pull changes since max_days prior to now
+    max_days_ago_datetime_utc = current_datetime_utc - \
+        timedelta(days=max_days)
+    if not last_synced_change_datetime_utc:
+        # fetch max_days worth of prior changes if no changes exist in
+        # database
+        sync_state.fetch_after = max_days_ago_datetime_utc
+    else:
+        # fetch changes since timestamp of latest change in database only
+        # if not more than max_days have elapsed since then
+        days_to_pull = abs(
+            current_datetime_utc -
+            last_synced_change_datetime_utc).days
+        if days_to_pull > max_days:
+            logging.info(
+                "%d days elapsed since last pull. Only pulling last %d "
+                "days.", days_to_pull, max_days)
+            # fetch max_days worth of prior changes
+            sync_state.fetch_after = max_days_ago_datetime_utc
+        else:
+            logging.info("Fetching changes since last pull...")
+            # fetch all changes since last fetched change
+            sync_state.fetch_after = last_synced_change_datetime_utc
+
+
+def _do_pull(hostname, username, port, max_days, sync_state, project=None,
+             raise_errors=False):
     """Pull changes from gerrit that are not in database
 
     Pull changes from gerrit created after change last saved into
-    database, limited to a maximum time period of max_days
+    database, limited to a maximum time period of max_days. Continues from
+    the cursor in sync_state if it is for a sync in progress or an
+    interrupted sync.
 
     :arg str hostname: gerrit server hostname
     :arg str username: gerrit username (SSH public key configured on server)
     :arg int port: port for gerrit service
     :arg int max_days: maximum number of days of outstanding changes
         to pull
-    :arg int skip: number of newest (already fetched) changes to skip
+    :arg models.SyncState sync_state: state of the sync, with the cursor to
+        continue fetching (older) changes from
+    :arg str project: name of project to pull changes for, changes for all
+        projects are pulled if not specified
+    :arg bool raise_errors: whether to raise gerrit and connection errors
+        instead of returning an empty list
     :Return: List of Change objects if any, empty list otherwise
     """
-    logging.info("Pulling from %s:%s a maximum of %d days of changes, skipping"
-                 " latest %d changes...", hostname, port, max_days, skip)
+    logging.info("Pulling %s from %s:%s a maximum of %d days of changes, "
+                 "before %s skipping %d changes...",
+                 project or "all projects", hostname, port, max_days,
+                 sync_state.fetch_before, sync_state.fetch_skip)
     # this fetch might be a continuation, if so we use the same 'after'
     # timestamp to start fetching changes from
-    global fetch_after_datetime_utc
-    if not fetch_after_datetime_utc:
-        # Latest timestamp found for a change in the database. Changes after this
-        # timestamp will be pulled, but the time is limited to max_days
-        last_synced_change_datetime_utc = database_helper.get_last_synced_change_timestamp()
-        logging.info("Last pulled change has UTC datetime: %s",
-                     last_synced_change_datetime_utc)
-        current_datetime_utc = datetime.utcnow()
-        # If no changes found, pull changes since max_days prior to now
-        max_days_ago_datetime_utc = current_datetime_utc - \
-            timedelta(days=max_days)
-        if not last_synced_change_datetime_utc:
-            # fetch max_days worth of prior changes if no changes exist in
-            # database
-            fetch_after_datetime_utc = max_days_ago_datetime_utc
-        else:
-            # fetch changes since timestamp of latest change in database only if
-            # not more than max_days have elapsed since then
-            days_to_pull = abs(
-                current_datetime_utc -
-                last_synced_change_datetime_utc).days
-            if days_to_pull > max_days:
-                logging.info(
-                    "%d days elapsed since last pull. Only pulling last %d days.",
-                    days_to_pull,
-                    max_days)
-                # fetch max_days worth of prior changes
-                fetch_after_datetime_utc = max_days_ago_datetime_utc
-            else:
-                logging.info("Fetching changes since last pull...")
-                # fetch all changes since last fetched change
-                fetch_after_datetime_utc = last_synced_change_datetime_utc
+    if not sync_state.fetch_after:
+        _set_fetch_after(max_days, sync_state, project)
 
     return fetch.fetch_merged_changes(hostname, username,
-                                      fetch_after_datetime_utc,
-                                      port, skip)
+                                      sync_state.fetch_after,
+                                      port, sync_state.fetch_skip,
+                                      sync_state.fetch_before,
+                                      project=project,
+                                      raise_errors=raise_errors)
 
 
-def pull_and_store_changes():
+def pull_and_store_changes(wait=False):
     """Pull changes from gerrit, process, and store in database
 
     - Loads gerrit hostname, port, and the maximum number of days to
@@ -77,31 +112,432 @@ def pull_and_store_changes():
     updates reviewer, changes, and comments tables in database.
     - Links changes and comments to reviewers. Links comments to
     changes.
+    - Records the start, finish, and outcome of the sync in the database,
+    along with a cursor committed with each page of changes stored so that
+    an interrupted sync is resumed by the next one.
+    - Fetches the next page of changes from gerrit in a background thread
+    while the previous page is being stored.
+    - If shardedsync is enabled in fetcher.conf, pulls changes with a query
+    per project, running up to fetchconcurrency queries at a time, with a
+    cursor recorded for each project.
+    - Holds a lease while syncing, so that only one sync runs at a time
+    across all processes.
 
+    :arg bool wait: whether to wait for a sync already running in another
+        process or thread to finish, instead of returning immediately
+    :Return: count of changes fetched, or by the sync already running if
+        waited for it, None if a sync was already running and not waited for
     """
-    # reset any previous fetches and continuations
-    global fetch_after_datetime_utc
-    fetch_after_datetime_utc = None
+    with lease.hold(SyncState.QUERY_MERGED) as acquired:
+        if acquired:
+            return _pull_and_store_changes()
+    if not wait:
+        logging.info("Changes are already being synced, not syncing")
+        return None
+    logging.info("Waiting for changes being synced")
+    lease.wait_for_release(SyncState.QUERY_MERGED)
+    sync_state = database_helper.get_last_sync_state()
+    return sync_state.change_count if sync_state else 0
+
+
+def _pull_and_store_changes():
     config = GerritFetchConfig()
-    # pull and store changes, MAX_CHANGES_FETCH_COUNT at a time
-    skip = 0
+    sync_state = database_helper.start_sync(config.hostname())
+    try:
+        projects = _get_projects(config) if config.sharded_sync() else None
+        if projects:
+            change_count = _pull_and_store_sharded(config, projects)
+        else:
+            change_count = _pull_and_store(config, sync_state)
+    except Exception as err:
+        database_helper.finish_sync(sync_state, 0, err)
+        raise
+    database_helper.finish_sync(sync_state, change_count)
+    if change_count:
+        # changes just merged are no longer open
+        open_load_cache.invalidate()
+    return change_count
+
+
+def _get_projects(config):
+    """Return names of projects to sync changes for with a query each
+
+    Projects are listed by gerrit, or if that fails, are the projects that
+    changes have already been stored for.
+
+    :arg GerritFetchConfig config: gerrit server configuration
+    :Return: list of project names, empty if there are none
+    """
+    projects = fetch.fetch_projects(config.hostname(), config.username(),
+                                    config.port())
+    if not projects:
+        logging.warning("Unable to list projects on %s, using projects of "
+                        "stored changes", config.hostname())
+        projects = database_helper.get_project_names()
+    if not projects:
+        logging.warning("No projects found, syncing changes for all projects "
+                        "with a single query")
+    return projects
+
+
+def _fetch_pages(config, cursor, project=None, raise_errors=False):
+    """Fetch pages of changes starting at cursor until there are no more
+
+    Runs in a pipeline fetch thread, so doesn't use the database. The cursor
+    is advanced as pages are fetched, which is ahead of the sync state
+    committed by the writer.
+
+    :arg GerritFetchConfig config: gerrit server configuration
+    :arg models.SyncState cursor: copy of the sync state to fetch from
+    :arg str project: name of project to fetch changes for, changes for all
+        projects are fetched if not specified
+    :arg bool raise_errors: whether to raise gerrit and connection errors
+        instead of treating them as there being no more changes
+    :Yields: tuple of fetched changes and the cursor to continue from
+    """
     gerrit_changes = _do_pull(
         config.hostname(),
         config.username(),
         config.port(),
         config.max_days(),
-        skip)
+        cursor,
+        project,
+        raise_errors)
     while gerrit_changes:
-        # update database
-        database_helper.update(gerrit_changes)
-        # there might be more changes, skip already fetched changes and try
-        # again
-        skip += len(gerrit_changes)
+        fetch_before, fetch_skip = fetch.next_page_cursor(
+            gerrit_changes, cursor.fetch_before, cursor.fetch_skip)
+        yield gerrit_changes, fetch_before, fetch_skip
+        # there might be more changes, continue from oldest change fetched and
+        # try again
+        cursor.fetch_before = fetch_before
+        cursor.fetch_skip = fetch_skip
         gerrit_changes = _do_pull(
             config.hostname(),
             config.username(),
             config.port(),
             config.max_days(),
-            skip)
+            cursor,
+            project,
+            raise_errors)
+
+
+def _pull_and_store(config, sync_state):
+    # decide where the sync starts before fetching, as fetching runs in
+    # another thread that doesn't use the database
+    if not sync_state.fetch_after:
+        _set_fetch_after(config.max_days(), sync_state)
+    # reviewers are looked up for every page stored, cache them for the sync
+    reviewer_cache = ReviewerCache()
+    reviewer_cache.warm()
+    change_count = 0
+
+    def store(page):
+        nonlocal change_count
+        gerrit_changes, fetch_before, fetch_skip = page
+        # update database, along with the sync's cursor so that already
+        # stored changes are skipped by this and any resumed sync
+        with transaction.atomic():
+            database_helper.update(gerrit_changes, reviewer_cache)
+            database_helper.advance_sync(sync_state, fetch_before, fetch_skip)
+        change_count += len(gerrit_changes)
+
+    # pull changes, MAX_CHANGES_FETCH_COUNT at a time, while storing
+    # previously pulled changes. A failed fetch fails the sync, to be resumed
+    # by the next one, rather than finishing it without the older changes
+    pipeline.run([_fetch_pages(config, copy.copy(sync_state),
+                               raise_errors=True)], store)
+
+    logging.info("Fetched a total of %d changes", change_count)
+    reviewer_cache.log_stats()
+    return change_count
+
+
+def _fetch_shard_pages(config, sync_state, project):
+    """Fetch pages of changes for a project, followed by a page without
+    changes marking the end of the project's changes
+
+    :arg GerritFetchConfig config: gerrit server configuration
+    :arg models.SyncState sync_state: sync state for the project
+    :arg str project: name of project to fetch changes for
+    :Yields: tuple of the project's sync state, fetched changes (None once
+        all changes are fetched), and the cursor to continue from
+    """
+    # a failed fetch fails the shard, to be resumed by the next sync, rather
+    # than finishing it without all of its changes
+    for page in _fetch_pages(config, copy.copy(sync_state), project,
+                             raise_errors=True):
+        yield (sync_state,) + page
+    yield sync_state, None, None, None
+
+
+def _pull_and_store_sharded(config, projects):
+    # each project is synced with its own cursor, so that an interrupted sync
+    # resumes each project where it left off
+    shards = []
+    for project in projects:
+        shard_state = database_helper.start_sync(
+            config.hostname(), SyncState.QUERY_MERGED_PROJECT % project)
+        if not shard_state.fetch_after:
+            _set_fetch_after(config.max_days(), shard_state, project)
+        shards.append((project, shard_state))
+    logging.info("Syncing %d projects, %d at a time", len(shards),
+                 config.fetch_concurrency())
+    change_count = _pull_and_store_shards(config, shards,
+                                          config.fetch_concurrency())
+    logging.info("Fetched a total of %d changes for %d projects",
+                 change_count, len(shards))
+    return change_count
+
+
+def _pull_and_store_shards(config, shards, max_workers, shard_stored=None):
+    """Pull and store changes for shards, each with its own sync state
+
+    Pages of changes are fetched for up to max_workers shards at a time, and
+    stored by this thread in the order they were fetched for each shard.
+    Each shard's sync state is finished once all its changes are stored, or
+    if the sync fails.
+
+    :arg GerritFetchConfig config: gerrit server configuration
+    :arg list shards: tuples of project name (None for all projects) and
+        started sync state with the cursor to fetch from
+    :arg int max_workers: maximum number of shards fetched at a time
+    :arg callable shard_stored: called with the sync state of each shard
+        once all its changes are stored
+    :Return: count of changes fetched
+    """
+    reviewer_cache = ReviewerCache()
+    reviewer_cache.warm()
+    # count of changes stored for each shard, by sync state ID
+    shard_change_counts = {}
+    # project of each shard, by sync state ID, whose latest change stored is
+    # the shard's watermark
+    shard_projects = {shard_state.id: project
+                      for project, shard_state in shards}
+
+    def store(page):
+        shard_state, gerrit_changes, fetch_before, fetch_skip = page
+        if gerrit_changes is None:
+            database_helper.finish_sync(
+                shard_state, shard_change_counts.get(shard_state.id, 0),
+                project=shard_projects[shard_state.id])
+            if shard_stored:
+                shard_stored(shard_state)
+            return
+        with transaction.atomic():
+            database_helper.update(gerrit_changes, reviewer_cache)
+            database_helper.advance_sync(shard_state, fetch_before, fetch_skip)
+        shard_change_counts[shard_state.id] = \
+            shard_change_counts.get(shard_state.id, 0) + len(gerrit_changes)
+
+    try:
+        pipeline.run(
+            [_fetch_shard_pages(config, shard_state, project)
+             for project, shard_state in shards],
+            store, max_workers=max_workers)
+    except Exception as err:
+        for _, shard_state in shards:
+            if shard_state.status == SyncState.STATUS_RUNNING:
+                database_helper.finish_sync(
+                    shard_state, shard_change_counts.get(shard_state.id, 0),
+                    err)
+        raise
+    reviewer_cache.log_stats()
+    return sum(shard_change_counts.values())
+
+
+def _get_archive_start(archive_dir, entries):
+    """Return time in UTC of the oldest change in given archived pages
+
+    :arg str archive_dir: directory pages were archived in
+    :arg list entries: pages as returned by archive.read_index()
+    :Return: datetime, None if there are no pages
+    :Raises: OSError if a page without its oldest time indexed can't be read
+    """
+    oldest_timestamps = []
+    for entry in entries:
+        if entry.get('oldest') is None:
+            # indexed before the oldest time was
+            entry['oldest'] = min(
+                float(gerrit_change.last_update_timestamp)
+                for gerrit_change in archive.read_page(archive_dir, entry))
+        oldest_timestamps.append(entry['oldest'])
+    if not oldest_timestamps:
+        return None
+    return database_helper.convert_to_utc_datetime(min(oldest_timestamps))
+
+
+def reprocess_archive(archive_dir, page_stored=None):
+    """Store changes again from pages of merged changes archived, instead of
+    fetching them from gerrit again
+
+    All changes, comments, and reviewers stored are removed, and archived
+    pages are stored in the order they were fetched in, a page at a time so
+    that memory use doesn't depend on the size of the archive. Changes that
+    were fetched more than once are updated with the comments added since.
+    Syncs wait for reprocessing to finish, while leaderboards may show some
+    of the changes until it does.
+
+    Nothing is removed unless the archive's index and pages can be found,
+    and no change stored is older than the oldest change archived, as such
+    changes were stored before pages were archived and wouldn't be fetched
+    again by later syncs.
+
+    :arg str archive_dir: directory pages were archived in
+    :arg callable page_stored: called with the count of pages and the count
+        of changes stored so far, after each page is stored
+    :Return: tuple of count of pages and count of changes stored
+    :Raises: OSError if the archive can't be read, ValueError if changes
+        stored are older than the archive
+    """
+    page_count = 0
+    change_count = 0
+    with lease.hold_when_free(SyncState.QUERY_MERGED):
+        entries = archive.read_index(archive_dir, "merged")
+        archive_start = _get_archive_start(archive_dir, entries)
+        first_stored = database_helper.get_first_synced_change_timestamp()
+        if first_stored and (archive_start is None or
+                             first_stored < archive_start):
+            raise ValueError(
+                "Changes stored since %s are older than the oldest change "
+                "archived in %s, %s" % (first_stored, archive_dir,
+                                        archive_start))
+        database_helper.delete_changes()
+        reviewer_cache = ReviewerCache()
+        try:
+            for entry in entries:
+                gerrit_changes = archive.read_page(archive_dir, entry)
+                database_helper.update(gerrit_changes, reviewer_cache)
+                page_count += 1
+                change_count += len(gerrit_changes)
+                if page_stored:
+                    page_stored(page_count, change_count)
+        finally:
+            # pages stored so far have been committed
+            database_helper.bump_generation()
+    reviewer_cache.log_stats()
+    logging.info("Reprocessed %d archived pages of %d changes", page_count,
+                 change_count)
+    return page_count, change_count
+
+
+def import_dumps(paths, batch_stored=None, max_workers=1):
+    """Store merged changes from files of gerrit query output, instead of
+    fetching them from gerrit
+
+    Files are read in up to max_workers background threads while changes
+    read are stored a batch at a time, each batch in its own transaction, so
+    that memory use doesn't depend on the size of the files. Changes already
+    stored are skipped, unless they have more comments than stored. Syncs
+    wait for imports to finish.
+
+    :arg list paths: files of gerrit query JSON output
+    :arg callable batch_stored: called with the count of changes and the
+        count of comments read so far, after each batch is stored
+    :arg int max_workers: maximum number of files read at a time
+    :Return: tuple of count of changes and count of comments read
+    :Raises: OSError if a file can't be read
+    """
+    change_count = 0
+    comment_count = 0
+    reviewer_cache = ReviewerCache()
+
+    def store(gerrit_changes):
+        nonlocal change_count, comment_count
+        database_helper.update(gerrit_changes, reviewer_cache)
+        change_count += len(gerrit_changes)
+        comment_count += sum(len(gerrit_change.comments)
+                             for gerrit_change in gerrit_changes)
+        if batch_stored:
+            batch_stored(change_count, comment_count)
+
+    with lease.hold_when_free(SyncState.QUERY_MERGED):
+        try:
+            pipeline.run([dump.read_changes(path) for path in paths], store,
+                         max_workers=max_workers)
+        finally:
+            # batches stored so far have been committed
+            database_helper.bump_generation()
+    reviewer_cache.log_stats()
+    logging.info("Imported %d changes with %d comments from %d files",
+                 change_count, comment_count, len(paths))
+    return change_count, comment_count
+
+
+def get_backfill_windows(since, until, slice_days):
+    """Split time range into windows of slice_days days each, newest first
+
+    :arg datetime.date since: first day of range
+    :arg datetime.date until: day after last day of range
+    :arg int slice_days: number of days in each window
+    :Return: list of tuples of first day of window and day after last day
+        of window
+    """
+    windows = []
+    window_end = until
+    while window_end > since:
+        window_start = max(since, window_end - timedelta(days=slice_days))
+        windows.append((window_start, window_end))
+        window_end = window_start
+    return windows
+
+
+def backfill_changes(since, until, slice_days, max_workers,
+                     window_stored=None):
+    """Pull and store changes last updated in given time range
+
+    The range is split into windows of slice_days days, and changes are
+    pulled for up to max_workers windows at a time. Each window has its own
+    sync state, so that a backfill that fails part way can be run again to
+    continue it, skipping windows already stored and resuming windows in
+    progress where they left off. Syncs wait for backfills to finish, and
+    backfills wait for syncs.
+
+    :arg datetime.date since: first day to pull changes for
+    :arg datetime.date until: day after last day to pull changes for
+    :arg int slice_days: number of days of changes in each window
+    :arg int max_workers: maximum number of windows pulled at a time
+    :arg callable window_stored: called with the sync state of each window
+        once all its changes are stored, and the number of windows being
+        pulled
+    :Return: tuple of count of changes fetched and count of windows already
+        stored by an earlier backfill
+    """
+    with lease.hold_when_free(SyncState.QUERY_MERGED):
+        return _backfill_changes(since, until, slice_days, max_workers,
+                                 window_stored)
+
+
+def _backfill_changes(since, until, slice_days, max_workers, window_stored):
+    config = GerritFetchConfig()
+    shards = []
+    stored_count = 0
+    for window_start, window_end in get_backfill_windows(since, until,
+                                                         slice_days):
+        query_type = SyncState.QUERY_BACKFILL % (window_start, window_end)
+        if database_helper.is_sync_succeeded(config.hostname(), query_type):
+            stored_count += 1
+            continue
+        window_state = database_helper.start_sync(config.hostname(),
+                                                  query_type)
+        if not window_state.fetch_after:
+            # 'after' has day granularity, 'before' is the start of the day
+            # after the window
+            window_state.fetch_after = datetime.combine(window_start,
+                                                        datetime.min.time())
+            window_state.fetch_before = datetime.combine(window_end,
+                                                         datetime.min.time())
+            window_state.fetch_skip = 0
+            window_state.save()
+        shards.append((None, window_state))
+    logging.info("Backfilling %d windows of %d days, %d at a time, %d "
+                 "windows already stored", len(shards), slice_days,
+                 max_workers, stored_count)
+
+    def shard_stored(window_state):
+        if window_stored:
+            window_stored(window_state, len(shards))
 
-    logging.info("Fetched a total of %d changes", skip)
+    change_count = _pull_and_store_shards(config, shards, max_workers,
+                                          shard_stored)
+    logging.info("Backfilled a total of %d changes", change_count)
+    return change_count, stored_count
@@ -0,0 +1,181 @@
+"""Database backed leases, so that only one sync of a type runs at a time
+across all web and sync processes
+
+A lease is taken with a single conditional update, which only succeeds if
+the lease is free or has expired, so processes racing for it can't both get
+it. The holder renews it from a heartbeat thread while it syncs.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.db import DatabaseError, IntegrityError, connection, \
+    transaction
+from django.db.models import Q
+
+from ..models import SyncLease
+
+# time a lease is held for unless renewed
+LEASE_DURATION = timedelta(minutes=2)
+# seconds between renewals of a lease held
+HEARTBEAT_INTERVAL = 30
+# seconds between checks of whether a lease has been released, while waiting
+# for it
+POLL_INTERVAL = 1
+
+
+def get_holder():
+    """Return identifier of the current thread as a lease holder
+
+    :Returns: str of hostname, process ID, and thread ID
+    """
+    return "%s:%d:%d" % (socket.gethostname(), os.getpid(),
+                         threading.current_thread().ident)
+
+
+def acquire(name, holder, duration=LEASE_DURATION):
+    """Take lease with given name, if it is free, expired, or already held by
+    holder
+
+    :arg str name: name of lease
+    :arg str holder: identifier of holder, see get_holder()
+    :arg datetime.timedelta duration: time to hold the lease for
+    :Returns: True if the lease was taken, False if someone else holds it
+    """
+    now = datetime.utcnow()
+    try:
+        with transaction.atomic():
+            if SyncLease.objects.filter(name=name).filter(
+                    Q(expires__isnull=True) | Q(expires__lt=now) |
+                    Q(holder=holder)).update(holder=holder,
+                                             expires=now + duration):
+                return True
+            SyncLease.objects.create(name=name, holder=holder,
+                                     expires=now + duration)
+    except IntegrityError:
+        # created by someone else since
+        return False
+    except DatabaseError as err:
+        # e.g. sqlite's database is locked by someone else taking or
+        # renewing the lease at the same time
+        logging.warning("Unable to take %s lease for %s: %s", name, holder,
+                        err)
+        return False
+    return True
+
+
+def renew(name, holder, duration=LEASE_DURATION):
+    """Extend lease with given name held by holder
+
+    :arg str name: name of lease
+    :arg str holder: identifier of holder, see get_holder()
+    :arg datetime.timedelta duration: time to hold the lease for from now
+    :Returns: True if renewed, False if the lease is no longer held by holder
+    """
+    return bool(SyncLease.objects.filter(name=name, holder=holder).update(
+        expires=datetime.utcnow() + duration))
+
+
+def release(name, holder):
+    """Give up lease with given name, if held by holder
+
+    :arg str name: name of lease
+    :arg str holder: identifier of holder, see get_holder()
+    """
+    SyncLease.objects.filter(name=name, holder=holder).update(holder="",
+                                                              expires=None)
+
+
+def is_held(name):
+    """Return whether lease with given name is held and hasn't expired
+
+    :arg str name: name of lease
+    :Returns: bool
+    """
+    return SyncLease.objects.filter(name=name,
+                                    expires__gte=datetime.utcnow()).exists()
+
+
+def wait_for_release(name):
+    """Wait until lease with given name is released or expires
+
+    :arg str name: name of lease
+    """
+    while True:
+        try:
+            with transaction.atomic():
+                if not is_held(name):
+                    return
+        except DatabaseError as err:
+            # e.g. sqlite's database is locked by the holder renewing or
+            # releasing the lease, checked again after the poll interval
+            logging.debug("Unable to check %s lease: %s", name, err)
+        time.sleep(POLL_INTERVAL)
+
+
+def _heartbeat(name, holder, stopped):
+    try:
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                renewed = renew(name, holder)
+            except DatabaseError as err:
+                # e.g. sqlite's database is locked while a page of changes is
+                # being stored, the lease is held for long enough to retry
+                logging.warning("Unable to renew %s lease held by %s, "
+                                "retrying in %d seconds: %s", name, holder,
+                                HEARTBEAT_INTERVAL, err)
+                continue
+            if not renewed:
+                logging.warning("Lost %s lease held by %s", name, holder)
+                return
+    finally:
+        # the thread's database connection isn't closed by a request ending
+        connection.close()
+
+
+@contextmanager
+def hold(name):
+    """Hold lease with given name while the block runs, if it can be taken
+
+    The lease is renewed every HEARTBEAT_INTERVAL seconds in a background
+    thread, and released when the block exits.
+
+    :arg str name: name of lease
+    :Yields: True if the lease was taken, False if someone else holds it, in
+        which case the block should not do the work the lease is for
+    """
+    holder = get_holder()
+    if not acquire(name, holder):
+        yield False
+        return
+    stopped = threading.Event()
+    thread = threading.Thread(target=_heartbeat,
+                              args=(name, holder, stopped),
+                              name="leaderboard-lease-heartbeat",
+                              daemon=True)
+    thread.start()
+    try:
+        yield True
+    finally:
+        stopped.set()
+        thread.join()
+        release(name, holder)
+
+
+@contextmanager
+def hold_when_free(name):
+    """Hold lease with given name while the block runs, waiting for it to be
+    released first if someone else holds it
+
+    :arg str name: name of lease
+    """
+    while True:
+        with hold(name) as acquired:
+            if acquired:
+                yield
+                return
+        wait_for_release(name)
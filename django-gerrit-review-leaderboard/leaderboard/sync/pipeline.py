@@ -0,0 +1,104 @@
+"""Pipeline for fetching pages of changes from gerrit in background threads
+while a single writer stores them in the database, so that waiting on gerrit
+overlaps with database writes
+"""
+import logging
+import queue
+import threading
+
+# maximum number of fetched pages waiting to be stored, after which fetching
+# waits for the writer to catch up
+DEFAULT_QUEUE_SIZE = 4
+# seconds to wait at a time for space in a full queue before checking whether
+# the pipeline has been stopped
+_PUT_TIMEOUT = 0.5
+
+
+class _Done:
+    """Put in the queue by a fetch thread when it has no more pages"""
+
+
+class _Failure:
+    """Put in the queue by a fetch thread when fetching fails"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _fetch_streams(streams, pages, stop):
+    """Put pages from each stream in pages queue until there are no more
+    streams or the pipeline is stopped
+
+    :arg queue.Queue streams: queue of iterables of pages
+    :arg queue.Queue pages: bounded queue of pages for the writer
+    :arg threading.Event stop: set when the pipeline is stopped
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        while not stop.is_set():
+            try:
+                stream = streams.get_nowait()
+            except queue.Empty:
+                break
+            for page in stream:
+                if not put(page):
+                    return
+    except Exception as err:
+        logging.exception("Fetching changes failed")
+        put(_Failure(err))
+        return
+    put(_Done())
+
+
+def run(streams, write, max_workers=1, queue_size=DEFAULT_QUEUE_SIZE):
+    """Fetch pages from streams in background threads and write them
+
+    Each stream is an iterable of pages, which is iterated over (fetching
+    from gerrit) in one of max_workers threads. Pages are passed to write()
+    one at a time in the calling thread, in the order they were fetched in
+    for each stream. At most queue_size pages are kept waiting to be
+    written. If fetching or writing fails, all threads are stopped after
+    their current fetch and the error is raised.
+
+    :arg list streams: iterables of pages to fetch
+    :arg callable write: called with each page fetched
+    :arg int max_workers: maximum number of streams fetched at a time
+    :arg int queue_size: maximum number of pages waiting to be written
+    :Raises: any exception raised fetching or writing pages
+    """
+    stream_queue = queue.Queue()
+    for stream in streams:
+        stream_queue.put(stream)
+    worker_count = max(1, min(max_workers, stream_queue.qsize()))
+    pages = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=_fetch_streams,
+                         args=(stream_queue, pages, stop),
+                         name="leaderboard-fetch-%d" % index, daemon=True)
+        for index in range(worker_count)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        done_count = 0
+        while done_count < worker_count:
+            page = pages.get()
+            if isinstance(page, _Done):
+                done_count += 1
+            elif isinstance(page, _Failure):
+                raise page.error
+            else:
+                write(page)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,90 @@
+"""In-process cache of reviewer IDs used when storing fetched changes, so that
+reviewers don't need to be looked up in the database for every page of
+changes
+"""
+from collections import OrderedDict
+import logging
+
+from ..models import Reviewer
+
+# maximum number of reviewers cached, which is far more than the number of
+# active reviewers on most gerrit servers
+DEFAULT_MAX_SIZE = 10000
+
+
+def normalize_reviewer_name(reviewer_name):
+    """Return reviewer name with surrounding and repeated whitespace removed
+
+    :arg str reviewer_name: reviewer name from gerrit
+    :Returns: normalized reviewer name
+    """
+    return " ".join(reviewer_name.split())
+
+
+class ReviewerCache:
+    """Least recently used map of normalized reviewer names to reviewer IDs
+
+    Keeps count of lookups that found a reviewer (hits) and that didn't
+    (misses).
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self._max_size = max_size
+        self._reviewer_ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._reviewer_ids)
+
+    def warm(self):
+        """Load the most recently created reviewers from the database, up to
+        the maximum cache size
+        """
+        reviewers = Reviewer.objects.order_by('-id').values_list(
+            'full_name', 'id')[:self._max_size]
+        # add oldest first so that the newest are least likely to be evicted
+        for reviewer_name, reviewer_id in reversed(list(reviewers)):
+            self.add(reviewer_name, reviewer_id)
+        logging.info("Loaded %d reviewers into reviewer cache", len(self))
+
+    def get(self, reviewer_name):
+        """Return ID of reviewer with given name if cached
+
+        :arg str reviewer_name: reviewer name
+        :Returns: reviewer ID, None if reviewer isn't cached
+        """
+        key = normalize_reviewer_name(reviewer_name)
+        reviewer_id = self._reviewer_ids.get(key)
+        if reviewer_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._reviewer_ids.move_to_end(key)
+        return reviewer_id
+
+    def add(self, reviewer_name, reviewer_id):
+        """Cache ID of reviewer with given name, evicting the least recently
+        used reviewer if the cache is full
+
+        :arg str reviewer_name: reviewer name
+        :arg int reviewer_id: reviewer's database ID
+        """
+        key = normalize_reviewer_name(reviewer_name)
+        self._reviewer_ids[key] = reviewer_id
+        self._reviewer_ids.move_to_end(key)
+        if len(self._reviewer_ids) > self._max_size:
+            self._reviewer_ids.popitem(last=False)
+
+    def discard(self, reviewer_names):
+        """Remove reviewers with given names from the cache, if cached
+
+        :arg iterable reviewer_names: reviewer names
+        """
+        for reviewer_name in reviewer_names:
+            self._reviewer_ids.pop(normalize_reviewer_name(reviewer_name),
+                                   None)
+
+    def log_stats(self):
+        logging.info("Reviewer cache: %d reviewers, %d hits, %d misses",
+                     len(self), self.hits, self.misses)
@@ -2,21 +2,64 @@
 Tests, including a 'system' test that when pointed to a gerrit server, fetches
 changes, stores them, and then dumps database into a JSON file
 """
-from datetime import datetime, timedelta
-from django.test import TestCase
+import calendar
+import copy
+from datetime import date, datetime, timedelta
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, DatabaseError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 import time
+from unittest import skipUnless
 
 from pygerrit.models import Account
 from pygerrit.models import Change as GerritChange
 from pygerrit.models import Comment as GerritComment
+from pygerrit.error import GerritError
 
+from . import range_index
 from . import views
+from . gerrit_handler import archive
+from . gerrit_handler import connection as gerrit_connection
+from . gerrit_handler import dump
+from . gerrit_handler import fetch
+from . config_handler.config import GerritFetchConfig
 from . current_load import current_load_fetcher
+from . current_load import database_helper as current_load_database_helper
+from . current_load import open_load_cache
 from . models import Change
 from . models import Comment
+from . models import DataGeneration
+from . models import OpenChange
+from . models import OpenReviewerLoad
+from . models import Project
 from . models import Reviewer
+from . models import ReviewerDailyStats
+from . models import SyncState
 from . sync import database_helper
+from . sync import events
 from . sync import fetcher
+from . sync import lease
+from . sync import pipeline
+from . sync.reviewer_cache import ReviewerCache
+
+
+# cache used by tests instead of the file based cache shared with the site
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 
 
 def dump_db(file_name="dbdump.txt"):
@@ -55,7 +98,8 @@ class TestDatabaseHelper(TestCase):
             timestamp = database_helper.convert_to_utc_datetime(str(now + i))
             latest_ts = timestamp
             change = Change(
-                timestamp=timestamp, change_id="test_change_id_%d" % i)
+                timestamp=timestamp, change_id="test_change_id_%d" % i,
+                project=Project.objects.get_or_create(name="foo")[0])
             change.save()
 
         last_synced_ts = database_helper.get_last_synced_change_timestamp()
@@ -198,7 +242,7 @@ class TestDatabaseHelper(TestCase):
                                                       timestamp_datetime))
         self.assertEqual(change.owner_full_name, self.OWNER)
         self.assertEqual(change.subject, self.SUBJECT)
-        self.assertEqual(change.project_name, self.PROJECT)
+        self.assertEqual(change.project.name, self.PROJECT)
         self.assertEqual(change.change_id, change_id)
         # check comment associated with reviewer
         comments = reviewer.comments.all()
@@ -270,6 +314,224 @@ class TestDatabaseHelper(TestCase):
             [["Jungle Boy", 2, 2], ["City Girl", 1, 2], ["Foo Bar", 2, 2],
              ["Mad Dog", 1, 1]], 3)
 
+    def test_update_queries_independent_of_comments(self):
+        """Test that storing changes takes the same number of queries
+        regardless of how many comments and reviewers they have"""
+        few_comments_changes = [
+            self._make_gerrit_change_with_comments(
+                change_id="few_%d" % index, reviewers=["Jungle Boy"])
+            for index in range(10)]
+        many_comments_changes = [
+            self._make_gerrit_change_with_comments(
+                change_id="many_%d" % index,
+                reviewers=["Reviewer %d" % reviewer for reviewer in range(20)])
+            for index in range(10)]
+        # both pages find their project already stored
+        Project.objects.create(name=self.PROJECT)
+        with CaptureQueriesContext(connection) as few_comments_queries:
+            database_helper.update(few_comments_changes)
+        with CaptureQueriesContext(connection) as many_comments_queries:
+            database_helper.update(many_comments_changes)
+        self.assertEqual(len(few_comments_queries),
+                         len(many_comments_queries))
+        self._assert_reviewer_change_comments_counts(21, 20, 210)
+
+    def test_update_projects_stored_once(self):
+        """Test that changes of the same project share one project row"""
+        database_helper.update([
+            self._make_gerrit_change_with_comments(
+                change_id="change_id_%d" % index, reviewers=["Jungle Boy"])
+            for index in range(3)])
+        database_helper.update([self._make_gerrit_change_with_comments(
+            change_id="change_id_3", reviewers=["Jungle Boy"])])
+        self.assertEqual(Project.objects.count(), 1)
+        self.assertEqual(
+            Change.objects.filter(project__name=self.PROJECT).count(), 4)
+        self.assertEqual(list(database_helper.get_project_names()),
+                         [self.PROJECT])
+
+    def test_update_only_existing_changes_queries(self):
+        """Test that a page of changes that all already exist costs a query
+        per chunk of changes, not a query per change"""
+        gerrit_changes = [
+            self._make_gerrit_change_with_comments(
+                change_id="change_id_%d" % index, reviewers=["Jungle Boy"])
+            for index in range(database_helper.MAX_LOOKUP_COUNT + 1)]
+        database_helper.update(gerrit_changes)
+        with self.assertNumQueries(2):
+            database_helper.update(gerrit_changes)
+        with self.assertNumQueries(1):
+            database_helper.update(gerrit_changes[:10])
+        self._assert_reviewer_change_comments(
+            [["Jungle Boy", len(gerrit_changes), len(gerrit_changes)]],
+            len(gerrit_changes))
+
+    def test_update_with_reviewer_cache(self):
+        """Test that reviewers are resolved from a warmed reviewer cache
+        without querying the database"""
+        self.test_update_initial_2changes_6comments_3reviewers()
+        reviewer_cache = ReviewerCache()
+        reviewer_cache.warm()
+        self.assertEqual(len(reviewer_cache), 3)
+        gerrit_change = self._make_gerrit_change_with_comments(
+            change_id="change_id3", reviewers=["Jungle Boy", " City  Girl "])
+        with CaptureQueriesContext(connection) as queries:
+            database_helper.update([gerrit_change], reviewer_cache)
+        self.assertFalse(
+            [query for query in queries
+             if 'FROM "leaderboard_reviewer" ' in query['sql']],
+            "Reviewers should not have been looked up")
+        self.assertEqual(reviewer_cache.hits, 2)
+        self.assertEqual(reviewer_cache.misses, 0)
+        # a new reviewer is looked up once and then cached
+        gerrit_change = self._make_gerrit_change_with_comments(
+            change_id="change_id4", reviewers=["Mad Dog"])
+        database_helper.update([gerrit_change], reviewer_cache)
+        self.assertEqual(reviewer_cache.misses, 1)
+        self.assertEqual(len(reviewer_cache), 4)
+        self._assert_reviewer_change_comments(
+            [["Jungle Boy", 2, 2], ["City Girl", 2, 3], ["Foo Bar", 2, 2],
+             ["Mad Dog", 1, 1]], 4)
+
+    def test_update_rolled_back_with_reviewer_cache(self):
+        """Test that reviewers created by an update that is rolled back
+        aren't used from the reviewer cache by later updates"""
+        reviewer_cache = ReviewerCache()
+        gerrit_change = self._make_gerrit_change_with_comments(
+            change_id="change_id1", reviewers=["Mad Dog"])
+        saved_add_daily_stats = database_helper._add_daily_stats
+
+        def _failing_add_daily_stats(daily_counts):
+            raise DatabaseError("database is locked")
+        database_helper._add_daily_stats = _failing_add_daily_stats
+        try:
+            with self.assertRaises(DatabaseError):
+                database_helper.update([gerrit_change], reviewer_cache)
+        finally:
+            database_helper._add_daily_stats = saved_add_daily_stats
+        self.assertEqual(Reviewer.objects.count(), 0)
+        self.assertIsNone(reviewer_cache.get("Mad Dog"))
+        database_helper.update([gerrit_change], reviewer_cache)
+        self._assert_reviewer_change_comments([["Mad Dog", 1, 1]], 1)
+        self.assertEqual(
+            ReviewerDailyStats.objects.get().reviewer.full_name, "Mad Dog")
+
+    def test_generation_bumped_by_sync(self):
+        self.assertEqual(0, database_helper.get_generation())
+        for query_type in [SyncState.QUERY_MERGED, SyncState.QUERY_OPEN,
+                           SyncState.QUERY_MERGED_PROJECT % "foo"]:
+            sync_state = database_helper.start_sync("gerrit.myhost.com",
+                                                    query_type)
+            database_helper.finish_sync(sync_state, 1)
+        # open changes aren't counted in leaderboards
+        self.assertEqual(2, database_helper.get_generation())
+        sync_state = database_helper.start_sync("gerrit.myhost.com")
+        database_helper.finish_sync(sync_state, 1, GerritError("failed"))
+        self.assertEqual(3, database_helper.get_generation())
+
+    def _get_daily_stats(self):
+        return sorted(ReviewerDailyStats.objects.values_list(
+            'reviewer__full_name', 'project__name', 'day', 'review_count',
+            'comment_count'))
+
+    def test_update_daily_stats(self):
+        """Test that daily stats are added to as changes are stored, and
+        match daily stats rebuilt from the changes stored"""
+        now = time.time()
+        yesterday = str(now - 24 * 60 * 60)
+        self.test_update_initial_2changes_6comments_3reviewers()
+        gerrit_change = self._make_gerrit_change_with_comments(
+            change_id="change_id3", timestamp=yesterday,
+            reviewers=["Jungle Boy", "Jungle Boy", "Mad Dog"])
+        database_helper.update([gerrit_change])
+        today = database_helper.convert_to_utc_datetime(str(now)).date()
+        yesterday = database_helper.convert_to_utc_datetime(yesterday).date()
+        # changes are counted on the day they were updated, comments on the
+        # day they were posted
+        expected_daily_stats = sorted([
+            ("City Girl", self.PROJECT, today, 1, 2),
+            ("Foo Bar", self.PROJECT, today, 2, 2),
+            ("Jungle Boy", self.PROJECT, today, 1, 3),
+            ("Jungle Boy", self.PROJECT, yesterday, 1, 0),
+            ("Mad Dog", self.PROJECT, today, 0, 1),
+            ("Mad Dog", self.PROJECT, yesterday, 1, 0),
+        ])
+        self.assertEqual(expected_daily_stats, self._get_daily_stats())
+        self.assertEqual(6, database_helper.rebuild_daily_stats())
+        self.assertEqual(expected_daily_stats, self._get_daily_stats())
+
+    def test_rebuild_rollups_waits_for_sync(self):
+        self.test_update_initial_2changes_6comments_3reviewers()
+        generation = database_helper.get_generation()
+        generations = []
+
+        def sleep(seconds):
+            # daily stats rebuilt while the sync holds the lease
+            generations.append(database_helper.get_generation())
+            lease.release(SyncState.QUERY_MERGED, "sync")
+        self.assertTrue(lease.acquire(SyncState.QUERY_MERGED, "sync"))
+        saved_time = lease.time
+        lease.time = type("Time", (), {"sleep": staticmethod(sleep)})
+        output = io.StringIO()
+        try:
+            call_command('leaderboard_rebuild_rollups', stdout=output)
+        finally:
+            lease.time = saved_time
+        self.assertEqual(generations, [generation])
+        self.assertEqual(database_helper.get_generation(), generation + 1)
+        self.assertIn("Rebuilt", output.getvalue())
+        self.assertFalse(lease.is_held(SyncState.QUERY_MERGED))
+
+    def test_update_comments_added_after_merge(self):
+        """Test that a change fetched again with more comments only has the
+        comments not stored yet added, and that its reviews move to the day
+        it was last updated"""
+        now = time.time()
+        yesterday = str(now - 24 * 60 * 60)
+        comments = [self._make_gerrit_comment("Jungle Boy")]
+        comments[0].timestamp = yesterday
+        gerrit_change = self._make_gerrit_change(yesterday, "change_id1",
+                                                 comments)
+        database_helper.update([gerrit_change])
+        # commented on again today, after it was merged
+        gerrit_change.last_update_timestamp = str(now)
+        gerrit_change.comments = comments + [
+            self._make_gerrit_comment("Jungle Boy"),
+            self._make_gerrit_comment("Mad Dog")]
+        database_helper.update([gerrit_change])
+        self._assert_reviewer_change_comments(
+            [["Jungle Boy", 1, 2], ["Mad Dog", 1, 1]], 1)
+        change = Change.objects.get()
+        self.assertEqual(change.comment_count, 3)
+        self.assertEqual(change.timestamp,
+                         database_helper.convert_to_utc_datetime(str(now)))
+        today = database_helper.convert_to_utc_datetime(str(now)).date()
+        yesterday = database_helper.convert_to_utc_datetime(yesterday).date()
+        expected_daily_stats = sorted([
+            ("Jungle Boy", self.PROJECT, today, 1, 1),
+            ("Jungle Boy", self.PROJECT, yesterday, 0, 1),
+            ("Mad Dog", self.PROJECT, today, 1, 1),
+        ])
+        self.assertEqual(expected_daily_stats, self._get_daily_stats())
+        database_helper.rebuild_daily_stats()
+        self.assertEqual(expected_daily_stats, self._get_daily_stats())
+        # fetching it again costs just the lookup
+        with self.assertNumQueries(1):
+            database_helper.update([gerrit_change])
+        self.assertEqual(Comment.objects.count(), 3)
+
+    def test_reviewer_cache_evicts_least_recently_used(self):
+        reviewer_cache = ReviewerCache(max_size=2)
+        reviewer_cache.add("Jungle Boy", 1)
+        reviewer_cache.add("City Girl", 2)
+        self.assertEqual(reviewer_cache.get("Jungle Boy"), 1)
+        reviewer_cache.add("Foo Bar", 3)
+        self.assertIsNone(reviewer_cache.get("City Girl"))
+        self.assertEqual(reviewer_cache.get("Jungle Boy"), 1)
+        self.assertEqual(reviewer_cache.get("Foo Bar"), 3)
+        self.assertEqual(reviewer_cache.hits, 3)
+        self.assertEqual(reviewer_cache.misses, 1)
+
 
 class TestFetcher(TestCase):
     """ Tests that the initial fetch is based on any existing change's
@@ -292,8 +554,11 @@ class TestFetcher(TestCase):
     fetch_count = 0
     # to keep tab of skip params used for multiple fetch changes testing
     skip_params_used = []
+    # to keep tab of before params used for multiple fetch changes testing
+    before_params_used = []
 
-    def _mock_fetch(self, hostname, username, datetime_utc, port, skip):
+    def _mock_fetch(self, hostname, username, datetime_utc, port, skip,
+                    before_datetime_utc, project=None, raise_errors=False):
         """Mocks fetch.fetch_changes()
         """
         self.found_hostname = hostname
@@ -304,15 +569,23 @@ class TestFetcher(TestCase):
         if self.multiple_fetch_changes:
             # store for validation by test
             self.skip_params_used.append(skip)
+            self.before_params_used.append(before_datetime_utc)
             # testing looped fetch of changes
             self.fetch_count += 1
             # return a set of changes
-            return self.multiple_fetch_changes[self.fetch_count - 1]
+            page = self.multiple_fetch_changes[self.fetch_count - 1]
+            if isinstance(page, Exception):
+                # a failed fetch
+                if raise_errors:
+                    raise page
+                return []
+            return page
         else:
             # testing just a single fetch' change
             return self.FAKE_CHANGES
 
-    def _mock_database_helper_update(self, gerrit_changes):
+    def _mock_database_helper_update(self, gerrit_changes,
+                                     reviewer_cache=None):
         pass
 
     def setUp(self):
@@ -322,8 +595,10 @@ class TestFetcher(TestCase):
         # mock out database helper update
         self.saved_database_helper_update = fetcher.database_helper.update
         fetcher.database_helper.update = self._mock_database_helper_update
-        # reset any previous fetches and continuations
-        fetcher.fetch_after_datetime_utc = None
+        # don't share looped fetch state between tests
+        self.skip_params_used = []
+        self.before_params_used = []
+        self.fetch_count = 0
 
     def tearDown(self):
         # unmock gerrit fetch
@@ -336,7 +611,8 @@ class TestFetcher(TestCase):
         expected_datetime_utc_str = expected_datetime_utc.strftime(
             '%Y-%m-%d %H:%M:%S')
         fake_change = fetcher._do_pull(self.HOST_NAME, self.USER_NAME,
-                                       self.PORT, self.MAX_DAYS, 0)
+                                       self.PORT, self.MAX_DAYS,
+                                       SyncState(hostname=self.HOST_NAME))
         self.assertEqual(self.found_hostname, self.HOST_NAME,
                          "Expected %s, found %s" % (self.HOST_NAME,
                                                     self.found_hostname))
@@ -369,13 +645,15 @@ class TestFetcher(TestCase):
         ten_days_ago_datetime_utc = datetime.utcnow() - timedelta(days=10)
         change = Change(
             timestamp=ten_days_ago_datetime_utc,
-            change_id="test_change_id_1")
+            change_id="test_change_id_1",
+            project=Project.objects.get_or_create(name="foo")[0])
         change.save()
         # a change 20 days ago (earlier change)
         twenty_days_ago_datetime_utc = datetime.utcnow() - timedelta(days=20)
         change = Change(
             timestamp=twenty_days_ago_datetime_utc,
-            change_id="test_change_id_2")
+            change_id="test_change_id_2",
+            project=Project.objects.get_or_create(name="foo")[0])
         change.save()
         # assert that fetch is done using latest change which is 10 days ago
         self._assert_fetch_params(ten_days_ago_datetime_utc)
@@ -390,7 +668,8 @@ class TestFetcher(TestCase):
             timedelta(days=1)
         change = Change(
             timestamp=more_than_max_days_ago_utc,
-            change_id="test_change_id_3")
+            change_id="test_change_id_3",
+            project=Project.objects.get_or_create(name="foo")[0])
         change.save()
 
         self._assert_fetch_params(max_days_ago_datetime_utc)
@@ -412,48 +691,917 @@ class TestFetcher(TestCase):
                 (index + 1, self.skip_params_used[index],
                  expected_skip_params[index]))
 
+    def _make_fake_change_pages(self, page_sizes):
+        """Return pages of fake changes with the given number of changes each,
+        the first page having the newest changes, each a second older than
+        the previous one
+        """
+        timestamp = int(time.time())
+        pages = []
+        for page_size in page_sizes:
+            page = []
+            for _ in range(page_size):
+                gerrit_change = GerritChange([])
+                gerrit_change.last_update_timestamp = str(timestamp)
+                page.append(gerrit_change)
+                timestamp -= 1
+            pages.append(page)
+        return pages
+
+    def _assert_before_params_used(self, pages):
+        """Assert each fetch after the first used the oldest change of the
+        previous page as 'before' param
+        """
+        self.assertIsNone(self.before_params_used[0])
+        for index, page in enumerate(pages[:-1]):
+            expected_before = database_helper.convert_to_utc_datetime(
+                page[-1].last_update_timestamp)
+            self.assertEqual(self.before_params_used[index + 1],
+                             expected_before)
+
     def test_looping_fetch(self):
-        """Test that fetcher fetches all changes with queries that skip any
-        changes already fetched
+        """Test that fetcher fetches all changes with queries that continue
+        from the oldest change already fetched
         """
         # mock return of one set of changes, followed by an empty set
-        self.multiple_fetch_changes = [range(0, 100), []]
+        self.multiple_fetch_changes = self._make_fake_change_pages([100, 0])
         fetcher.pull_and_store_changes()
-        self._assert_skip_params_used([0, 100])
+        self._assert_skip_params_used([0, 1])
+        self._assert_before_params_used(self.multiple_fetch_changes)
 
-        # reset skip params, fetch count
+        # reset skip and before params, fetch count
         self.skip_params_used = []
+        self.before_params_used = []
         self.fetch_count = 0
         # test fetch returns of 500, 500, 100 and then nothing
-        self.multiple_fetch_changes = [range(0, 500), range(0, 500),
-                                       range(0, 100), []]
+        self.multiple_fetch_changes = self._make_fake_change_pages(
+            [500, 500, 100, 0])
+        fetcher.pull_and_store_changes()
+        self._assert_skip_params_used([0, 1, 1, 1])
+        self._assert_before_params_used(self.multiple_fetch_changes)
+
+    def test_sync_state_recorded(self):
+        """Test that the outcome of a sync is recorded in the database"""
+        self.multiple_fetch_changes = self._make_fake_change_pages([100, 0])
+        change_count = fetcher.pull_and_store_changes()
+        self.assertEqual(change_count, 100)
+        sync_state = database_helper.get_last_sync_state()
+        self.assertEqual(sync_state.status, SyncState.STATUS_SUCCEEDED)
+        self.assertEqual(sync_state.change_count, 100)
+        self.assertIsNotNone(sync_state.finished)
+
+    def test_failed_sync_state_recorded(self):
+        def _failing_update(gerrit_changes, reviewer_cache=None):
+            raise ValueError("Bad change")
+        fetcher.database_helper.update = _failing_update
+        self.multiple_fetch_changes = self._make_fake_change_pages([1, 0])
+        with self.assertRaises(ValueError):
+            fetcher.pull_and_store_changes()
+        sync_state = database_helper.get_last_sync_state()
+        self.assertEqual(sync_state.status, SyncState.STATUS_FAILED)
+        self.assertEqual(sync_state.message, "Bad change")
+
+    def test_failed_fetch_sync_state_recorded(self):
+        """Test that a fetch failing part way fails the sync, keeping its
+        cursor so that the changes left are fetched by the next sync"""
+        pages = self._make_fake_change_pages([500, 500])
+        self.multiple_fetch_changes = [pages[0],
+                                       GerritError("Connection lost")]
+        with self.assertRaises(GerritError):
+            fetcher.pull_and_store_changes()
+        sync_state = database_helper.get_last_sync_state()
+        self.assertEqual(sync_state.status, SyncState.STATUS_FAILED)
+        self.assertEqual(sync_state.message, "Connection lost")
+        self.assertIsNotNone(sync_state.fetch_after)
+        self.assertEqual(sync_state.fetch_before,
+                         database_helper.convert_to_utc_datetime(
+                             pages[0][-1].last_update_timestamp))
+        self.assertEqual(sync_state.fetch_skip, 1)
+        self.assertIsNone(sync_state.watermark)
+
+    def test_do_pull_with_watermark(self):
+        """Test that the last successful sync's watermark is used as start
+        for fetching changes"""
+        five_days_ago_datetime_utc = datetime.utcnow() - timedelta(days=5)
+        change = Change(
+            timestamp=datetime.utcnow() - timedelta(days=10),
+            change_id="test_change_id_1",
+            project=Project.objects.get_or_create(name="foo")[0])
+        change.save()
+        sync_state = SyncState(hostname=self.HOST_NAME,
+                               watermark=five_days_ago_datetime_utc)
+        fetcher._do_pull(self.HOST_NAME, self.USER_NAME, self.PORT,
+                         self.MAX_DAYS, sync_state)
+        self.assertEqual(
+            self.found_datetime_str,
+            five_days_ago_datetime_utc.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def test_interrupted_sync_resumed(self):
+        """Test that a sync interrupted part way continues from the last
+        stored page, and that a completed sync resets the cursor"""
+        update_count = [0]
+
+        def _update_failing_second_page(gerrit_changes, reviewer_cache=None):
+            # pages are fetched ahead of being stored, so count stored pages
+            update_count[0] += 1
+            if update_count[0] == 2:
+                raise ValueError("Interrupted")
+        fetcher.database_helper.update = _update_failing_second_page
+        pages = self._make_fake_change_pages([500, 500, 100, 0])
+        self.multiple_fetch_changes = pages
+        with self.assertRaises(ValueError):
+            fetcher.pull_and_store_changes()
+        sync_state = SyncState.objects.get()
+        self.assertEqual(sync_state.fetch_before,
+                         database_helper.convert_to_utc_datetime(
+                             pages[0][-1].last_update_timestamp))
+        self.assertEqual(sync_state.fetch_skip, 1)
+        fetch_after = sync_state.fetch_after
+        self.assertIsNotNone(fetch_after)
+
+        # next sync continues from second page, with the same start time
+        fetcher.database_helper.update = self._mock_database_helper_update
+        self.skip_params_used = []
+        self.before_params_used = []
+        self.fetch_count = 1
+        fetcher.pull_and_store_changes()
+        self._assert_skip_params_used([1, 1, 1])
+        self.assertEqual(self.before_params_used[0], sync_state.fetch_before)
+        self.assertEqual(self.found_datetime_str,
+                         fetch_after.strftime('%Y-%m-%d %H:%M:%S'))
+        sync_state = SyncState.objects.get()
+        self.assertEqual(sync_state.status, SyncState.STATUS_SUCCEEDED)
+        self.assertIsNone(sync_state.fetch_after)
+        self.assertIsNone(sync_state.fetch_before)
+        self.assertEqual(sync_state.fetch_skip, 0)
+
+
+class TestShardedFetcher(TestCase):
+    """Tests that a sharded sync fetches changes for each project with a
+    separate query, no more than fetchconcurrency at a time, and stores all
+    of them with a cursor for each project
+    """
+    PROJECT_PAGE_SIZES = {
+        "foo": [500, 20, 0],
+        "bar": [3, 0],
+        "baz": [0],
+    }
+    FETCH_CONCURRENCY = 2
+
+    def _mock_fetch(self, hostname, username, datetime_utc, port, skip,
+                    before_datetime_utc, project=None, raise_errors=False):
+        with self.lock:
+            self.fetching += 1
+            self.max_fetching = max(self.max_fetching, self.fetching)
+        # give other fetch threads a chance to run
+        time.sleep(0.01)
+        with self.lock:
+            self.fetching -= 1
+            self.fetched_projects.append(project)
+            return self.project_pages[project].pop(0)
+
+    def _mock_fetch_projects(self, hostname, username, port=29418):
+        return list(self.gerrit_projects)
+
+    def _make_project_pages(self, project, page_sizes):
+        timestamp = int(time.time())
+        pages = []
+        for page_index, page_size in enumerate(page_sizes):
+            page = []
+            for index in range(page_size):
+                gerrit_change = GerritChange([])
+                gerrit_change.last_update_timestamp = str(timestamp)
+                gerrit_change.owner = self._make_account("Owner")
+                gerrit_change.subject = "Change %d" % index
+                gerrit_change.project = project
+                gerrit_change.change_id = "I%s-%d-%d" % (project, page_index,
+                                                         index)
+                gerrit_change.comments = []
+                page.append(gerrit_change)
+                timestamp -= 1
+            pages.append(page)
+        return pages
+
+    def _make_account(self, name):
+        account = Account([])
+        account.name = name
+        return account
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.fetching = 0
+        self.max_fetching = 0
+        self.fetched_projects = []
+        self.gerrit_projects = sorted(self.PROJECT_PAGE_SIZES)
+        self.project_pages = {
+            project: self._make_project_pages(project, page_sizes)
+            for project, page_sizes in self.PROJECT_PAGE_SIZES.items()}
+        self.saved_fetch_method = fetcher.fetch.fetch_merged_changes
+        fetcher.fetch.fetch_merged_changes = self._mock_fetch
+        self.saved_fetch_projects = fetcher.fetch.fetch_projects
+        fetcher.fetch.fetch_projects = self._mock_fetch_projects
+        self.saved_sharded_sync = fetcher.GerritFetchConfig.sharded_sync
+        fetcher.GerritFetchConfig.sharded_sync = lambda config: True
+        self.saved_fetch_concurrency = \
+            fetcher.GerritFetchConfig.fetch_concurrency
+        fetcher.GerritFetchConfig.fetch_concurrency = \
+            lambda config: self.FETCH_CONCURRENCY
+
+    def tearDown(self):
+        fetcher.fetch.fetch_merged_changes = self.saved_fetch_method
+        fetcher.fetch.fetch_projects = self.saved_fetch_projects
+        fetcher.GerritFetchConfig.sharded_sync = self.saved_sharded_sync
+        fetcher.GerritFetchConfig.fetch_concurrency = \
+            self.saved_fetch_concurrency
+
+    def test_sharded_sync(self):
+        change_count = fetcher.pull_and_store_changes()
+        self.assertEqual(change_count, 523)
+        self.assertEqual(Change.objects.count(), 523)
+        self.assertEqual(
+            Change.objects.filter(project__name="foo").count(), 520)
+        # each project fetched until no more changes, a page at a time
+        for project, page_sizes in self.PROJECT_PAGE_SIZES.items():
+            self.assertEqual(self.fetched_projects.count(project),
+                             len(page_sizes))
+        self.assertLessEqual(self.max_fetching, self.FETCH_CONCURRENCY)
+        # sync recorded as a whole and for each project
+        sync_state = database_helper.get_last_sync_state()
+        self.assertEqual(sync_state.query_type, SyncState.QUERY_MERGED)
+        self.assertEqual(sync_state.status, SyncState.STATUS_SUCCEEDED)
+        self.assertEqual(sync_state.change_count, 523)
+        for project, expected_count in [("foo", 520), ("bar", 3),
+                                        ("baz", 0)]:
+            shard_state = SyncState.objects.get(
+                query_type=SyncState.QUERY_MERGED_PROJECT % project)
+            self.assertEqual(shard_state.status, SyncState.STATUS_SUCCEEDED)
+            self.assertEqual(shard_state.change_count, expected_count)
+            self.assertIsNone(shard_state.fetch_after)
+
+    def test_projects_of_stored_changes_used(self):
+        """Test that projects already stored are synced if gerrit doesn't
+        list projects"""
+        self.gerrit_projects = []
+        Change(timestamp=datetime.utcnow() - timedelta(days=1),
+               change_id="existing",
+               project=Project.objects.create(name="bar")).save()
         fetcher.pull_and_store_changes()
-        self._assert_skip_params_used([0, 500, 1000, 1100])
+        self.assertEqual(set(self.fetched_projects), {"bar"})
+        self.assertEqual(Change.objects.count(), 4)
+
+    def test_project_watermarks(self):
+        """Test that each project is synced from its own last synced change,
+        or from maxdays ago if it doesn't have any"""
+        fetch_afters = {}
+
+        def _recording_fetch(hostname, username, datetime_utc, port, skip,
+                             before_datetime_utc, project=None,
+                             raise_errors=False):
+            fetch_afters.setdefault(project, datetime_utc)
+            return self._mock_fetch(hostname, username, datetime_utc, port,
+                                    skip, before_datetime_utc, project)
+        fetcher.fetch.fetch_merged_changes = _recording_fetch
+        latest_change = Change(timestamp=datetime.utcnow().replace(
+            microsecond=0), change_id="existing",
+            project=Project.objects.create(name="foo"))
+        latest_change.save()
+        bar_latest = database_helper.convert_to_utc_datetime(
+            self.project_pages["bar"][0][0].last_update_timestamp)
+        max_days_ago = datetime.utcnow() - timedelta(
+            days=GerritFetchConfig().max_days())
+        fetcher.pull_and_store_changes()
+        self.assertEqual(fetch_afters["foo"], latest_change.timestamp)
+        for project in ["bar", "baz"]:
+            self.assertLess(abs(fetch_afters[project] - max_days_ago),
+                            timedelta(minutes=1))
+        shard_watermarks = dict(SyncState.objects.values_list(
+            'query_type', 'watermark'))
+        self.assertEqual(
+            shard_watermarks[SyncState.QUERY_MERGED_PROJECT % "bar"],
+            bar_latest)
+        self.assertIsNone(
+            shard_watermarks[SyncState.QUERY_MERGED_PROJECT % "baz"])
+
+    def test_failed_project_resumed(self):
+        """Test that a failed project keeps its cursor, while other projects
+        finish"""
+        def _failing_fetch(hostname, username, datetime_utc, port, skip,
+                           before_datetime_utc, project=None,
+                           raise_errors=False):
+            if project == "foo" and before_datetime_utc:
+                raise GerritError("Connection dropped")
+            return self._mock_fetch(hostname, username, datetime_utc, port,
+                                    skip, before_datetime_utc, project)
+        fetcher.fetch.fetch_merged_changes = _failing_fetch
+        with self.assertRaises(GerritError):
+            fetcher.pull_and_store_changes()
+        shard_state = SyncState.objects.get(
+            query_type=SyncState.QUERY_MERGED_PROJECT % "foo")
+        self.assertEqual(shard_state.status, SyncState.STATUS_FAILED)
+        self.assertEqual(shard_state.fetch_skip, 1)
+        self.assertIsNotNone(shard_state.fetch_before)
+        self.assertEqual(database_helper.get_last_sync_state().status,
+                         SyncState.STATUS_FAILED)
+
+
+class FakeGerritClient:
+    """Answers merged change queries from a list of changes the way a gerrit
+    server would, keeping count of changes it had to go through for each
+    query
+    """
+
+    def __init__(self, gerrit_changes):
+        # newest first, as gerrit returns them
+        self.gerrit_changes = sorted(
+            gerrit_changes,
+            key=lambda change: (int(change.last_update_timestamp),
+                                change.number),
+            reverse=True)
+        self.queries = []
+        self.scanned_counts = []
+        self.version_count = 0
+        # number of queries to fail, starting with the next one
+        self.fail_queries = 0
+
+    @staticmethod
+    def make_change(number, timestamp):
+        gerrit_change = GerritChange([])
+        gerrit_change.number = number
+        gerrit_change.change_id = "I%040d" % number
+        gerrit_change.last_update_timestamp = str(timestamp)
+        gerrit_change.owner = Account([])
+        gerrit_change.owner.name = "John Doe"
+        gerrit_change.subject = "Change %d" % number
+        gerrit_change.project = "project-%d" % (number % 10)
+        gerrit_change.comments = []
+        return gerrit_change
+
+    def gerrit_version(self):
+        self.version_count += 1
+        return "2.11"
+
+    def query(self, gerrit_query):
+        self.queries.append(gerrit_query)
+        if self.fail_queries:
+            self.fail_queries -= 1
+            raise GerritError("Connection dropped")
+        after = datetime.strptime(
+            re.search(r'after:(\S+)', gerrit_query).group(1), "%Y-%m-%d")
+        limit = int(re.search(r'limit:(\d+)', gerrit_query).group(1))
+        before_match = re.search(r'before:"([^"]+)"', gerrit_query)
+        before = before_match and datetime.strptime(
+            before_match.group(1), fetch.GERRIT_QUERY_DATETIME_FORMAT)
+        skip_match = re.search(r'-S (\d+)', gerrit_query)
+        skip = int(skip_match.group(1)) if skip_match else 0
+        matching_changes = []
+        for gerrit_change in self.gerrit_changes:
+            updated = database_helper.convert_to_utc_datetime(
+                gerrit_change.last_update_timestamp)
+            if updated >= after and (not before or updated <= before):
+                matching_changes.append(gerrit_change)
+        changes = matching_changes[skip:skip + limit]
+        self.scanned_counts.append(skip + len(changes))
+        return changes
+
+
+class TestKeysetPagination(TestCase):
+    """Tests that paging through thousands of merged changes fetches every
+    change once, and that each page costs gerrit about the same
+    """
+
+    def setUp(self):
+        self.saved_gerrit_client = gerrit_connection.GerritClient
+        gerrit_connection.pool.close_all()
+
+    def tearDown(self):
+        gerrit_connection.GerritClient = self.saved_gerrit_client
+        gerrit_connection.pool.close_all()
+
+    def test_pages_cost_the_same(self):
+        now = int(time.time())
+        # changes merged a minute apart in threes, so that changes updated at
+        # the same time span pages
+        gerrit_changes = [
+            FakeGerritClient.make_change(number, now - (number // 3) * 60)
+            for number in range(3000)]
+        # more changes updated at the same time than fit in a page, in
+        # between the others
+        gerrit_changes += [
+            FakeGerritClient.make_change(number, now - 500 * 60 - 30)
+            for number in range(3000, 3700)]
+        client = FakeGerritClient(gerrit_changes)
+        gerrit_connection.GerritClient = lambda host, username, port: client
+
+        fetcher.pull_and_store_changes()
+
+        self.assertEqual(Change.objects.count(), len(gerrit_changes))
+        page_count = -(-len(gerrit_changes) // fetch.MAX_CHANGES_FETCH_COUNT)
+        # one more query to find there are no more changes
+        self.assertEqual(len(client.queries), page_count + 1)
+        # all pages were fetched using the same connection
+        self.assertEqual(client.version_count, 1)
+        # only changes updated at the same time as the oldest change of the
+        # previous page get skipped, except for the 700 updated at the same
+        # time, so pages don't get more expensive as they get older
+        self.assertLessEqual(max(client.scanned_counts),
+                             fetch.MAX_CHANGES_FETCH_COUNT + 700)
+        self.assertLessEqual(client.scanned_counts[0],
+                             fetch.MAX_CHANGES_FETCH_COUNT)
+        self.assertLessEqual(client.scanned_counts[-2],
+                             fetch.MAX_CHANGES_FETCH_COUNT + 3)
+
+
+class TestBackfill(TestCase):
+    """Tests that a backfill pulls all changes in a range in windows, and
+    continues where it left off when run again after failing
+    """
+    SINCE = date(2017, 1, 1)
+    UNTIL = date(2017, 1, 31)
+
+    def setUp(self):
+        self.saved_gerrit_client = gerrit_connection.GerritClient
+        gerrit_connection.pool.close_all()
+        # a change every 3 hours, at half past the hour so that none are
+        # at the boundary between windows
+        until_timestamp = calendar.timegm(self.UNTIL.timetuple())
+        self.gerrit_changes = [
+            FakeGerritClient.make_change(
+                number, until_timestamp - number * 3 * 3600 - 1800)
+            for number in range(30 * 8)]
+        self.client = FakeGerritClient(self.gerrit_changes)
+        gerrit_connection.GerritClient = \
+            lambda host, username, port: self.client
+        self.stored_windows = []
+
+    def tearDown(self):
+        gerrit_connection.GerritClient = self.saved_gerrit_client
+        gerrit_connection.pool.close_all()
+
+    def _window_stored(self, window_state, window_count):
+        self.stored_windows.append((window_state.query_type, window_count))
+
+    def test_get_backfill_windows(self):
+        self.assertEqual(
+            fetcher.get_backfill_windows(self.SINCE, date(2017, 1, 18), 7),
+            [(date(2017, 1, 11), date(2017, 1, 18)),
+             (date(2017, 1, 4), date(2017, 1, 11)),
+             (date(2017, 1, 1), date(2017, 1, 4))])
+
+    def test_backfill(self):
+        change_count, stored_count = fetcher.backfill_changes(
+            self.SINCE, self.UNTIL, 7, 3, self._window_stored)
+        self.assertEqual(change_count, len(self.gerrit_changes))
+        self.assertEqual(stored_count, 0)
+        self.assertEqual(Change.objects.count(), len(self.gerrit_changes))
+        # each window was queried with its own time range
+        self.assertEqual(len(self.stored_windows), 5)
+        self.assertEqual(set(window_count for _, window_count
+                             in self.stored_windows), {5})
+        window_states = SyncState.objects.filter(
+            query_type__startswith="backfill")
+        self.assertEqual(window_states.count(), 5)
+        for window_state in window_states:
+            self.assertEqual(window_state.status,
+                             SyncState.STATUS_SUCCEEDED)
+        for query in self.client.queries:
+            self.assertIn("before:", query)
+
+    def test_backfill_waits_for_sync(self):
+        window_counts = []
+
+        def sleep(seconds):
+            # windows backfilled while the sync holds the lease
+            window_counts.append(SyncState.objects.filter(
+                query_type__startswith="backfill").count())
+            lease.release(SyncState.QUERY_MERGED, "sync")
+        self.assertTrue(lease.acquire(SyncState.QUERY_MERGED, "sync"))
+        saved_time = lease.time
+        lease.time = type("Time", (), {"sleep": staticmethod(sleep)})
+        try:
+            change_count, _ = fetcher.backfill_changes(
+                self.SINCE, self.UNTIL, 7, 1, self._window_stored)
+        finally:
+            lease.time = saved_time
+        self.assertEqual(window_counts, [0])
+        self.assertEqual(change_count, len(self.gerrit_changes))
+        self.assertFalse(lease.is_held(SyncState.QUERY_MERGED))
+
+    def test_backfill_continued(self):
+        # fail the first query of the third window, and its retry
+        self.client.fail_queries = 0
+        queries = self.client.queries
+
+        def fail_third_window(gerrit_query):
+            if len(queries) == 4:
+                self.client.fail_queries = 2
+            return FakeGerritClient.query(self.client, gerrit_query)
+        self.client.query = fail_third_window
+        with self.assertRaises(GerritError):
+            fetcher.backfill_changes(self.SINCE, self.UNTIL, 7, 1,
+                                     self._window_stored)
+        self.assertEqual(len(self.stored_windows), 2)
+        # the window that failed and the ones not yet pulled
+        self.assertEqual(SyncState.objects.filter(
+            status=SyncState.STATUS_FAILED,
+            query_type__startswith="backfill").count(), 3)
+
+        # continuing skips windows already stored
+        del self.client.query
+        self.stored_windows = []
+        change_count, stored_count = fetcher.backfill_changes(
+            self.SINCE, self.UNTIL, 7, 1, self._window_stored)
+        self.assertEqual(stored_count, 2)
+        self.assertEqual(len(self.stored_windows), 3)
+        self.assertEqual(Change.objects.count(), len(self.gerrit_changes))
+
+
+class TestConnectionPool(TestCase):
+    """Tests that gerrit connections are reused, and replaced when they fail
+    or are idle
+    """
+
+    class MockGerritClient:
+        def __init__(self, test, host, username, port):
+            self.test = test
+            self.closed = False
+            # closed by the pool like pygerrit's paramiko client
+            self._ssh_client = self
+            test.clients.append(self)
+
+        def close(self):
+            self.closed = True
+
+        def gerrit_version(self):
+            self.test.version_count += 1
+            return "2.11"
+
+        def query(self, gerrit_query):
+            if self.test.fail_queries:
+                self.test.fail_queries -= 1
+                raise GerritError("Connection dropped")
+            return [gerrit_query]
+
+        def run_command(self, command):
+            result = type("Result", (), {})()
+            result.stdout = io.BytesIO(b"All-Projects\nfoo\n\nbar/baz\n")
+            return result
+
+    def setUp(self):
+        self.clients = []
+        self.version_count = 0
+        self.fail_queries = 0
+        self.saved_gerrit_client = gerrit_connection.GerritClient
+        gerrit_connection.GerritClient = \
+            lambda host, username, port: self.MockGerritClient(
+                self, host, username, port)
+        self.pool = gerrit_connection.GerritConnectionPool()
+
+    def tearDown(self):
+        gerrit_connection.GerritClient = self.saved_gerrit_client
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            self.pool.query("gerrit-a", "user", 29418, "status:merged")
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.version_count, 1)
+        self.assertEqual(
+            self.pool.gerrit_version("gerrit-a", "user", 29418), "2.11")
+        self.assertEqual(self.version_count, 1)
+        # a different server gets its own connection
+        self.pool.query("gerrit-b", "user", 29418, "status:merged")
+        self.assertEqual(len(self.clients), 2)
+
+    def test_reconnect_on_failure(self):
+        self.pool.query("gerrit-a", "user", 29418, "status:merged")
+        self.fail_queries = 1
+        changes = self.pool.query("gerrit-a", "user", 29418, "status:open")
+        self.assertEqual(changes, ["status:open"])
+        self.assertEqual(len(self.clients), 2)
+        # gives up if reconnecting doesn't help
+        self.fail_queries = 2
+        with self.assertRaises(GerritError):
+            self.pool.query("gerrit-a", "user", 29418, "status:open")
+
+    def test_replaced_connection_kept(self):
+        self.pool.query("gerrit-a", "user", 29418, "status:merged")
+        queries = []
+
+        def query(gerrit_query):
+            queries.append(gerrit_query)
+            if len(queries) == 1:
+                # another thread's query fails too, and it reconnects before
+                # this one does
+                self.assertEqual(
+                    self.pool.query("gerrit-a", "user", 29418, "status:open"),
+                    ["status:open"])
+            raise GerritError("Connection dropped")
+        self.clients[0].query = query
+        changes = self.pool.query("gerrit-a", "user", 29418, "status:merged")
+        self.assertEqual(changes, ["status:merged"])
+        # the connection made by the other thread is used rather than closed
+        self.assertEqual(len(self.clients), 2)
+        self.assertTrue(self.clients[0].closed)
+        self.assertFalse(self.clients[1].closed)
+
+    def test_projects_fetched(self):
+        saved_pool = fetch.connection.pool
+        fetch.connection.pool = self.pool
+        try:
+            projects = fetch.fetch_projects("gerrit-a", "user", 29418)
+        finally:
+            fetch.connection.pool = saved_pool
+        self.assertEqual(projects, ["All-Projects", "foo", "bar/baz"])
+        self.assertEqual(len(self.clients), 1)
+
+    def test_idle_connection_closed(self):
+        self.pool.query("gerrit-a", "user", 29418, "status:merged")
+        self.pool.idle_timeout = -1
+        self.pool.query("gerrit-a", "user", 29418, "status:merged")
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(self.version_count, 2)
+
+    def test_pool_built_with_compression(self):
+        saved_pool = gerrit_connection.pool
+        saved_compression = GerritFetchConfig.compression
+        saved_enable_compression = gerrit_connection._enable_compression
+        compressed_clients = []
+        GerritFetchConfig.compression = lambda config: True
+        gerrit_connection._enable_compression = compressed_clients.append
+        try:
+            apps.get_app_config('leaderboard').ready()
+            self.assertIsNot(gerrit_connection.pool, saved_pool)
+            self.assertTrue(gerrit_connection.pool.compress)
+            gerrit_connection.pool.query("gerrit-a", "user", 29418,
+                                         "status:merged")
+        finally:
+            gerrit_connection.pool = saved_pool
+            GerritFetchConfig.compression = saved_compression
+            gerrit_connection._enable_compression = saved_enable_compression
+        self.assertEqual(compressed_clients, self.clients)
+
+
+class TestPipeline(TestCase):
+    """Tests that pages are fetched while earlier pages are written, that
+    fetching waits for a slow writer, and that errors stop the pipeline
+    """
+    # seconds to wait for something the pipeline should do
+    TIMEOUT = 5
+
+    def setUp(self):
+        self.fetched = []
+        self.written = []
+
+    def _stream(self, page_count=None):
+        page = 0
+        while page_count is None or page < page_count:
+            self.fetched.append(page)
+            yield page
+            page += 1
+
+    def test_fetch_overlaps_write(self):
+        second_page_fetched = threading.Event()
+
+        def stream():
+            for page in self._stream(3):
+                if page == 1:
+                    second_page_fetched.set()
+                yield page
+
+        def write(page):
+            if page == 0:
+                # only returns early if the next page is fetched meanwhile
+                self.assertTrue(second_page_fetched.wait(self.TIMEOUT))
+            self.written.append(page)
+
+        pipeline.run([stream()], write)
+        self.assertEqual(self.written, [0, 1, 2])
+
+    def test_fetch_waits_for_writer(self):
+        def write(page):
+            if page == 0:
+                time.sleep(0.5)
+                # one page being written, queue_size pages queued, and one
+                # page waiting to be queued
+                self.assertLessEqual(len(self.fetched), 2 + 2)
+            self.written.append(page)
+
+        pipeline.run([self._stream(10)], write, queue_size=2)
+        self.assertEqual(self.written, list(range(10)))
+
+    def test_write_error_stops_fetch(self):
+        def write(page):
+            raise ValueError("Write failed")
+
+        with self.assertRaises(ValueError):
+            pipeline.run([self._stream()], write, queue_size=1)
+        # the fetch thread has been stopped
+        fetched_count = len(self.fetched)
+        time.sleep(0.1)
+        self.assertEqual(len(self.fetched), fetched_count)
+        self.assertEqual(
+            [thread.name for thread in threading.enumerate()
+             if thread.name.startswith("leaderboard-fetch")], [])
+
+    def test_fetch_error_raised(self):
+        def stream():
+            yield from self._stream(2)
+            raise GerritError("Connection dropped")
+
+        with self.assertRaises(GerritError):
+            pipeline.run([stream()], self.written.append)
+        self.assertEqual(self.written, [0, 1])
+
+
+class TestSyncLease(TransactionTestCase):
+    """Tests that only one sync runs at a time across threads, which use
+    separate database connections like separate processes do, and that
+    leases expire unless renewed
+    """
+
+    def _mock_fetch_merged_changes(self, hostname, username, datetime_utc,
+                                   port, skip, before_datetime_utc,
+                                   project=None, raise_errors=False):
+        self.fetch_count += 1
+        self.fetch_started.set()
+        self.fetch_allowed.wait(TestPipeline.TIMEOUT)
+        return []
+
+    def setUp(self):
+        self.fetch_count = 0
+        self.fetch_started = threading.Event()
+        self.fetch_allowed = threading.Event()
+        self.saved_fetch_merged_changes = fetch.fetch_merged_changes
+        fetch.fetch_merged_changes = self._mock_fetch_merged_changes
+        self.saved_poll_interval = lease.POLL_INTERVAL
+        lease.POLL_INTERVAL = 0.01
+
+    def tearDown(self):
+        fetch.fetch_merged_changes = self.saved_fetch_merged_changes
+        lease.POLL_INTERVAL = self.saved_poll_interval
+
+    def _start_sync(self, results, wait=False):
+        def sync():
+            try:
+                results.append(fetcher.pull_and_store_changes(wait=wait))
+            finally:
+                connection.close()
+        thread = threading.Thread(target=sync)
+        thread.start()
+        return thread
+
+    def test_concurrent_syncs_query_gerrit_once(self):
+        winner_results = []
+        loser_results = []
+        waiter_results = []
+        threads = [self._start_sync(winner_results)]
+        self.assertTrue(self.fetch_started.wait(TestPipeline.TIMEOUT))
+        waiting = threading.Event()
+
+        def sleep(seconds):
+            # the waiter polls again once the winner is done, as sqlite's
+            # shared in-memory test database fails writes made while
+            # another thread reads
+            waiting.set()
+            threads[0].join(TestPipeline.TIMEOUT)
+        saved_time = lease.time
+        lease.time = type("Time", (), {"sleep": staticmethod(sleep)})
+        try:
+            threads.extend(self._start_sync(loser_results) for _ in range(3))
+            threads.append(self._start_sync(waiter_results, wait=True))
+            for thread in threads[1:-1]:
+                thread.join(TestPipeline.TIMEOUT)
+            # syncs that lost the race returned without waiting
+            self.assertEqual(loser_results, [None, None, None])
+            self.assertTrue(waiting.wait(TestPipeline.TIMEOUT))
+            self.assertEqual(waiter_results, [])
+            self.fetch_allowed.set()
+            for thread in threads:
+                thread.join(TestPipeline.TIMEOUT)
+        finally:
+            lease.time = saved_time
+        self.assertEqual(self.fetch_count, 1)
+        self.assertEqual(winner_results, [0])
+        self.assertEqual(waiter_results, [0])
+        self.assertFalse(lease.is_held(SyncState.QUERY_MERGED))
+        # the next sync gets the lease
+        self.assertEqual(fetcher.pull_and_store_changes(), 0)
+        self.assertEqual(self.fetch_count, 2)
+
+    def test_expired_lease_taken_over(self):
+        self.assertTrue(lease.acquire("sync", "a", timedelta(seconds=-1)))
+        self.assertFalse(lease.is_held("sync"))
+        self.assertTrue(lease.acquire("sync", "b"))
+        self.assertFalse(lease.acquire("sync", "a"))
+        # only the holder can renew or release it
+        self.assertFalse(lease.renew("sync", "a"))
+        self.assertTrue(lease.renew("sync", "b"))
+        lease.release("sync", "a")
+        self.assertTrue(lease.is_held("sync"))
+        lease.release("sync", "b")
+        self.assertFalse(lease.is_held("sync"))
+        self.assertTrue(lease.acquire("sync", "a"))
+
+    def test_heartbeat_retries_database_errors(self):
+        saved_functions = (lease.HEARTBEAT_INTERVAL, lease.renew)
+        renewals = []
+
+        def renew(name, holder, duration=lease.LEASE_DURATION):
+            renewals.append(name)
+            if len(renewals) == 1:
+                raise DatabaseError("database is locked")
+            return saved_functions[1](name, holder, duration)
+        lease.HEARTBEAT_INTERVAL = 0.01
+        lease.renew = renew
+        try:
+            with lease.hold("sync") as acquired:
+                self.assertTrue(acquired)
+                deadline = time.time() + TestPipeline.TIMEOUT
+                while len(renewals) < 3 and time.time() < deadline:
+                    time.sleep(0.01)
+        finally:
+            lease.HEARTBEAT_INTERVAL, lease.renew = saved_functions
+        # still renewing after the failed renewal
+        self.assertGreaterEqual(len(renewals), 3)
+        self.assertFalse(lease.is_held("sync"))
+
+    def test_acquire_fails_on_database_errors(self):
+        class LockedManager:
+            def filter(self, **kwargs):
+                raise DatabaseError("database table is locked")
+        saved_sync_lease = lease.SyncLease
+        lease.SyncLease = type("SyncLease", (), {"objects": LockedManager()})
+        try:
+            with lease.hold("sync") as acquired:
+                self.assertFalse(acquired)
+        finally:
+            lease.SyncLease = saved_sync_lease
+        # taken once the database is no longer locked
+        with lease.hold("sync") as acquired:
+            self.assertTrue(acquired)
 
 
 class TestCurrentLoadFetcher(TestCase):
-    # Mocks changes to be returned from mock gerrit fetch
+    # Mocks open changes to be returned from mock gerrit fetch, newest first
     changes = []
-
-    def _mock_fetch(self, hostname, username, port=29418):
-        return self.changes
+    # Mocks closed changes to be returned from mock gerrit fetch, newest first
+    closed_changes = []
+
+    def _query(self, changes, after_datetime_utc, skip, before_datetime_utc):
+        """Returns page of given changes the way gerrit would"""
+        matching_changes = []
+        for gerrit_change in changes:
+            updated = database_helper.convert_to_utc_datetime(
+                gerrit_change.last_update_timestamp)
+            if (not after_datetime_utc or updated > after_datetime_utc) and \
+                    (not before_datetime_utc or updated <= before_datetime_utc):
+                matching_changes.append(gerrit_change)
+        skip = skip or 0
+        return matching_changes[skip:skip + fetch.MAX_CHANGES_FETCH_COUNT]
+
+    def _mock_fetch(self, hostname, username, port=29418, raise_errors=False,
+                    after_datetime_utc=None, skip=None,
+                    before_datetime_utc=None):
+        self.queries.append(("open", after_datetime_utc))
+        return self._query(self.changes, after_datetime_utc, skip,
+                           before_datetime_utc)
+
+    def _mock_fetch_closed(self, hostname, username, port=29418,
+                           raise_errors=False, after_datetime_utc=None,
+                           skip=None, before_datetime_utc=None):
+        self.queries.append(("closed", after_datetime_utc))
+        return self._query(self.closed_changes, after_datetime_utc, skip,
+                           before_datetime_utc)
 
     def setUp(self):
         # mock out gerrit fetch
         self.saved_fetch_method = fetcher.fetch.fetch_open_changes
         fetcher.fetch.fetch_open_changes = self._mock_fetch
+        self.saved_fetch_closed_method = fetcher.fetch.fetch_closed_changes
+        fetcher.fetch.fetch_closed_changes = self._mock_fetch_closed
+        self.queries = []
+        self.closed_changes = []
+        self.change_number = 0
+        self.timestamp = int(time.time()) - 24 * 3600
 
     def tearDown(self):
         # unmock gerrit fetch
         fetcher.fetch.fetch_open_changes = self.saved_fetch_method
+        fetcher.fetch.fetch_closed_changes = self.saved_fetch_closed_method
 
-    def _make_gerrit_change(self, project, reviewers):
+    def _make_gerrit_change(self, project, reviewers, number=None):
         gerrit_change = GerritChange([])
         for reviewer_name in reviewers:
             reviewer = Account([])
             reviewer.name = reviewer_name
             gerrit_change.reviewers.append(reviewer)
         gerrit_change.project = project
+        if number is None:
+            self.change_number += 1
+            number = self.change_number
+        gerrit_change.number = str(number)
+        # each change updated after the previous one
+        self.timestamp += 300
+        gerrit_change.last_update_timestamp = str(self.timestamp)
         return gerrit_change
 
     def _make_open_changes(self, changes_specs):
@@ -472,7 +1620,12 @@ class TestCurrentLoadFetcher(TestCase):
         return changes
 
     def _test_current_load_fetcher(self, changes, expected_dic):
-        self.changes = changes
+        # as if each set of changes was on a different gerrit server
+        OpenChange.objects.all().delete()
+        OpenReviewerLoad.objects.all().delete()
+        SyncState.objects.all().delete()
+        # newest first, as gerrit returns them
+        self.changes = list(reversed(changes))
         found_dic = current_load_fetcher.get_open_change_reviewers_per_project()
         self.assertDictEqual(expected_dic, found_dic)
 
@@ -558,12 +1711,829 @@ class TestCurrentLoadFetcher(TestCase):
         }
         )
 
+    def test_open_changes_paged(self):
+        """Test that more open changes than fit in a page are counted"""
+        changes = self._make_open_changes(
+            [["project-a", ["Reviewer X"]]] * 1200)
+        self._test_current_load_fetcher(changes, {
+            "project-a": {
+                "Reviewer X": 1200
+            }
+        })
+        # three pages and a query finding no more changes
+        self.assertEqual(len(self.queries), 4)
+
+    def test_incremental_refresh(self):
+        """Test that a refresh only fetches changes updated since the last
+        one, and retires closed changes"""
+        changes = self._make_open_changes([
+            ["project-a", ["Reviewer X", "Reviewer Y"]],
+            ["project-a", ["Reviewer X"]],
+            ["project-b", ["Reviewer Y"]],
+        ])
+        self._test_current_load_fetcher(changes, {
+            "project-a": {"Reviewer X": 2, "Reviewer Y": 1},
+            "project-b": {"Reviewer Y": 1},
+        })
+        self.assertEqual(set(self.queries), {("open", None)})
+        last_refresh = SyncState.objects.get(
+            query_type=SyncState.QUERY_OPEN).watermark
+
+        # a reviewer is replaced on one change, another is merged, and a
+        # change is added
+        self.queries = []
+        updated_change = self._make_gerrit_change(
+            "project-a", ["Reviewer Z"], number=changes[0].number)
+        merged_change = self._make_gerrit_change(
+            "project-a", ["Reviewer X"], number=changes[1].number)
+        new_change = self._make_gerrit_change("project-b", ["Reviewer X"])
+        self.changes = [new_change, updated_change, changes[2]]
+        self.closed_changes = [merged_change]
+        found_dic = current_load_fetcher.get_open_change_reviewers_per_project()
+        self.assertDictEqual(found_dic, {
+            "project-a": {"Reviewer Z": 1},
+            "project-b": {"Reviewer X": 1, "Reviewer Y": 1},
+        })
+        after = last_refresh - current_load_fetcher.REFRESH_OVERLAP
+        self.assertEqual(set(self.queries),
+                         {("open", after), ("closed", after)})
+        self.assertEqual(OpenChange.objects.count(), 3)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TestOpenLoadCache(TestCase):
+    """Tests that the open change load is fetched once and shared, and that
+    it is fetched again in the background once it is out of date while the
+    last one keeps being returned
+    """
+
+    def _mock_get_open_change_reviewers_per_project(self, raise_errors=False):
+        self.fetch_count += 1
+        self.fetch_allowed.wait(TestPipeline.TIMEOUT)
+        if isinstance(self.open_load, Exception):
+            raise self.open_load
+        return self.open_load
+
+    def setUp(self):
+        cache.clear()
+        self.fetch_count = 0
+        self.fetch_allowed = threading.Event()
+        self.fetch_allowed.set()
+        self.open_load = {"project-a": {"Reviewer A": 1}}
+        self.ttl = 60
+        self.saved_fetch = \
+            current_load_fetcher.get_open_change_reviewers_per_project
+        current_load_fetcher.get_open_change_reviewers_per_project = \
+            self._mock_get_open_change_reviewers_per_project
+        self.saved_open_load_ttl = GerritFetchConfig.open_load_ttl
+        GerritFetchConfig.open_load_ttl = lambda config: self.ttl
+
+    def tearDown(self):
+        self._join_refresh()
+        current_load_fetcher.get_open_change_reviewers_per_project = \
+            self.saved_fetch
+        GerritFetchConfig.open_load_ttl = self.saved_open_load_ttl
+
+    def _join_refresh(self):
+        for thread in threading.enumerate():
+            if thread.name == "leaderboard-open-load-refresh":
+                thread.join()
+
+    def _get(self):
+        return open_load_cache.get_open_change_reviewers_per_project()
+
+    def _get_first(self):
+        # the first load is fetched in the background
+        self.assertEqual(self._get(), {})
+        self._join_refresh()
+
+    def test_fetched_once(self):
+        self._get_first()
+        self.assertEqual(self._get(), {"project-a": {"Reviewer A": 1}})
+        self.assertEqual(self._get(), {"project-a": {"Reviewer A": 1}})
+        self.assertEqual(self.fetch_count, 1)
+
+    def test_stale_load_refreshed_in_background(self):
+        self._get_first()
+        self.ttl = -1
+        self.open_load = {"project-a": {"Reviewer B": 2}}
+        self.fetch_allowed.clear()
+        # last load returned while being refreshed, by one refresh only
+        self.assertEqual(self._get(), {"project-a": {"Reviewer A": 1}})
+        self.assertEqual(self._get(), {"project-a": {"Reviewer A": 1}})
+        self.fetch_allowed.set()
+        self._join_refresh()
+        self.assertEqual(self.fetch_count, 2)
+        self.ttl = 60
+        self.assertEqual(self._get(), {"project-a": {"Reviewer B": 2}})
+
+    def test_failed_refresh_keeps_last_load(self):
+        self._get_first()
+        self.ttl = -1
+        self.open_load = GerritError("Connection dropped")
+        self._get()
+        self._join_refresh()
+        # not retried until the refresh lock expires
+        self.assertEqual(self._get(), {"project-a": {"Reviewer A": 1}})
+        self._join_refresh()
+        self.assertEqual(self.fetch_count, 2)
+
+    def test_no_load_if_first_fetch_fails(self):
+        self.open_load = GerritError("Connection dropped")
+        self._get_first()
+        self.open_load = {"project-a": {"Reviewer B": 2}}
+        # not retried until the refresh lock expires
+        self.assertEqual(self._get(), {})
+        self._join_refresh()
+        self.assertEqual(self.fetch_count, 1)
+        cache.delete(open_load_cache.REFRESH_LOCK_KEY)
+        self._get_first()
+        self.assertEqual(self._get(), {"project-a": {"Reviewer B": 2}})
+        self.assertEqual(self.fetch_count, 2)
+
+    def test_first_fetch_made_once(self):
+        self.fetch_allowed.clear()
+        # no load while the first one is being fetched
+        self.assertEqual(self._get(), {})
+        self.assertEqual(self._get(), {})
+        self.fetch_allowed.set()
+        self._join_refresh()
+        self.assertEqual(self._get(), {"project-a": {"Reviewer A": 1}})
+        self.assertEqual(self.fetch_count, 1)
+
+    def test_database_error_while_fetching(self):
+        self.open_load = DatabaseError("database is locked")
+        with self.assertLogs(level='ERROR') as logs:
+            self._get_first()
+        self.assertIn("database is locked", logs.output[0])
+        # not retried until the refresh lock expires
+        self.assertEqual(self._get(), {})
+        self._join_refresh()
+        self.assertEqual(self.fetch_count, 1)
+
+    def test_invalidated(self):
+        self._get_first()
+        self.open_load = {}
+        open_load_cache.invalidate()
+        self.assertEqual(self._get(), {"project-a": {"Reviewer A": 1}})
+        self._join_refresh()
+        self.assertEqual(self._get(), {})
+        self.assertEqual(self.fetch_count, 2)
+
+
+class TestStreamEvents(TestCase):
+    """Tests that events replayed from gerrit stream-events are applied in
+    batches to the changes and open changes stored, and that changes missed
+    are caught up on each time the stream is connected
+    """
+    # events as recorded from gerrit stream-events, along with ones that are
+    # ignored
+    RECORDED_EVENTS = [
+        '{"type": "reviewer-added", "change": {"project": "project-a", '
+        '"number": "1"}, "reviewer": {"name": "Reviewer A"}}',
+        '{"type": "comment-added", "change": {"project": "project-a", '
+        '"number": "2"}, "author": {"name": "Reviewer B"}}',
+        '{"type": "change-merged", "change": {"project": "project-a", '
+        '"number": "3", "id": "I3"}, "submitter": {"name": "Owner"}}',
+        '{"type": "change-abandoned", "change": {"project": "project-a", '
+        '"number": "4"}, "abandoner": {"name": "Owner"}}',
+        '{"type": "ref-updated", "refUpdate": {"project": "project-a"}}',
+        'not an event',
+    ]
+
+    class _Stream:
+        """Stream of given lines, which stays open for more, like gerrit's,
+        if wait is set
+        """
+
+        def __init__(self, lines, wait=False):
+            self.lines = lines
+            self.wait = wait
+            self.closed = threading.Event()
+
+        def __iter__(self):
+            for line in self.lines:
+                yield line
+            if self.wait:
+                self.closed.wait(TestPipeline.TIMEOUT)
+
+        def close(self):
+            self.closed.set()
+
+    def _mock_fetch_changes(self, hostname, username, numbers, status,
+                            port=29418, raise_errors=False):
+        self.calls.append((status, sorted(numbers)))
+        return [self.gerrit_changes[(status, number)] for number in numbers
+                if (status, number) in self.gerrit_changes]
+
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+        self.saved_fetch_changes = fetch.fetch_changes
+        fetch.fetch_changes = self._mock_fetch_changes
+        self.timestamp = int(time.time()) - 3600
+        self.gerrit_changes = {}
+        # open changes as fetched when events are applied
+        for number, reviewers in [(1, ["Reviewer A"]),
+                                  (2, ["Reviewer A", "Reviewer B"])]:
+            self.gerrit_changes[("open", number)] = \
+                self._make_gerrit_change(number, reviewers)
+        merged_change = self._make_gerrit_change(3, ["Reviewer B"])
+        merged_change.change_id = "I3"
+        merged_change.owner = Account([])
+        merged_change.owner.name = "Owner"
+        merged_change.subject = "A merged change"
+        merged_change.comments = []
+        for reviewer_name in ["Reviewer A", "Reviewer B"]:
+            gerrit_comment = GerritComment([])
+            gerrit_comment.timestamp = str(self.timestamp)
+            gerrit_comment.reviewer = Account([])
+            gerrit_comment.reviewer.name = reviewer_name
+            gerrit_comment.message = "Looks good"
+            merged_change.comments.append(gerrit_comment)
+        self.gerrit_changes[("merged", 3)] = merged_change
+        # open changes stored before the events
+        current_load_database_helper.update([
+            self._make_gerrit_change(1, []),
+            self._make_gerrit_change(3, ["Reviewer B"]),
+            self._make_gerrit_change(4, ["Reviewer A"])])
+
+    def tearDown(self):
+        fetch.fetch_changes = self.saved_fetch_changes
+
+    def _make_gerrit_change(self, number, reviewers):
+        gerrit_change = GerritChange([])
+        gerrit_change.number = str(number)
+        gerrit_change.project = "project-a"
+        gerrit_change.last_update_timestamp = str(self.timestamp)
+        for reviewer_name in reviewers:
+            reviewer = Account([])
+            reviewer.name = reviewer_name
+            gerrit_change.reviewers.append(reviewer)
+        return gerrit_change
+
+    def _consume(self, lines, window=TestPipeline.TIMEOUT):
+        return events.consume(events.read_events(lines), GerritFetchConfig(),
+                              window=window)
+
+    def _assert_applied(self):
+        self.assertEqual(list(Change.objects.values_list('change_id',
+                                                         flat=True)), ["I3"])
+        self.assertEqual(Comment.objects.count(), 2)
+        self.assertEqual(
+            current_load_database_helper.get_stored_numbers(), {1, 2})
+        self.assertEqual(
+            current_load_database_helper.get_open_change_reviewers_per_project(),
+            {"project-a": {"Reviewer A": 2, "Reviewer B": 1}})
+
+    def test_events_applied(self):
+        self.assertEqual(self._consume(self.RECORDED_EVENTS), 4)
+        # all events applied as one batch
+        self.assertEqual(self.calls, [("merged", [1, 2, 3]),
+                                      ("open", [1, 2])])
+        self._assert_applied()
+        # leaderboards read changes stored from events
+        self.assertEqual(database_helper.get_generation(), 1)
+        self.assertFalse(lease.is_held(SyncState.QUERY_MERGED))
+        self.assertFalse(lease.is_held(SyncState.QUERY_OPEN))
+
+    def test_events_batched_in_windows(self):
+        def slow_lines():
+            yield self.RECORDED_EVENTS[0]
+            yield self.RECORDED_EVENTS[2]
+            time.sleep(0.3)
+            yield self.RECORDED_EVENTS[1]
+
+        self.assertEqual(self._consume(slow_lines(), window=0.1), 3)
+        self.assertEqual(self.calls, [("merged", [1, 3]), ("open", [1]),
+                                      ("merged", [2]), ("open", [2])])
+
+    def test_comment_added_to_merged_change(self):
+        merged_change = self.gerrit_changes[("merged", 3)]
+        stored_change = copy.copy(merged_change)
+        stored_change.comments = merged_change.comments[:1]
+        database_helper.update([stored_change])
+        self.assertEqual(self._consume([
+            '{"type": "comment-added", "change": {"project": "project-a", '
+            '"number": "3"}, "author": {"name": "Reviewer B"}}']), 1)
+        self.assertEqual(self.calls, [("merged", [3]), ("open", [3])])
+        self.assertEqual(Change.objects.get().comment_count, 2)
+        self.assertEqual(
+            sorted(Comment.objects.values_list('reviewer__full_name',
+                                               flat=True)),
+            ["Reviewer A", "Reviewer B"])
+
+    def test_generation_bumped_when_changes_stored(self):
+        generation = database_helper.get_generation()
+        # open changes only
+        self._consume(self.RECORDED_EVENTS[:1])
+        self.assertEqual(database_helper.get_generation(), generation)
+        self._consume(self.RECORDED_EVENTS[2:3])
+        self.assertEqual(database_helper.get_generation(), generation + 1)
+        # merged change already stored
+        self._consume(self.RECORDED_EVENTS[2:3])
+        self.assertEqual(database_helper.get_generation(), generation + 1)
+        self.assertEqual(SyncState.objects.get(
+            query_type=SyncState.QUERY_EVENTS).status,
+            SyncState.STATUS_SUCCEEDED)
+
+    def test_caught_up_on_connecting(self):
+        def open_event_stream(hostname, username, port):
+            self.calls.append("connect")
+            if self.calls.count("connect") == 1:
+                raise GerritError("Connection refused")
+            return self._Stream(self.RECORDED_EVENTS)
+
+        saved_functions = (gerrit_connection.open_event_stream,
+                           fetcher.pull_and_store_changes,
+                           current_load_fetcher.refresh_open_changes)
+        gerrit_connection.open_event_stream = open_event_stream
+        fetcher.pull_and_store_changes = \
+            lambda wait=False: self.calls.append(("sync", wait))
+        current_load_fetcher.refresh_open_changes = \
+            lambda: self.calls.append("refresh")
+        try:
+            self.assertTrue(events.run(window=TestPipeline.TIMEOUT,
+                                       reconnect_delay=0, connection_count=3))
+        finally:
+            (gerrit_connection.open_event_stream,
+             fetcher.pull_and_store_changes,
+             current_load_fetcher.refresh_open_changes) = saved_functions
+        # connected again after failing, and after the stream ended
+        caught_up_calls = ["connect", ("sync", True), "refresh",
+                           ("merged", [1, 2, 3]), ("open", [1, 2])]
+        self.assertEqual(self.calls,
+                         ["connect"] + caught_up_calls + caught_up_calls)
+        self._assert_applied()
+        self.assertFalse(lease.is_held(SyncState.QUERY_EVENTS))
+
+    def test_reviewer_cache_replaced_after_failure(self):
+        reviewer_caches = []
+
+        def apply_events(batch, config, reviewer_cache):
+            reviewer_caches.append(reviewer_cache)
+            if len(reviewer_caches) == 1:
+                raise DatabaseError("database is locked")
+            return len(batch)
+
+        saved_functions = (gerrit_connection.open_event_stream,
+                           events.catch_up, events.apply_events)
+        gerrit_connection.open_event_stream = \
+            lambda hostname, username, port: self._Stream(
+                self.RECORDED_EVENTS[:1])
+        events.catch_up = lambda: None
+        events.apply_events = apply_events
+        try:
+            events.run(window=TestPipeline.TIMEOUT, reconnect_delay=0,
+                       connection_count=3)
+        finally:
+            (gerrit_connection.open_event_stream, events.catch_up,
+             events.apply_events) = saved_functions
+        # reviewers cached by the failed batch aren't used again, others are
+        self.assertEqual(len(reviewer_caches), 3)
+        self.assertIsNot(reviewer_caches[1], reviewer_caches[0])
+        self.assertIs(reviewer_caches[2], reviewer_caches[1])
+
+    def test_reader_stopped_when_applying_fails(self):
+        def apply_events(batch, config, reviewer_cache):
+            raise DatabaseError("database is locked")
+
+        stream = self._Stream(self.RECORDED_EVENTS, wait=True)
+        saved_apply_events = events.apply_events
+        events.apply_events = apply_events
+        try:
+            with self.assertRaises(DatabaseError):
+                events.consume(events.read_events(stream), GerritFetchConfig(),
+                               window=0, stream=stream)
+        finally:
+            events.apply_events = saved_apply_events
+        self.assertTrue(stream.closed.is_set())
+        self.assertNotIn("leaderboard-event-reader",
+                         [thread.name for thread in threading.enumerate()])
+
+    def test_events_streamed_once(self):
+        self.assertTrue(lease.acquire(SyncState.QUERY_EVENTS, "other"))
+        self.assertFalse(events.run(connection_count=1))
+        self.assertEqual(self.calls, [])
+
+
+class TestArchive(TestCase):
+    """Tests that pages of changes fetched are archived, and that changes can
+    be stored again from the archive
+    """
+
+    class _FakePool:
+        def __init__(self, pages):
+            self.pages = pages
+
+        def query(self, hostname, username, port, gerrit_query):
+            return self.pages.pop(0)
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        archive.pages.directory = self.archive_dir
+        self.saved_pool = gerrit_connection.pool
+        # time comments were posted at, and changes last updated at, midday
+        # so that changes updated a little later are counted on the same day
+        self.comment_timestamp = calendar.timegm(
+            (date.today() - timedelta(days=1)).timetuple()) + 12 * 3600
+        self.timestamp = self.comment_timestamp
+
+    def tearDown(self):
+        archive.pages.directory = None
+        gerrit_connection.pool = self.saved_pool
+        shutil.rmtree(self.archive_dir)
+
+    def _make_gerrit_change(self, change_id, comments):
+        gerrit_change = GerritChange([])
+        gerrit_change.change_id = change_id
+        gerrit_change.number = change_id[-1]
+        gerrit_change.project = "project-a"
+        gerrit_change.subject = "A change"
+        gerrit_change.owner = Account([])
+        gerrit_change.owner.name = "Owner"
+        gerrit_change.last_update_timestamp = str(self.timestamp)
+        gerrit_change.comments = []
+        for reviewer_name, message in comments:
+            gerrit_comment = GerritComment([])
+            gerrit_comment.timestamp = str(self.comment_timestamp)
+            gerrit_comment.reviewer = Account([])
+            gerrit_comment.reviewer.name = reviewer_name
+            gerrit_comment.message = message
+            gerrit_change.comments.append(gerrit_comment)
+            gerrit_change.reviewers.append(gerrit_comment.reviewer)
+        return gerrit_change
+
+    def _fetch(self, fetch_changes, *pages):
+        gerrit_connection.pool = self._FakePool(list(pages))
+        for _ in pages:
+            fetch_changes()
+
+    def _fetch_merged(self, *pages):
+        self._fetch(lambda: fetch.fetch_merged_changes(
+            "gerrit.myhost.com", "user", datetime.utcnow()), *pages)
+
+    def test_fetched_pages_archived(self):
+        gerrit_change = self._make_gerrit_change(
+            "I1", [("Reviewer A", "Looks good")])
+        self._fetch_merged([gerrit_change], [])
+        self._fetch(lambda: fetch.fetch_open_changes("gerrit.myhost.com",
+                                                     "user"),
+                    [self._make_gerrit_change("I2", [])])
+        # empty pages aren't archived
+        pages = list(archive.read_pages(self.archive_dir))
+        self.assertEqual(len(pages), 2)
+        merged_pages = list(archive.read_pages(self.archive_dir, "merged"))
+        self.assertEqual(len(merged_pages), 1)
+        gerrit_query, gerrit_changes = merged_pages[0]
+        self.assertTrue(gerrit_query.startswith("status:merged after:"))
+        self.assertEqual(archive.change_to_json(gerrit_changes[0]),
+                         archive.change_to_json(gerrit_change))
+        self.assertEqual(gerrit_changes[0].comments[0].reviewer.name,
+                         "Reviewer A")
+
+    def test_event_fetches_archived(self):
+        saved_pages = archive.pages
+        saved_archive_dir = GerritFetchConfig.archive_dir
+        GerritFetchConfig.archive_dir = lambda config: self.archive_dir
+        try:
+            apps.get_app_config('leaderboard').ready()
+            self.assertIsNot(archive.pages, saved_pages)
+            gerrit_connection.pool = self._FakePool(
+                [[self._make_gerrit_change("I1", [])]])
+            events.apply_events(
+                [{"type": "change-merged",
+                  "change": {"project": "project-a", "number": "1"}}],
+                GerritFetchConfig(), ReviewerCache())
+        finally:
+            archive.pages = saved_pages
+            GerritFetchConfig.archive_dir = saved_archive_dir
+        merged_pages = list(archive.read_pages(self.archive_dir, "merged"))
+        self.assertEqual(len(merged_pages), 1)
+        self.assertEqual(merged_pages[0][1][0].change_id, "I1")
+
+    def test_reprocess_archive(self):
+        database_helper.update([self._make_gerrit_change("I0", [])])
+        self._fetch_merged(
+            [self._make_gerrit_change("I1", [("Reviewer A", "Nit")])],
+            [self._make_gerrit_change("I3", [("Reviewer B", "Typo")])])
+        self._fetch(lambda: fetch.fetch_open_changes("gerrit.myhost.com",
+                                                     "user"),
+                    [self._make_gerrit_change("I2", [("Reviewer C", "Hmm")])])
+        # fetched again with comments added after merging
+        self.timestamp += 60
+        self._fetch_merged([self._make_gerrit_change(
+            "I1", [("Reviewer A", "Nit"), ("Reviewer B", "Code-Review+2"),
+                   ("Reviewer C", "Why?")])])
+        page_counts = []
+        self.assertEqual(
+            fetcher.reprocess_archive(
+                self.archive_dir,
+                lambda page_count, change_count: page_counts.append(
+                    (page_count, change_count))),
+            (3, 3))
+        self.assertEqual(page_counts, [(1, 1), (2, 2), (3, 3)])
+        # open changes aren't stored, and ignored comments aren't counted
+        self.assertEqual(sorted(Change.objects.values_list('change_id',
+                                                           flat=True)),
+                         ["I1", "I3"])
+        self.assertEqual(
+            sorted(Comment.objects.values_list('reviewer__full_name',
+                                               'change__change_id')),
+            [("Reviewer A", "I1"), ("Reviewer B", "I3"),
+             ("Reviewer C", "I1")])
+        self.assertFalse(Reviewer.objects.filter(full_name="Owner").exists())
+        daily_stats = sorted(ReviewerDailyStats.objects.values_list(
+            'reviewer__full_name', 'review_count', 'comment_count'))
+        self.assertEqual(daily_stats, [("Reviewer A", 1, 1),
+                                       ("Reviewer B", 1, 1),
+                                       ("Reviewer C", 1, 1)])
+        database_helper.rebuild_daily_stats()
+        self.assertEqual(daily_stats, sorted(
+            ReviewerDailyStats.objects.values_list(
+                'reviewer__full_name', 'review_count', 'comment_count')))
+        self.assertEqual(database_helper.get_generation(), 2)
+
+    def test_reprocess_missing_archive(self):
+        database_helper.update([self._make_gerrit_change(
+            "I1", [("Reviewer A", "Nit")])])
+        with self.assertRaises(OSError):
+            fetcher.reprocess_archive(self.archive_dir + "/missing")
+        self._fetch_merged([self._make_gerrit_change("I2", [])])
+        page_file = archive.read_index(self.archive_dir)[0]['file']
+        os.remove(os.path.join(self.archive_dir, page_file))
+        with self.assertRaises(OSError):
+            fetcher.reprocess_archive(self.archive_dir)
+        # nothing is removed if the archive can't be read
+        self.assertEqual(list(Change.objects.values_list('change_id',
+                                                         flat=True)),
+                         ["I1"])
+        self.assertEqual(Comment.objects.count(), 1)
+
+    def test_reprocess_archive_older_changes_stored(self):
+        # stored before pages were archived
+        self.timestamp -= 3600
+        database_helper.update([self._make_gerrit_change(
+            "I1", [("Reviewer A", "Nit")])])
+        self.timestamp += 3600
+        self._fetch_merged([self._make_gerrit_change("I2", [])])
+        with self.assertRaises(ValueError):
+            fetcher.reprocess_archive(self.archive_dir)
+        self.assertEqual(list(Change.objects.values_list('change_id',
+                                                         flat=True)),
+                         ["I1"])
+        self.assertEqual(Comment.objects.count(), 1)
+
+
+class TestImport(TestCase):
+    """Tests that changes are stored from files of gerrit query output"""
+
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.timestamp = calendar.timegm(
+            (date.today() - timedelta(days=1)).timetuple()) + 12 * 3600
+
+    def tearDown(self):
+        shutil.rmtree(self.dump_dir)
+
+    def _change_line(self, change_id, status, comments):
+        return json.dumps({
+            "project": "project-a", "id": change_id,
+            "number": int(change_id[1:]), "subject": "A change",
+            "owner": {"name": "Owner", "username": "owner"},
+            "lastUpdated": self.timestamp, "status": status,
+            "comments": [{"timestamp": self.timestamp,
+                          "reviewer": {"name": reviewer_name},
+                          "message": message}
+                         for reviewer_name, message in comments]}) + "\n"
+
+    def test_import_dumps(self):
+        dump_path = self.dump_dir + "/changes.json"
+        with open(dump_path, 'w') as dump_file:
+            dump_file.write(self._change_line(
+                "I1", "MERGED", [("Reviewer A", "Nit")]))
+            dump_file.write(self._change_line(
+                "I2", "NEW", [("Reviewer B", "Hmm")]))
+            dump_file.write("{truncated\n")
+            dump_file.write('{"type": "stats", "rowCount": 2}\n')
+        gzip_path = self.dump_dir + "/more-changes.json.gz"
+        with gzip.open(gzip_path, 'wt') as dump_file:
+            # captured again with a comment added after merging
+            dump_file.write(self._change_line(
+                "I1", "MERGED", [("Reviewer A", "Nit"),
+                                 ("Reviewer B", "Why?")]))
+            dump_file.write(self._change_line(
+                "I3", "MERGED", [("Reviewer A", "Typo")]))
+        self.assertEqual(
+            [len(batch) for batch in dump.read_changes(gzip_path,
+                                                       batch_size=1)],
+            [1, 1])
+        self.assertEqual(fetcher.import_dumps([dump_path, gzip_path],
+                                              max_workers=2), (3, 4))
+        # imported again, nothing is stored twice
+        fetcher.import_dumps([gzip_path, dump_path])
+        self.assertEqual(sorted(Change.objects.values_list('change_id',
+                                                           flat=True)),
+                         ["I1", "I3"])
+        self.assertEqual(
+            sorted(Comment.objects.values_list('reviewer__full_name',
+                                               'change__change_id')),
+            [("Reviewer A", "I1"), ("Reviewer A", "I3"),
+             ("Reviewer B", "I1")])
+        self.assertEqual(sorted(ReviewerDailyStats.objects.values_list(
+            'reviewer__full_name', 'review_count', 'comment_count')),
+            [("Reviewer A", 2, 2), ("Reviewer B", 1, 1)])
+
+    def test_import_modifies_leaderboard(self):
+        dump_path = self.dump_dir + "/changes.json"
+        with open(dump_path, 'w') as dump_file:
+            dump_file.write(self._change_line(
+                "I1", "MERGED", [("Reviewer A", "Nit")]))
+        database_helper.finish_sync(
+            database_helper.start_sync("gerrit.myhost.com"), 0)
+        an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+        SyncState.objects.update(finished=an_hour_ago)
+        DataGeneration.objects.update(updated=an_hour_ago)
+        query = {'from': str(date.today() - timedelta(days=7)),
+                 'to': str(date.today())}
+        last_modified = self.client.get('/api/leaderboard',
+                                        query)['Last-Modified']
+        self.assertEqual(self.client.get(
+            '/api/leaderboard', query,
+            HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        fetcher.import_dumps([dump_path])
+        response = self.client.get('/api/leaderboard', query,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [reviewer['name'] for reviewer in response.json()['reviewers']],
+            ["Reviewer A"])
+
+
+@override_settings(CACHES=TEST_CACHES)
+@skipUnless(connection.vendor == 'sqlite',
+            "Query plans are checked with sqlite's EXPLAIN QUERY PLAN")
+class TestQueryPlans(TestCase):
+    """Test that queries made as changes are stored and pages are viewed use
+    indexes rather than scanning whole tables"""
+    # tables with a row per type of sync or project, or a single row, which
+    # are listed in full
+    SMALL_TABLES = ("leaderboard_syncstate", "leaderboard_datageneration",
+                    "leaderboard_project")
+
+    def _assert_no_full_scans(self, queries, whole_table_queries=()):
+        """Assert queries only look up rows using indexes
+
+        :arg list queries: queries captured
+        :arg iterable whole_table_queries: SQL of queries that read whole
+            tables on purpose
+        """
+        with connection.cursor() as cursor:
+            for query in queries:
+                sql = query['sql']
+                if not sql.startswith(("SELECT", "UPDATE", "DELETE")) or \
+                        sql in whole_table_queries:
+                    continue
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    # scans using an index, even a covering one, read all of
+                    # it, only searches look up rows. A scan of an index in
+                    # the order asked for stops once the limit is reached.
+                    match = re.match(r"SCAN (?:TABLE )?(leaderboard_\w+)",
+                                     detail)
+                    if match and "USING" in detail and \
+                            re.search(r" LIMIT \d+$", sql):
+                        continue
+                    if match and match.group(1) not in self.SMALL_TABLES:
+                        self.fail("Full scan of %s by query:\n%s\n%s" % (
+                            match.group(1), sql, detail))
+
+    def _make_gerrit_changes(self, first_number, count):
+        gerrit_changes = []
+        for number in range(first_number, first_number + count):
+            gerrit_change = FakeGerritClient.make_change(
+                number, int(time.time()) - number)
+            for reviewer_name in ["Jungle Boy", "City Girl"]:
+                gerrit_comment = GerritComment([])
+                gerrit_comment.timestamp = gerrit_change.last_update_timestamp
+                gerrit_comment.reviewer = Account([])
+                gerrit_comment.reviewer.name = reviewer_name
+                gerrit_comment.message = "Looks good"
+                gerrit_change.comments.append(gerrit_comment)
+            gerrit_changes.append(gerrit_change)
+        return gerrit_changes
+
+    def test_store_changes(self):
+        database_helper.update(self._make_gerrit_changes(0, 10))
+        with CaptureQueriesContext(connection) as queries:
+            # new changes, with reviewers and daily stats already stored
+            database_helper.update(self._make_gerrit_changes(5, 10))
+            sync_state = database_helper.start_sync("gerrit.myhost.com")
+            database_helper.advance_sync(sync_state, datetime.utcnow(), 1)
+            database_helper.finish_sync(sync_state, 10)
+            database_helper.get_project_names()
+        self._assert_no_full_scans(queries)
+
+    def test_store_open_changes(self):
+        gerrit_changes = self._make_gerrit_changes(0, 10)
+        for gerrit_change in gerrit_changes:
+            gerrit_change.reviewers = [gerrit_comment.reviewer for
+                                       gerrit_comment in gerrit_change.comments]
+        current_load_database_helper.update(gerrit_changes)
+        with CaptureQueriesContext(connection) as queries:
+            current_load_database_helper.update(gerrit_changes[:5])
+            current_load_database_helper.retire([5, 6, 20])
+        self._assert_no_full_scans(queries)
+
+    def test_view(self):
+        database_helper.update(self._make_gerrit_changes(0, 10))
+        self.client.get('/')
+        # pages are read without results cached
+        cache.clear()
+        range_index.invalidate()
+        open_load_cache.cache.set(open_load_cache.SNAPSHOT_KEY,
+                                  ({}, time.time()), None)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/', {'project_name': "project-1",
+                                   'time_period': "1 Week"})
+            self.client.get('/api/leaderboard', {'project': "project-1"})
+        # the range index is built from all daily stats, once per data
+        # generation
+        with CaptureQueriesContext(connection) as range_index_queries:
+            range_index._build()
+        range_index_sql = [query['sql'] for query in range_index_queries]
+        self.assertTrue(set(range_index_sql).issubset(
+            query['sql'] for query in queries))
+        self._assert_no_full_scans(queries, range_index_sql)
+
+
+class TestRangeIndex(TestCase):
+    DAY = date(2016, 2, 1)
+
+    def setUp(self):
+        range_index.invalidate()
+
+    def _add_daily_stats(self, reviewer_name, project_name, days_after,
+                         review_count, comment_count):
+        reviewer, _ = Reviewer.objects.get_or_create(full_name=reviewer_name)
+        ReviewerDailyStats.objects.create(
+            reviewer=reviewer,
+            project=Project.objects.get_or_create(name=project_name)[0],
+            day=self.DAY + timedelta(days=days_after),
+            review_count=review_count, comment_count=comment_count)
+
+    def _assert_counts(self, expected_counts, project_name, from_days_after,
+                       to_days_after=None):
+        to_day = None if to_days_after is None else \
+            self.DAY + timedelta(days=to_days_after)
+        self.assertEqual(
+            sorted(expected_counts),
+            sorted(range_index.get_index().get_reviewers_and_counts(
+                project_name, self.DAY + timedelta(days=from_days_after),
+                to_day)))
+
+    def test_ranges(self):
+        self._add_daily_stats("Jungle Boy", "foo", 0, 1, 2)
+        self._add_daily_stats("Jungle Boy", "foo", 3, 2, 0)
+        self._add_daily_stats("Jungle Boy", "bar", 3, 1, 1)
+        self._add_daily_stats("Jungle Boy", "bar", 10, 4, 5)
+        self._add_daily_stats("City Girl", "foo", 5, 0, 3)
+        self._add_daily_stats("City Girl", "bar", 7, 3, 1)
+        all_projects = range_index.ALL_PROJECTS
+        self._assert_counts([("Jungle Boy", 8, 8), ("City Girl", 3, 4)],
+                            all_projects, -5)
+        self._assert_counts([("Jungle Boy", 3, 1), ("City Girl", 3, 4)],
+                            all_projects, 1, 9)
+        self._assert_counts([("Jungle Boy", 3, 2)], "foo", 0, 3)
+        # reviewers without changes in a range aren't included
+        self._assert_counts([("Jungle Boy", 2, 0)], "foo", 1)
+        self._assert_counts([("City Girl", 3, 1)], "bar", 4, 9)
+        self._assert_counts([], "bar", 11)
+        self._assert_counts([], "bar", 8, 9)
+        self._assert_counts([], "biz", -5)
+
+    def test_built_again_after_sync(self):
+        self._add_daily_stats("Jungle Boy", "foo", 0, 1, 2)
+        self._assert_counts([("Jungle Boy", 1, 2)], "foo", 0)
+        self._add_daily_stats("Jungle Boy", "foo", 1, 1, 0)
+        # the index is only built again once a sync has finished
+        with self.assertNumQueries(1):
+            self._assert_counts([("Jungle Boy", 1, 2)], "foo", 0)
+        sync_state = database_helper.start_sync("gerrit.myhost.com")
+        database_helper.finish_sync(sync_state, 1)
+        self._assert_counts([("Jungle Boy", 2, 2)], "foo", 0)
+
 
 class TestView(TestCase):
     # Mocks dictionary returned by mock open changes fetcher
     _mock_open_change_reviewers_per_project = {}
 
     def setUp(self):
+        # don't use open change load cached by other tests
+        cache.clear()
+        # nor the range index built by other tests
+        range_index.invalidate()
         self._saved_curr_load_fetcher = \
             current_load_fetcher.get_open_change_reviewers_per_project
         current_load_fetcher.get_open_change_reviewers_per_project = \
@@ -573,9 +2543,30 @@ class TestView(TestCase):
         current_load_fetcher.get_open_change_reviewers_per_project = \
             self._saved_curr_load_fetcher
 
-    def _mock_get_open_change_reviewers_per_project(self):
+    def _mock_get_open_change_reviewers_per_project(self, raise_errors=False):
         return self._mock_open_change_reviewers_per_project
 
+    def _set_open_load(self, open_load):
+        # as fetched in the background the first time it was asked for
+        open_load_cache.cache.set(open_load_cache.SNAPSHOT_KEY,
+                                  (open_load, time.time()), None)
+
+    def test_index_does_not_sync(self):
+        """Test that the page only reads from the database and shows the last
+        sync's outcome"""
+        saved_pull_and_store_changes = fetcher.pull_and_store_changes
+        fetcher.pull_and_store_changes = lambda: self.fail(
+            "View should not sync changes")
+        try:
+            response = self.client.get('/')
+            self.assertContains(response, "have not been synced")
+            sync_state = database_helper.start_sync("gerrit.myhost.com")
+            database_helper.finish_sync(sync_state, 10)
+            response = self.client.get('/')
+            self.assertContains(response, "(Succeeded)")
+        finally:
+            fetcher.pull_and_store_changes = saved_pull_and_store_changes
+
     def _assert_time_period_list(self, expected_list, found_list):
         index = 0
         for expected_time_period in expected_list:
@@ -636,7 +2627,7 @@ class TestView(TestCase):
         change = Change()
         change.change_id = "test-change-id-" + str(change_id)
         change.owner_full_name = "John Smith"
-        change.project_name = project_name
+        change.project, _ = Project.objects.get_or_create(name=project_name)
         change.subject = "A test commit"
         change.timestamp = timestamp
         change.save()
@@ -699,7 +2690,9 @@ class TestView(TestCase):
         reviewer = Reviewer()
         reviewer.full_name = reviewer_name
         reviewer.save()
-        reviewer.comments.add(*comments)
+        for comment in comments:
+            comment.reviewer = reviewer
+            comment.save()
         reviewer.changes.add(*changes)
         reviewer.save()
 
@@ -710,7 +2703,7 @@ class TestView(TestCase):
         # comment change link doesn't affect the view in any way, but is needed
         # by the model
         comment.change = mock_change
-        comment.save()
+        # saved once its reviewer is created
         return comment
 
     def _create_comments(self, mock_change, count):
@@ -804,6 +2797,8 @@ class TestView(TestCase):
                               self._create_comments(mock_change, 4))
 
         dump_db("test_reviewers.txt")
+        # reviewers were created directly, so count their daily stats
+        database_helper.rebuild_daily_stats()
 
         # one week, all projects
         expected_reviewers = [
@@ -892,6 +2887,34 @@ class TestView(TestCase):
         ]
         self._assert_reviewers(projectc, "6 Months", expected_reviewers)
 
+    def _assert_reviewers_query_count(self, reviewer_count):
+        mock_change = self._create_change("mock_change", "project-a")
+        changes = self._create_changes("project-a", 1, 2)
+        for index in range(reviewer_count):
+            self._create_reviewer("Reviewer %d" % index, changes,
+                                  self._create_comments(mock_change, 2))
+        # reviewers were created directly, so count their daily stats
+        database_helper.rebuild_daily_stats()
+        range_index.invalidate()
+        from_datetime = views._get_start_datetime_for_time_period("1 Week")
+        views._get_reviewers_and_counts(views.PROJECT_ALL, from_datetime)
+        for project_name in [views.PROJECT_ALL, "project-a"]:
+            with self.assertNumQueries(1):
+                reviewers_info = views._get_reviewers_and_counts(
+                    project_name, from_datetime)
+            self.assertEqual(reviewer_count, len(reviewers_info))
+            for reviewer_info in reviewers_info:
+                self.assertEqual(2, reviewer_info["review_count"])
+                self.assertEqual(2, reviewer_info["comment_count"])
+
+    def test_get_reviewers_and_counts_query_count(self):
+        """Test that the number of queries for reviewer counts doesn't grow
+        with the number of reviewers"""
+        self._assert_reviewers_query_count(1)
+        Reviewer.objects.all().delete()
+        Change.objects.all().delete()
+        self._assert_reviewers_query_count(20)
+
     def _compare_dic_list(self, expected_list, found_list):
         self.assertEqual(len(expected_list),
                          len(found_list),
@@ -907,8 +2930,136 @@ class TestView(TestCase):
                 self.fail("Expected reviewer info %r not found in %r" %
                           (expected_dic, found_list))
 
+    def test_index_custom_time_period(self):
+        changes = self._create_changes("project-a", 20, 2) + \
+            self._create_changes("project-a", 10, 1)
+        self._create_reviewer("Kutty Krishnan", changes, [])
+        database_helper.rebuild_daily_stats()
+        today = datetime.utcnow().date()
+        from_date = (today - timedelta(days=25)).strftime("%Y-%m-%d")
+        to_date = (today - timedelta(days=15)).strftime("%Y-%m-%d")
+        response = self.client.post('/', {
+            'project_name': views.PROJECT_ALL, 'time_period': "1 Week",
+            'from_date': from_date, 'to_date': to_date})
+        self.assertEqual(
+            [views._create_reviewer_info("Kutty Krishnan", 2, 0)],
+            response.context['reviewers'])
+        self.assertEqual(from_date, response.context['from_date'])
+        # a time period selected ends on the last day entered
+        response = self.client.post('/', {
+            'project_name': views.PROJECT_ALL, 'time_period': "1 Week",
+            'from_date': "", 'to_date': to_date})
+        self.assertEqual(
+            [views._create_reviewer_info("Kutty Krishnan", 2, 0)],
+            response.context['reviewers'])
+        # invalid dates are ignored
+        response = self.client.post('/', {
+            'project_name': views.PROJECT_ALL, 'time_period': "1 Month",
+            'from_date': "invalid date", 'to_date': ""})
+        self.assertEqual(
+            [views._create_reviewer_info("Kutty Krishnan", 3, 0)],
+            response.context['reviewers'])
+
+    def test_results_cached_for_generation(self):
+        """Test that results are cached until the data generation changes"""
+        changes = self._create_changes("project-a", 1, 2)
+        self._create_reviewer("Kutty Krishnan", changes, [])
+        database_helper.rebuild_daily_stats()
+        from_datetime = views._get_start_datetime_for_time_period("1 Week")
+        expected_reviewers = [
+            views._create_reviewer_info("Kutty Krishnan", 2, 0)]
+        self.assertEqual(expected_reviewers, views._get_reviewers_and_counts(
+            "project-a", from_datetime))
+        self.assertEqual(["project-a", views.PROJECT_ALL],
+                         views._get_projects("project-a"))
+        # changed without committing a sync, so not seen
+        ReviewerDailyStats.objects.update(review_count=3)
+        self._create_change("another", "project-b")
+        range_index.invalidate()
+        with self.assertNumQueries(1):
+            self.assertEqual(expected_reviewers,
+                             views._get_reviewers_and_counts(
+                                 "project-a", from_datetime))
+            self.assertEqual(["project-a", views.PROJECT_ALL],
+                             views._get_projects("project-a", 1))
+        database_helper.bump_generation()
+        self.assertEqual(
+            [views._create_reviewer_info("Kutty Krishnan", 3, 0)],
+            views._get_reviewers_and_counts("project-a", from_datetime))
+        self.assertEqual(["project-a", views.PROJECT_ALL, "project-b"],
+                         views._get_projects("project-a"))
+
+    def test_api_leaderboard(self):
+        self._create_reviewer("Kutty Krishnan",
+                              self._create_changes("project-a", 1, 2), [])
+        self._create_reviewer("Sharada Mani",
+                              self._create_changes("project-a", 10, 3), [])
+        sync_state = database_helper.start_sync("gerrit.myhost.com")
+        database_helper.finish_sync(sync_state, 5)
+        database_helper.rebuild_daily_stats()
+        response = self.client.get('/api/leaderboard',
+                                   {'project': "project-a"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [views._create_reviewer_info("Sharada Mani", 3, 0),
+             views._create_reviewer_info("Kutty Krishnan", 2, 0)],
+            response.json()['reviewers'])
+        self.assertTrue(response.has_header('Last-Modified'))
+        etag = response['ETag']
+        # revalidated by looking up the data generation and when it changed
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/leaderboard',
+                                       {'project': "project-a"},
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(2, len([query for query in queries
+                                 if query['sql'].startswith("SELECT")]))
+        response = self.client.get('/api/leaderboard',
+                                   {'project': "project-a",
+                                    'period': "1 Week"},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [views._create_reviewer_info("Kutty Krishnan", 2, 0)],
+            response.json()['reviewers'])
+        # changes committed by a sync change the ETag
+        sync_state = database_helper.start_sync("gerrit.myhost.com")
+        database_helper.finish_sync(sync_state, 0)
+        response = self.client.get('/api/leaderboard',
+                                   {'project': "project-a"},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_api_leaderboard_invalid_query(self):
+        for query in [{'period': "1 Year"}, {'from': "2016-02-30"},
+                      {'to': "yesterday"}]:
+            response = self.client.get('/api/leaderboard', query)
+            self.assertEqual(400, response.status_code)
+            self.assertIn('error', response.json())
+        response = self.client.post('/api/leaderboard')
+        self.assertEqual(405, response.status_code)
+
+    def test_api_open_load(self):
+        self._set_open_load({
+            "project-a": {"Kutty Krishnan": 2, "Sharada Mani": 3},
+            "project-b": {"Kutty Krishnan": 4},
+        })
+        response = self.client.get('/api/open-load')
+        self.assertEqual(
+            [{"name": "Kutty Krishnan", "review_count": 6},
+             {"name": "Sharada Mani", "review_count": 3}],
+            response.json()['reviewers'])
+        response = self.client.get('/api/open-load', {'project': "project-a"},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("project-a", response.json()['project'])
+        response = self.client.get('/api/open-load', {'project': "project-a"},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
     def test_get_current_reviewers_and_counts(self):
-        self._mock_open_change_reviewers_per_project = {
+        self._set_open_load({
             "project-a": {
                 "Reviewer A": 2,
                 "Reviewer X": 1,
@@ -920,7 +3071,7 @@ class TestView(TestCase):
                 "Reviewer Y": 1,
                 "Reviewer Z": 1
             }
-        }
+        })
         reviewer_count_info = views._get_current_reviewers_and_counts(
             "project-a")
         expected_project_a_info = [
@@ -4,4 +4,6 @@ from . import views
 
 urlpatterns = [
     url(r'^$', views.index, name='index'),
+    url(r'^api/leaderboard$', views.api_leaderboard, name='api_leaderboard'),
+    url(r'^api/open-load$', views.api_open_load, name='api_open_load'),
 ]
@@ -3,13 +3,18 @@ gerrit reviewers
 """
 from collections import OrderedDict
 from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.http import JsonResponse
 from django.shortcuts import render
+from django.views.decorators.http import condition, require_GET
+import hashlib
+import json
 import logging
 
-from leaderboard.current_load import current_load_fetcher
+from leaderboard.current_load import open_load_cache
 
-from .models import Reviewer, Change
-from .sync import fetcher
+from . import range_index
+from .sync import database_helper
 
 
 PROJECT_ALL = "all"
@@ -19,9 +24,37 @@ SORTED_TIME_PERIODS["1 Week"] = 7
 SORTED_TIME_PERIODS[TIME_PERIOD_DEFAULT] = 30
 SORTED_TIME_PERIODS["3 Months"] = 90
 SORTED_TIME_PERIODS["6 Months"] = 180
+# format of dates entered for a custom time period
+CUSTOM_DATE_FORMAT = "%Y-%m-%d"
+# seconds results computed from the changes stored are cached for, they are
+# no longer used once the data generation changes anyway
+RESULT_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _get_cached_result(name, generation, compute, *args):
+    """Return result computed from the changes stored, cached for the data
+    generation
+
+    Results are kept in django's cache, shared by all requests and worker
+    processes, until the data generation changes as a sync commits changes.
+
+    :arg str name: name of result, used in its cache key
+    :arg int generation: current data generation, looked up if None
+    :arg callable compute: function computing the result, called with the
+        data generation and args
+    :arg args: arguments the result depends on, used in its cache key
+    :Return: result of compute
+    """
+    if generation is None:
+        generation = database_helper.get_generation()
+    key = "leaderboard:%s:%d:%s" % (
+        name, generation,
+        hashlib.md5(repr(args).encode('utf-8')).hexdigest())
+    return cache.get_or_set(key, lambda: compute(generation, *args),
+                            RESULT_CACHE_TIMEOUT)
 
 
-def _get_projects(current_project_name):
+def _get_projects(current_project_name, generation=None):
     """Get all project names found in fetched changes
 
     Queries database for changes and returns a list of all associated
@@ -31,18 +64,14 @@ def _get_projects(current_project_name):
     :arg str current_project_name: any currently selected project, which is
         validated and then guaranteed to be first in list so that it shows as
         currently selected in drop down
+    :arg int generation: current data generation, looked up if None
     :Return: list of projects in the order they should be displayed in drop
         down with current_project_name if any and valid, being the first choice
     """
-    projects = []
-
-    unique_project_changes = Change.objects.order_by().values(
-        'project_name').distinct()
-    for change in unique_project_changes:
-        projects.append(change['project_name'])
-
-    # sort alphabetically
-    projects.sort()
+    # sorted alphabetically
+    projects = list(_get_cached_result(
+        "projects", generation,
+        lambda generation: database_helper.get_project_names()))
 
     # insert 'all' option as it should be present always
     projects.insert(0, PROJECT_ALL)
@@ -83,17 +112,39 @@ def _get_time_periods(current_time_period=None):
     return sorted_time_periods
 
 
-def _get_start_datetime_for_time_period(time_period, end_datetime=None):
+def _parse_date(value):
+    """Return date for a custom time period limit entered as YYYY-MM-DD
+
+    :arg str value: date entered, if any
+    :Return: date object, None if value is empty or invalid
+    """
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, CUSTOM_DATE_FORMAT).date()
+    except ValueError:
+        logging.error("Invalid date %s, expected YYYY-MM-DD. Ignoring.",
+                      value)
+        return None
+
+
+def _get_start_datetime_for_time_period(time_period, end_datetime=None,
+                                        from_date=None):
     """Return a UTC datetime corresponding to start of time_period
 
     Given a time period, return a datetime object for the start of the time
     period. If end_datetime is not specified, use current date and time as end
-    of time period for calculating start of time period.
+    of time period for calculating start of time period. If from_date is
+    specified, it is the start of a custom time period instead.
     :arg str time_period: One of the strings in SORTED_TIME_PERIODS
         designating a period of time
     :arg datetime end_datetime: datetime corresponding to end of time period
+    :arg date from_date: first day in UTC of a custom time period
     :Return: UTC datetime object representing start of time period
     """
+    if from_date:
+        return datetime.combine(from_date, datetime.min.time())
+
     if time_period not in SORTED_TIME_PERIODS.keys():
         logging.error(
             "Time period %s not in %r. Using default %s",
@@ -111,6 +162,25 @@ def _get_start_datetime_for_time_period(time_period, end_datetime=None):
     return start_datetime
 
 
+def _get_start_datetime_for_range(time_period, from_date, to_date):
+    """Return a UTC datetime corresponding to start of a time period selected
+    along with any custom first and last days entered
+
+    :arg str time_period: One of the strings in SORTED_TIME_PERIODS
+        designating a period of time
+    :arg date from_date: first day in UTC of a custom time period, overriding
+        time_period, if any
+    :arg date to_date: last day in UTC of a custom time period, or of
+        time_period, if any
+    :Return: UTC datetime object representing start of time period
+    """
+    # a time period selected ends on to_date if one was entered
+    end_datetime = to_date and datetime.combine(
+        to_date + timedelta(days=1), datetime.min.time())
+    return _get_start_datetime_for_time_period(time_period, end_datetime,
+                                               from_date)
+
+
 def _create_reviewer_info(reviewer_name, review_count, comment_count):
     return {
         "name": reviewer_name,
@@ -119,87 +189,22 @@ def _create_reviewer_info(reviewer_name, review_count, comment_count):
     }
 
 
-def _get_reviewers(project_name, from_datetime):
-    """Get reviewers from database filtered based on given parameters
-
-    Get reviewers from database filtered with given project_name and with
-    changes from from_datetime and later
-
-    :arg str project_name: filter list of reviewers to be only those with
-        changes in the corresponding project
-    :arg datetime from_datetime: filter reviewers to be only those with
-        changes after datetime
-
-    :Returns: A list of :class:`.models.Reviewer` objects.
-    """
-    logging.debug(
-        "Getting reviewers for project: %s from datetime: %r",
-        project_name, from_datetime)
+def _count_reviewers(generation, project_name, from_date, to_date):
     if project_name == PROJECT_ALL:
-        # reviewers with changes across all projects after from_datetime
-        reviewers = Reviewer.objects.filter(
-            changes__timestamp__gte=from_datetime).distinct()
-    else:
-        # reviewers with changes in given project after from_datetime
-        reviewers = Reviewer.objects.filter(
-            changes__project_name=project_name,
-            changes__timestamp__gte=from_datetime).distinct()
+        project_name = range_index.ALL_PROJECTS
 
-    logging.debug("Found reviewers: %r", reviewers)
-    return reviewers
-
-
-def _get_reviewer_change_count(reviewer, project_name, from_datetime):
-    """Return count of changes for reviewer
-
-    :arg models.Reviewer reviewer: reviewer to get change count for
-    :arg str project_name: filter changes to be only those in the corresponding
-        project
-    :arg datetime from_datetime: filter changes to be only those with timestamp
-        after from_datetime
-
-    :Return: count of changes for given reviewer filtered by project_name and
-        that have a timestamp after from_datetime
-    """
-    if project_name == PROJECT_ALL:
-        # changes across all projects after from_datetime
-        changes = reviewer.changes.filter(
-            timestamp__gte=from_datetime).distinct()
-    else:
-        # changes in given project after from_datetime
-        changes = reviewer.changes.filter(
-            project_name=project_name,
-            timestamp__gte=from_datetime).distinct()
-
-    return changes.count()
-
-
-def _get_reviewer_comment_count(reviewer, project_name, from_datetime):
-    """Return count of comments for reviewer
-
-    :arg models.Reviewer reviewer: reviewer to get change count for
-    :arg str project_name: filter comments to be only those for changes in the
-        corresponding project
-    :arg datetime from_datetime: filter comments to be only those with
-        timestamp after from_datetime
-
-    :Return: count of comments for given reviewer filtered by project_name and
-        that have a timestamp after from_datetime
-    """
-    if project_name == PROJECT_ALL:
-        # comments in changes across all projects after from_datetime
-        comments = reviewer.comments.filter(
-            timestamp__gte=from_datetime).distinct()
-    else:
-        # comments in changes in given project after from_datetime
-        comments = reviewer.comments.filter(
-            change__project_name=project_name,
-            timestamp__gte=from_datetime).distinct()
-
-    return comments.count()
+    reviewers_info = []
+    for reviewer_name, review_count, comment_count in \
+            range_index.get_index(generation).get_reviewers_and_counts(
+                project_name, from_date, to_date):
+        reviewers_info.append(
+            _create_reviewer_info(reviewer_name, review_count,
+                                  comment_count))
+    return reviewers_info
 
 
-def _get_reviewers_and_counts(project_name, from_datetime):
+def _get_reviewers_and_counts(project_name, from_datetime, to_date=None,
+                              generation=None):
     """Return reviewers with their changes and comments counts.
 
     Gets reviewers with changes newer than from_datetime and and in project
@@ -207,25 +212,28 @@ def _get_reviewers_and_counts(project_name, from_datetime):
     each reviewer in list of reviewers found, that contains the reviewer name,
     reviewer change count, and reviewer comment count.
 
+    Counts are looked up in the range index of reviewers' daily stats, so
+    they include the whole day from_datetime is on, and cached until the data
+    generation changes.
+
     :arg str project_name: filter list of reviewers to be only those with
         changes in the corresponding project
     :arg datetime from_datetime: filter reviewers to be only those with
         changes after from_datetime
+    :arg date to_date: filter reviewers to be only those with changes on or
+        before to_date, None for no limit
+    :arg int generation: current data generation, looked up if None
 
     :Return: A list of reviewer info dictionaries containing reviewer "name",
         "review_count" and "comment_count" info.
     """
-    reviewers_info = []
-    for reviewer in _get_reviewers(project_name, from_datetime):
-        reviewer_name = reviewer.full_name
-        review_count = _get_reviewer_change_count(reviewer, project_name,
-                                                  from_datetime)
-        comment_count = _get_reviewer_comment_count(reviewer, project_name,
-                                                    from_datetime)
-        reviewers_info.append(
-            _create_reviewer_info(reviewer_name, review_count,
-                                  comment_count))
-
+    logging.debug(
+        "Getting reviewers for project: %s from datetime: %r to date: %r",
+        project_name, from_datetime, to_date)
+    reviewers_info = _get_cached_result(
+        "reviewers", generation, _count_reviewers, project_name,
+        from_datetime.date(), to_date)
+    logging.debug("Found reviewers: %r", reviewers_info)
     return reviewers_info
 
 
@@ -266,7 +274,7 @@ def _get_current_reviewers_and_counts(project_name):
     :Return: A list of reviewer info dictionaries containing reviewer "name",
     and "review_count" representing open changes for the reviewer
     """
-    reviewer_change_count_per_project = current_load_fetcher.\
+    reviewer_change_count_per_project = open_load_cache.\
         get_open_change_reviewers_per_project()
 
     if project_name not in reviewer_change_count_per_project and \
@@ -290,27 +298,35 @@ def _get_current_reviewers_and_counts(project_name):
 
 
 def index(request):
-    # fetch outstanding changes, up to a configured maximum specified in
-    # ../fetcher.cfg
-    fetcher.pull_and_store_changes()
+    # changes are pulled from gerrit in the background by the leaderboard_sync
+    # management command, so only read from the database here
 
     # default to displaying reviewers with changes in all projects and for the
     # past month
     project_name = PROJECT_ALL
     time_period = TIME_PERIOD_DEFAULT
+    from_date = None
+    to_date = None
     if request.method == 'POST':
         logging.debug("request.POST = %r", request.POST)
         project_name = request.POST['project_name']
         time_period = request.POST['time_period']
-
-    time_period_start_datetime_utc = _get_start_datetime_for_time_period(
-        time_period)
+        # a custom time period overrides the time period selected
+        from_date = _parse_date(request.POST.get('from_date'))
+        to_date = _parse_date(request.POST.get('to_date'))
+
+    time_period_start_datetime_utc = _get_start_datetime_for_range(
+        time_period, from_date, to_date)
+    # results are cached until a sync commits changes
+    generation = database_helper.get_generation()
     # reviewers
     reviewers_info_list = _get_reviewers_and_counts(
         project_name,
-        time_period_start_datetime_utc)
+        time_period_start_datetime_utc,
+        to_date,
+        generation)
     # projects
-    project_list = _get_projects(project_name)
+    project_list = _get_projects(project_name, generation)
     # time choices
     time_period_list = _get_time_periods(time_period)
 
@@ -322,7 +338,122 @@ def index(request):
         'reviewers': reviewers_info_list,
         'projects': project_list,
         'time_periods': time_period_list,
-        'current_reviewers': current_reviewers_info_list
+        'from_date': from_date and from_date.strftime(CUSTOM_DATE_FORMAT),
+        'to_date': to_date and to_date.strftime(CUSTOM_DATE_FORMAT),
+        'current_reviewers': current_reviewers_info_list,
+        'last_sync': database_helper.get_last_sync_state()
     }
 
     return render(request, 'leaderboard/index.html', context)
+
+
+def _get_api_leaderboard_query(request):
+    """Return project and range of days requested from the leaderboard API
+
+    :arg HttpRequest request: GET request with optional "project", "period",
+        "from", and "to" parameters, like the form on the index page
+    :Return: tuple of project name, UTC datetime of start of time period, and
+        last day in UTC of time period if any
+    :Raises: ValueError if the time period or a date is invalid
+    """
+    project_name = request.GET.get('project') or PROJECT_ALL
+    time_period = request.GET.get('period') or TIME_PERIOD_DEFAULT
+    if time_period not in SORTED_TIME_PERIODS:
+        raise ValueError("Invalid period %s, expected one of %s" % (
+            time_period, ", ".join(SORTED_TIME_PERIODS)))
+    dates = []
+    for name in ('from', 'to'):
+        value = request.GET.get(name)
+        dates.append(_parse_date(value))
+        if value and not dates[-1]:
+            raise ValueError("Invalid %s date %s, expected YYYY-MM-DD" % (
+                name, value))
+    from_date, to_date = dates
+    return (project_name,
+            _get_start_datetime_for_range(time_period, from_date, to_date),
+            to_date)
+
+
+def _get_leaderboard_etag(request):
+    try:
+        project_name, from_datetime, to_date = _get_api_leaderboard_query(
+            request)
+    except ValueError:
+        return None
+    # the leaderboard only changes with the data generation and days asked
+    # for
+    return hashlib.md5(repr((
+        database_helper.get_generation(), project_name, from_datetime.date(),
+        to_date)).encode('utf-8')).hexdigest()
+
+
+def _get_leaderboard_last_modified(request):
+    # changes are also committed by imports and reprocessing, which aren't
+    # syncs
+    last_modified = database_helper.get_generation_updated() or \
+        database_helper.get_last_sync_finished()
+    if last_modified and not request.GET.get('from') and \
+            not request.GET.get('to'):
+        # a time period ending today starts a day later each day
+        last_modified = max(last_modified, datetime.combine(
+            datetime.utcnow().date(), datetime.min.time()))
+    return last_modified
+
+
+@require_GET
+@condition(etag_func=_get_leaderboard_etag,
+           last_modified_func=_get_leaderboard_last_modified)
+def api_leaderboard(request):
+    """Return reviewers with their merged changes and comments counts as JSON
+
+    Takes the same parameters as the index page, as "project", "period",
+    "from", and "to" GET parameters. Responses have an ETag that changes as
+    syncs commit changes, so polling clients can revalidate them cheaply.
+    """
+    try:
+        project_name, from_datetime, to_date = _get_api_leaderboard_query(
+            request)
+    except ValueError as err:
+        return JsonResponse({'error': str(err)}, status=400)
+    reviewers_info_list = sorted(
+        _get_reviewers_and_counts(project_name, from_datetime, to_date),
+        key=lambda reviewer: (-reviewer['review_count'],
+                              -reviewer['comment_count'], reviewer['name']))
+    return JsonResponse({
+        'project': project_name,
+        'from': from_datetime.strftime(CUSTOM_DATE_FORMAT),
+        'to': to_date and to_date.strftime(CUSTOM_DATE_FORMAT),
+        'reviewers': reviewers_info_list
+    })
+
+
+def _get_api_open_load(request):
+    return sorted(
+        _get_current_reviewers_and_counts(
+            request.GET.get('project') or PROJECT_ALL),
+        key=lambda reviewer: (-reviewer['review_count'], reviewer['name']))
+
+
+def _get_open_load_etag(request):
+    # open change load is cached, so is cheap to compare
+    return hashlib.md5(json.dumps(_get_api_open_load(request)).encode(
+        'utf-8')).hexdigest()
+
+
+def _get_open_load_last_modified(request):
+    return database_helper.get_last_sync_finished(open_changes=True)
+
+
+@require_GET
+@condition(etag_func=_get_open_load_etag,
+           last_modified_func=_get_open_load_last_modified)
+def api_open_load(request):
+    """Return reviewers with their open change counts as JSON
+
+    Takes an optional "project" GET parameter. Responses have an ETag that
+    changes with the counts, so polling clients can revalidate them cheaply.
+    """
+    return JsonResponse({
+        'project': request.GET.get('project') or PROJECT_ALL,
+        'reviewers': _get_api_open_load(request)
+    })